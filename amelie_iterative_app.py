@@ -6,9 +6,31 @@ import streamlit as st
 import pandas as pd
 import io
 
+import base64
+import bisect
+import copy
+import csv
+import hashlib
+import heapq
 import json
 import os
+import re
+import shlex
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import weakref
 import numpy as np
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+# dataclass(slots=True) richiede Python 3.10
+if sys.version_info < (3, 10):
+    raise RuntimeError("amelie_iterative_app requires Python 3.10 or newer")
 
 
 def update_black_mass_value(scenario, new_mass):
@@ -27,6 +49,507 @@ def update_black_mass_value(scenario, new_mass):
             break
 
     return scenario
+
+
+# Versione dello schema dei dati persistiti (scenari e case studies).
+# v1: fasi degli scenari come {"liquids": [{"type", "volume"}], "mass"},
+#     fasi della letteratura come {"masses": {...}, "liquids": {...}}
+# v2: formato canonico unico {"masses": {tipo: kg}, "liquids": {tipo: L}}
+# v3: i case studies indicano valuta ("currency") e anno ("cost_year") dei costi
+SCHEMA_VERSION = 3
+DEFAULT_COST_YEAR = 2024
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def normalize_phase(phase_data):
+    """
+    Converte una fase (qualsiasi formato storico) nel formato canonico
+    {"masses": {tipo: kg}, "liquids": {tipo: L}}.
+    """
+    if not isinstance(phase_data, dict):
+        return {"masses": {}, "liquids": {}}
+
+    masses = phase_data.get("masses")
+    if isinstance(masses, dict):
+        masses = {str(k): _to_float(v) for k, v in masses.items()}
+    else:
+        masses = {}
+    # Formato scenario v1: una sola massa per fase
+    if "mass" in phase_data:
+        masses["Black Mass"] = masses.get("Black Mass", 0.0) + _to_float(phase_data["mass"])
+
+    raw_liquids = phase_data.get("liquids", {})
+    liquids = {}
+    if isinstance(raw_liquids, dict):
+        for liquid_type, volume in raw_liquids.items():
+            liquids[str(liquid_type)] = _to_float(volume)
+    elif isinstance(raw_liquids, list):
+        for idx, liquid in enumerate(raw_liquids):
+            if isinstance(liquid, dict):
+                liquid_type = str(liquid.get("type", f"Liquid {idx + 1}"))
+                volume = _to_float(liquid.get("volume", 0.0))
+            else:
+                liquid_type = f"Liquid {idx + 1}"
+                volume = _to_float(liquid)
+            # Liquidi dello stesso tipo nella stessa fase vengono sommati
+            liquids[liquid_type] = liquids.get(liquid_type, 0.0) + volume
+
+    return {"masses": masses, "liquids": liquids}
+
+
+def migrate_record(record, defaults):
+    """
+    Porta uno scenario o un case study allo SCHEMA_VERSION corrente:
+    aggiunge le chiavi mancanti e normalizza le fasi. Va eseguita una sola
+    volta al caricamento, così le pagine non devono più controllare i tipi.
+    """
+    if not isinstance(record, dict):
+        record = {}
+    for key, default_value in defaults.items():
+        record.setdefault(key, default_value)
+
+    # Tutte le voci numeriche diventano float (i widget non accettano tipi misti)
+    for key in ("capex", "opex", "energy_consumption"):
+        if not isinstance(record.get(key), dict):
+            record[key] = {}
+        record[key] = {str(k): _to_float(v) for k, v in record[key].items()}
+    record["energy_cost"] = _to_float(record.get("energy_cost", 0.0))
+    if "currency" in record:
+        record["currency"] = str(record["currency"] or "EUR").strip().upper()
+    if "cost_year" in record:
+        record["cost_year"] = int(_to_float(record["cost_year"])) or DEFAULT_COST_YEAR
+
+    technical_kpis = record.get("technical_kpis")
+    if not isinstance(technical_kpis, dict):
+        technical_kpis = record["technical_kpis"] = {}
+    for key in ("composition", "recovered_masses"):
+        if key in technical_kpis:
+            values = technical_kpis[key] if isinstance(technical_kpis[key], dict) else {}
+            technical_kpis[key] = {str(k): _to_float(v) for k, v in values.items()}
+    phases = technical_kpis.get("phases")
+    if not isinstance(phases, dict):
+        phases = {}
+    technical_kpis["phases"] = {
+        phase_name: normalize_phase(phase_data) for phase_name, phase_data in phases.items()
+    }
+
+    record["schema_version"] = SCHEMA_VERSION
+    return record
+
+
+def _delta_floats(values):
+    # None è il marcatore di una chiave rimossa rispetto al genitore e va conservato
+    if not isinstance(values, dict):
+        return values
+    return {str(k): None if v is None else _to_float(v) for k, v in values.items()}
+
+
+def migrate_delta(overrides):
+    """
+    Come migrate_record, ma per le differenze di uno scenario derivato:
+    converte solo le chiavi presenti, senza aggiungere i valori di default
+    (che nasconderebbero quelli del genitore).
+    """
+    overrides = dict(overrides)
+    for key in ("capex", "opex", "energy_consumption"):
+        if key in overrides:
+            overrides[key] = _delta_floats(overrides[key])
+    if overrides.get("energy_cost") is not None:
+        overrides["energy_cost"] = _to_float(overrides["energy_cost"])
+    if overrides.get("currency") is not None:
+        overrides["currency"] = str(overrides["currency"]).strip().upper() or "EUR"
+    if overrides.get("cost_year") is not None:
+        overrides["cost_year"] = int(_to_float(overrides["cost_year"])) or DEFAULT_COST_YEAR
+
+    technical_kpis = overrides.get("technical_kpis")
+    if isinstance(technical_kpis, dict):
+        technical_kpis = dict(technical_kpis)
+        for key in ("composition", "recovered_masses"):
+            if key in technical_kpis:
+                technical_kpis[key] = _delta_floats(technical_kpis[key])
+        phases = technical_kpis.get("phases")
+        if isinstance(phases, dict):
+            migrated_phases = {}
+            for phase_name, phase_data in phases.items():
+                if not isinstance(phase_data, dict):
+                    migrated_phases[phase_name] = phase_data
+                elif "mass" in phase_data or isinstance(phase_data.get("liquids"), list):
+                    migrated_phases[phase_name] = normalize_phase(phase_data)  # Fase completa in formato storico
+                else:
+                    migrated_phases[phase_name] = {key: _delta_floats(value) for key, value in phase_data.items()}
+            technical_kpis["phases"] = migrated_phases
+        overrides["technical_kpis"] = technical_kpis
+    if "schema_version" in overrides:
+        overrides["schema_version"] = SCHEMA_VERSION
+    return overrides
+
+
+def get_default_case_study():
+    return {
+        "assumptions": [],
+        "capex": {},
+        "opex": {},
+        "energy_cost": 0.12,
+        "energy_consumption": {},
+        "technical_kpis": {},
+        "currency": "EUR",
+        "cost_year": DEFAULT_COST_YEAR
+    }
+
+
+def phase_totals(phase_data):
+    """Restituisce (massa totale, volume totale) di una fase canonica."""
+    return sum(phase_data["masses"].values()), sum(phase_data["liquids"].values())
+
+
+# --- Import massivo dei case studies da CSV/JSONL ---
+# JSONL: una riga per case study, {"name": ..., "capex": {...}, "technical_kpis": {...}, ...}.
+# CSV: una colonna "name" più colonne con percorso puntato, ad es. "capex.Reactor",
+# "composition.Co", "phases.Leach.liquids.Water"; "assumptions" separate da "|".
+IMPORT_BATCH_SIZE = 1000
+IMPORT_CSV_TECHNICAL_KEYS = ("composition", "recovered_masses", "efficiency", "phases")
+
+
+def _import_number(value, field):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{field}: '{value}' is not a number")
+    if not np.isfinite(number) or number < 0:
+        raise ValueError(f"{field}: must be a non-negative number")
+    return number
+
+
+def _import_items(values, field):
+    if not isinstance(values, dict):
+        raise ValueError(f"{field}: expected an object of name -> value")
+    return {str(name): _import_number(value, f"{field}.{name}") for name, value in values.items()}
+
+
+def _unflatten_csv_row(row):
+    """Converte le colonne puntate di una riga CSV nel dict annidato di un case study."""
+    record = {}
+    for column, value in row.items():
+        if column is None:
+            raise ValueError("row has more values than the header")
+        if value is None or value.strip() == "":
+            continue
+        path = column.strip().split(".")
+        if path[0] == "assumptions":
+            record["assumptions"] = [part.strip() for part in value.split("|") if part.strip()]
+            continue
+        if path[0] in IMPORT_CSV_TECHNICAL_KEYS:
+            path = ["technical_kpis"] + path
+        target = record
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+            if not isinstance(target, dict):
+                raise ValueError(f"column '{column}' conflicts with another column")
+        target[path[-1]] = value
+    return record
+
+
+def parse_case_study_row(row):
+    """Valida una riga importata e la normalizza nello schema dei case studies: (nome, record)."""
+    row = dict(row)
+    name = str(row.pop("name", "") or "").strip()
+    if not name:
+        raise ValueError("missing case study name")
+    unknown_keys = set(row) - set(get_default_case_study()) - {"schema_version"}
+    if unknown_keys:
+        raise ValueError(f"unknown fields: {', '.join(sorted(unknown_keys))}")
+
+    record = {}
+    assumptions = row.get("assumptions", [])
+    if not isinstance(assumptions, list):
+        raise ValueError("assumptions: expected a list of strings")
+    record["assumptions"] = [str(assumption) for assumption in assumptions]
+    for key in ("capex", "opex", "energy_consumption"):
+        record[key] = _import_items(row.get(key, {}), key)
+    record["energy_cost"] = _import_number(row.get("energy_cost", 0.12), "energy_cost")
+    record["currency"] = str(row.get("currency", "EUR")).strip().upper()
+    if not re.fullmatch(r"[A-Z]{3}", record["currency"]):
+        raise ValueError(f"currency: '{record['currency']}' is not a three-letter currency code")
+    cost_year = _import_number(row.get("cost_year", DEFAULT_COST_YEAR), "cost_year")
+    if cost_year != int(cost_year) or not 1950 <= cost_year <= 2100:
+        raise ValueError(f"cost_year: '{row.get('cost_year')}' is not a valid year")
+    record["cost_year"] = int(cost_year)
+
+    technical_kpis = row.get("technical_kpis", {})
+    if not isinstance(technical_kpis, dict):
+        raise ValueError("technical_kpis: expected an object")
+    record["technical_kpis"] = dict(technical_kpis)
+    for key in ("composition", "recovered_masses"):
+        if key in technical_kpis:
+            record["technical_kpis"][key] = _import_items(technical_kpis[key], key)
+    # Gli altri KPI (total_black_mass, custom_kpis, ...) sono numeri o oggetti nome -> numero
+    for key, value in technical_kpis.items():
+        if key not in IMPORT_CSV_TECHNICAL_KEYS:
+            record["technical_kpis"][key] = (_import_items(value, key) if isinstance(value, dict)
+                                             else _import_number(value, key))
+    if "efficiency" in technical_kpis:
+        efficiency = _import_number(technical_kpis["efficiency"], "efficiency")
+        if efficiency > 100:
+            raise ValueError("efficiency: must be between 0 and 100")
+        record["technical_kpis"]["efficiency"] = efficiency
+    phases = technical_kpis.get("phases", {})
+    if not isinstance(phases, dict):
+        raise ValueError("phases: expected an object of phase name -> masses/liquids")
+    for phase_name, phase_data in phases.items():
+        if not isinstance(phase_data, dict):
+            raise ValueError(f"phases.{phase_name}: expected an object")
+        for group in ("masses", "liquids"):
+            if isinstance(phase_data.get(group), dict):
+                phase_data[group] = _import_items(phase_data[group], f"phases.{phase_name}.{group}")
+    return name, migrate_record(record, get_default_case_study())
+
+
+def iter_import_rows(file, file_format):
+    """Legge il file riga per riga: restituisce (numero di riga, dict o None, errore o None)."""
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    if file_format == "csv":
+        reader = csv.DictReader(text)
+        for row in reader:
+            try:
+                yield reader.line_num, _unflatten_csv_row(row), None
+            except ValueError as e:
+                yield reader.line_num, None, str(e)
+    else:
+        for line_number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, None, f"invalid JSON: {e}"
+                continue
+            if isinstance(row, dict):
+                yield line_number, row, None
+            else:
+                yield line_number, None, "expected a JSON object"
+    text.detach()
+
+
+def import_case_studies(file, file_format, existing_names, write_batch, overwrite=False, report_progress=None):
+    """
+    Importa in streaming i case studies di un file CSV o JSONL. Le righe valide
+    vengono raccolte a lotti di IMPORT_BATCH_SIZE e ogni lotto è passato subito
+    a write_batch, così in memoria resta un solo lotto alla volta.
+    Restituisce (numero di case studies importati, [(riga, errore)]).
+    """
+    imported_names = set()
+    batch = {}
+    errors = []
+
+    def flush():
+        if batch:
+            write_batch(dict(batch))
+            imported_names.update(batch)
+            batch.clear()
+        if report_progress is not None:
+            report_progress(len(imported_names), len(errors))
+
+    for line_number, row, error in iter_import_rows(file, file_format):
+        if error is None:
+            try:
+                name, record = parse_case_study_row(row)
+                if name in imported_names or name in batch:
+                    raise ValueError(f"duplicate case study name '{name}' in file")
+                if name in existing_names and not overwrite:
+                    raise ValueError(f"case study '{name}' already exists")
+                batch[name] = record
+            except ValueError as e:
+                error = str(e)
+        if error is not None:
+            errors.append((line_number, error))
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            flush()
+    flush()
+    return len(imported_names), errors
+
+
+# --- Journal delle modifiche ---
+# Ogni salvataggio aggiunge una riga JSON con le sole operazioni cambiate
+# (in stile JSON Patch, con path JSON Pointer). Periodicamente il journal viene
+# compattato in background nello snapshot JSON, che resta nel formato di sempre.
+JOURNAL_COMPACT_EVERY = 200  # Numero di salvataggi prima della compattazione
+
+
+def _pointer_escape(key):
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def _pointer_parts(path):
+    return [part.replace("~1", "/").replace("~0", "~") for part in path.split("/")[1:]]
+
+
+def journal_ops(before, after, path=""):
+    """Operazioni add/remove che trasformano `before` in `after` (ricorsivo sui dict)."""
+    ops = []
+    for key in before:
+        if key not in after:
+            ops.append({"op": "remove", "path": f"{path}/{_pointer_escape(key)}"})
+    for key, value in after.items():
+        key_path = f"{path}/{_pointer_escape(key)}"
+        if key in before and isinstance(value, dict) and isinstance(before[key], dict):
+            ops.extend(journal_ops(before[key], value, key_path))
+        elif key not in before or value != before[key]:
+            ops.append({"op": "add", "path": key_path, "value": copy.deepcopy(value)})
+    return ops
+
+
+def apply_journal_ops(state, ops):
+    for op in ops:
+        *parents, last = _pointer_parts(op["path"])
+        target = state
+        for part in parents:
+            target = target.setdefault(part, {})
+        if op["op"] == "remove":
+            target.pop(last, None)
+        else:
+            target[last] = copy.deepcopy(op["value"])
+    return state
+
+
+@st.cache_resource
+def journal_lock(path):
+    # Lock condiviso tra sessioni e thread di compattazione per lo stesso file
+    return threading.Lock()
+
+
+class EditJournal:
+    """
+    Persistenza di un dataset (dict JSON) come snapshot + journal append-only.
+    Il costo di scrittura di un salvataggio è proporzionale alla modifica.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.sealed_path = path + ".journal.compacting"
+        self._lock = journal_lock(path)
+        self._state = None  # Ultimo stato persistito
+        self._entries = 0
+
+    def exists(self):
+        return any(os.path.exists(p) for p in (self.path, self.journal_path, self.sealed_path))
+
+    @staticmethod
+    def _replay(state, journal_path):
+        entries = 0
+        if not os.path.exists(journal_path):
+            return entries
+        with open(journal_path, "r") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Frammento troncato da un crash: le righe successive restano valide
+                apply_journal_ops(state, entry["ops"])
+                entries += 1
+        return entries
+
+    def _read(self):
+        state = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as file:
+                state = json.load(file)
+        if isinstance(state, dict):
+            # Un'eventuale compattazione interrotta viene riapplicata prima del journal
+            self._replay(state, self.sealed_path)
+            self._entries = self._replay(state, self.journal_path)
+        return state
+
+    def load(self):
+        """Carica lo snapshot e riapplica il journal. Solleva JSONDecodeError se lo snapshot è corrotto."""
+        with self._lock:
+            state = self._read()
+        self._state = copy.deepcopy(state)
+        return state
+
+    def record(self, data):
+        """
+        Aggiunge al journal le differenze rispetto all'ultimo stato persistito.
+        Restituisce le operazioni scritte, oppure None se è stato creato un
+        nuovo snapshot (tutto il dataset è nuovo).
+        """
+        if self._state is None:
+            with self._lock:
+                if not self.exists():
+                    self._write_snapshot(data)
+                    return None
+                # Un'altra sessione ha già creato il dataset: si parte dal suo stato
+                self._state = self._read()
+        ops = journal_ops(self._state, data)
+        if not ops:
+            return ops
+        # Il ritorno a capo iniziale chiude un eventuale frammento lasciato da un crash
+        line = "\n" + json.dumps({"ts": time.time(), "ops": ops}) + "\n"
+        with self._lock:
+            with open(self.journal_path, "a") as file:
+                file.write(line)
+                file.flush()
+                os.fsync(file.fileno())
+        apply_journal_ops(self._state, ops)
+        self._entries += 1
+        if self._entries >= JOURNAL_COMPACT_EVERY:
+            self._entries = 0
+            threading.Thread(target=self.compact, daemon=True).start()
+        return ops
+
+    def _write_snapshot(self, data):
+        # Solo per un dataset nuovo (chiamata con il lock acquisito): non ci sono journal da preservare
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(data, file, indent=4)
+        os.replace(temp_path, self.path)
+        self._state = copy.deepcopy(data)
+        self._entries = 0
+
+    def content_key(self):
+        """
+        Chiave del contenuto persistito senza ricaricarlo: digest dello snapshot (e del journal
+        in compattazione) più la lunghezza del journal, che cresce solo per append.
+        """
+        digest = hashlib.sha1()
+        with self._lock:
+            for path in (self.path, self.sealed_path):
+                if os.path.exists(path):
+                    with open(path, "rb") as file:
+                        digest.update(file.read())
+                digest.update(b"\0")
+            journal_size = os.path.getsize(self.journal_path) if os.path.exists(self.journal_path) else 0
+        return f"{digest.hexdigest()[:16]}-{journal_size}"
+
+    def compact(self):
+        """Riporta il journal nello snapshot. Le scritture concorrenti vanno in un journal nuovo."""
+        with self._lock:
+            if os.path.exists(self.sealed_path) or not os.path.exists(self.journal_path):
+                return  # Compattazione già in corso o niente da fare
+            os.replace(self.journal_path, self.sealed_path)
+
+        state = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as file:
+                state = json.load(file)
+        self._replay(state, self.sealed_path)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(state, file, indent=4)
+
+        with self._lock:
+            os.replace(temp_path, self.path)
+            os.remove(self.sealed_path)
+
+
 # Path to the JSON file
 data_dir = "data"
 if not os.path.exists(data_dir):
@@ -36,41 +559,154 @@ case_studies_file = os.path.join(data_dir, "case_studies.json")
 
 # Load case studies into session state on app start
 if "case_studies" not in st.session_state:
-    if os.path.exists(case_studies_file):
-        with open(case_studies_file, "r") as file:
-            try:
-                loaded_data = json.load(file)
-                # Verifica che ogni case study sia un dizionario
-                if isinstance(loaded_data, dict):
-                    for case_study_name, case_study in loaded_data.items():
-                        # Assicura che il valore sia un dizionario
-                        if not isinstance(case_study, dict):
-                            # Sostituisci con una struttura vuota valida
-                            loaded_data[case_study_name] = {
-                                "assumptions": [],
-                                "capex": {},
-                                "opex": {},
-                                "energy_cost": 0.12,
-                                "energy_consumption": {}
-                            }
-                        else:
-                            # Aggiungi chiavi mancanti con valori di default
-                            case_study.setdefault("assumptions", [])
-                            case_study.setdefault("capex", {})
-                            case_study.setdefault("opex", {})
-                            case_study.setdefault("energy_cost", 0.12)
-                            case_study.setdefault("energy_consumption", {})
-                    st.session_state.case_studies = loaded_data
-                else:
-                    # Se i dati non sono un dizionario, inizializza vuoto
-                    st.session_state.case_studies = {}
-            except json.JSONDecodeError:
-                st.warning("Case studies file is invalid. Starting with an empty state.")
+    st.session_state.case_studies_journal = EditJournal(case_studies_file)
+    if st.session_state.case_studies_journal.exists():
+        try:
+            loaded_data = st.session_state.case_studies_journal.load()
+            # Verifica che ogni case study sia un dizionario e migra allo schema corrente
+            if isinstance(loaded_data, dict):
+                for case_study_name, case_study in loaded_data.items():
+                    loaded_data[case_study_name] = migrate_record(case_study, get_default_case_study())
+                st.session_state.case_studies = loaded_data
+            else:
+                # Se i dati non sono un dizionario, inizializza vuoto
                 st.session_state.case_studies = {}
+        except json.JSONDecodeError:
+            st.warning("Case studies file is invalid. Starting with an empty state.")
+            st.session_state.case_studies = {}
     else:
         st.session_state.case_studies = {}
 
 
+# --- Politica di output dei grafici ---
+# Formato, DPI massimo e dimensione massima (larghezza e pixel totali) di ogni
+# grafico inviato al browser. Ogni installazione può sovrascriverla con
+# data/chart_policy.json (stessa struttura). max_width è la larghezza massima
+# del contenuto di Streamlit: oltre questa l'immagine verrebbe ricampionata.
+# Con renderer "vega-lite" i grafici che hanno una specifica sono disegnati dal
+# browser e matplotlib resta solo per l'esportazione statica.
+chart_policy_file = os.path.join(data_dir, "chart_policy.json")
+CHART_FORMATS = ("png", "webp", "svg")
+CHART_RENDERERS = ("matplotlib", "vega-lite")
+DEFAULT_CHART_POLICY = {
+    "renderer": "matplotlib",
+    "format": "png",
+    "max_dpi": 100,
+    "max_width": 1460,
+    "max_pixels": 1_500_000,
+    "webp_quality": 80
+}
+
+
+def load_chart_policy():
+    """Politica dei grafici: file locale se presente, altrimenti i valori predefiniti."""
+    policy = DEFAULT_CHART_POLICY
+    if os.path.exists(chart_policy_file):
+        try:
+            with open(chart_policy_file, "r") as file:
+                policy = {**DEFAULT_CHART_POLICY, **json.load(file)}
+        except (OSError, ValueError) as e:
+            st.warning(f"Could not read {chart_policy_file}, using the default chart policy: {e}")
+    if policy["format"] not in CHART_FORMATS:
+        st.warning(f"Unsupported chart format '{policy['format']}', using PNG.")
+        policy = {**policy, "format": "png"}
+    if policy["renderer"] not in CHART_RENDERERS:
+        st.warning(f"Unsupported chart renderer '{policy['renderer']}', using matplotlib.")
+        policy = {**policy, "renderer": "matplotlib"}
+    return policy
+
+
+chart_policy = load_chart_policy()
+# Grafici e byte inviati durante questa esecuzione dello script
+chart_payload = {"charts": 0, "bytes": 0}
+# Grafici già mostrati per nome in questa esecuzione: chiavi stabili per i pulsanti di download
+chart_names = {}
+
+
+def render_chart(fig, policy=None):
+    """
+    Serializza e chiude una figura secondo la politica dei grafici.
+    Il DPI è il più alto che rispetta max_dpi, max_width e max_pixels sul
+    riquadro ritagliato della figura. Restituisce dati accettati da st.image:
+    byte PNG, markup SVG oppure un data URI WebP (Streamlit ricodificherebbe
+    i byte WebP in PNG/JPEG).
+    """
+    policy = policy or chart_policy
+    try:
+        bbox = fig.get_tightbbox(fig.canvas.get_renderer()).padded(0.1)
+        dpi = min(policy["max_dpi"], policy["max_width"] / bbox.width,
+                  (policy["max_pixels"] / (bbox.width * bbox.height)) ** 0.5)
+        buf = io.BytesIO()
+        options = {"pil_kwargs": {"quality": policy["webp_quality"]}} if policy["format"] == "webp" else {}
+        fig.savefig(buf, format=policy["format"], dpi=dpi, bbox_inches="tight", **options)
+    finally:
+        plt.close(fig)
+
+    if policy["format"] == "svg":
+        payload = buf.getvalue().decode("utf-8")
+    elif policy["format"] == "webp":
+        payload = "data:image/webp;base64," + base64.b64encode(buf.getvalue()).decode("ascii")
+    else:
+        payload = buf.getvalue()
+    chart_payload["charts"] += 1
+    chart_payload["bytes"] += len(payload)
+    return payload
+
+
+def show_chart(fig, caption=None):
+    """Sostituto di st.pyplot che applica la politica dei grafici."""
+    st.image(render_chart(fig), caption=caption, use_container_width=True)
+
+
+def export_chart(fig):
+    """PNG per il download al DPI massimo della politica; non conta nel payload della pagina."""
+    buf = io.BytesIO()
+    try:
+        fig.savefig(buf, format="png", dpi=chart_policy["max_dpi"], bbox_inches="tight")
+    finally:
+        plt.close(fig)
+    return buf.getvalue()
+
+
+def show_figure(draw, frame=None, spec=None, caption=None, name="chart"):
+    """
+    Mostra un grafico secondo il renderer della politica. draw() costruisce la
+    figura matplotlib; spec è la specifica Vega-Lite equivalente sui dati di
+    frame. In modalità "vega-lite" la figura viene costruita solo se l'utente
+    scarica il PNG; senza specifica si ricade sulla figura matplotlib.
+    """
+    if chart_policy["renderer"] != "vega-lite" or spec is None:
+        show_chart(draw(), caption)
+        return
+    st.vega_lite_chart(frame, spec)
+    if caption:
+        st.caption(caption)
+    # La chiave dipende dal nome, non dalla posizione del grafico nella pagina
+    occurrence = chart_names.get(name, 0)
+    chart_names[name] = occurrence + 1
+    st.download_button("Download PNG", data=lambda: export_chart(draw()),
+                       file_name=f"{re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_')}.png", mime="image/png",
+                       key=f"export_chart_{name}" + (f"_{occurrence}" if occurrence else ""))
+    chart_payload["charts"] += 1
+    chart_payload["bytes"] += len(json.dumps(spec)) + (len(frame.to_json(orient="records")) if frame is not None else 0)
+
+
+def line_spec(frame, x, series, y_title, title=None, x_type="quantitative", mark="line"):
+    """Specifica Vega-Lite per più serie (colonne di frame) in funzione di x."""
+    spec = {
+        "transform": [{"fold": list(series), "as": ["Series", "Value"]}],
+        "mark": {"type": mark, "tooltip": True},
+        "encoding": {
+            "x": {"field": x, "type": x_type},
+            "y": {"field": "Value", "type": "quantitative", "title": y_title,
+                  **({"stack": "zero"} if mark == "area" else {})},
+            "color": {"field": "Series", "type": "nominal", "title": None}
+        }
+    }
+    if title:
+        spec["title"] = title
+    return frame, spec
+
 
 class AmelieEconomicModel:
     def __init__(self):
@@ -84,6 +720,7 @@ class AmelieEconomicModel:
             "Microwave Thermal Treatment": 2.5
         }
         self.energy_cost = st.session_state.get("amelie_energy_cost", 0.12)  # Default 0.12 EUR per kWh
+        self.energy_schedule = None  # Profilo orario per la tariffa a fasce (None: prezzo flat)
         self.black_mass = 10
 
 
@@ -94,9 +731,9 @@ class AmelieEconomicModel:
 
     def calculate_total_energy_cost(self):
         total_kWh = sum(self.energy_consumption.values())
-        return total_kWh * self.energy_cost
+        return total_kWh * effective_energy_price(self.energy_consumption, self.energy_cost, self.energy_schedule)
 
-    def generate_pie_chart(self, data, title):
+    def pie_figure(self, data, title):
         fig, ax = plt.subplots(figsize=(12, 10))
         explode = [0.1 if key in ["Reagents", "Energy", "Labor"] else 0 for key in data.keys()]
         wedges, texts, autotexts = ax.pie(
@@ -117,18 +754,23 @@ class AmelieEconomicModel:
         for text in autotexts:
             text.set_fontsize(14)
             text.set_color('black')
+        return fig
+
+    def pie_chart_spec(self, data, title):
+        frame = pd.DataFrame({"Category": list(data.keys()), "Cost (EUR)": list(data.values())})
+        spec = {
+            "title": title,
+            "mark": {"type": "arc", "tooltip": True},
+            "encoding": {
+                "theta": {"field": "Cost (EUR)", "type": "quantitative"},
+                "color": {"field": "Category", "type": "nominal"}
+            }
+        }
+        return frame, spec
 
-        buf = io.BytesIO()
-        try:
-            plt.savefig(buf, format='png', bbox_inches="tight")
-        except ValueError as e:
-            plt.close(fig)
-            raise ValueError(f"Error generating pie chart: {e}")
-        finally:
-            plt.close(fig)
-
-        buf.seek(0)
-        return buf
+    def show_pie_chart(self, data, title, caption=None):
+        show_figure(lambda: self.pie_figure(data, title), *self.pie_chart_spec(data, title), caption=caption,
+                    name=title)
 
     def generate_table(self, data):
         df = pd.DataFrame(list(data.items()), columns=['Category', 'Cost (EUR)'])
@@ -161,6 +803,12 @@ def get_default_opex():
         'Wastewater Treatment Chemicals': 6.0
     }
 
+def get_default_phases():
+    return {
+        "Leaching in Water": {"masses": {"Black Mass": 5.0}, "liquids": {"Water": 20.0}},
+        "Leaching in Acid": {"masses": {"Black Mass": 5.0}, "liquids": {"Malic Acid": 5.0, "Water": 2.0}}
+    }
+
 def get_default_scenario():
     default_black_mass = 10.0  # Definiamo un valore di default una volta sola
     return {
@@ -190,10 +838,2168 @@ def get_default_scenario():
             "efficiency": 0.0,
             "phases": {},
             "total_black_mass": default_black_mass  # E lo aggiungiamo anche qui
+        },
+        "schema_version": SCHEMA_VERSION
+    }
+
+
+# --- Reagenti collegati alle fasi Solid/Liquid ---
+# Con "reagent_link" = {"prices": {liquido: EUR/L}, "reference_black_mass": kg}
+# le voci OpEx dei liquidi collegati sono derivate dai volumi delle fasi,
+# riferiti a reference_black_mass e scalati con la total_black_mass del batch.
+def phase_liquid_volumes(phases):
+    """Volumi (L) per tipo di liquido, sommati su tutte le fasi."""
+    volumes = {}
+    for phase in phases.values():
+        for liquid, volume in phase["liquids"].items():
+            volumes[liquid] = volumes.get(liquid, 0.0) + volume
+    return volumes
+
+
+def reagent_scale(scenario):
+    link = scenario.get("reagent_link") or {}
+    reference = link.get("reference_black_mass") or 0.0
+    batch_mass = scenario.get("technical_kpis", {}).get("total_black_mass", reference)
+    return batch_mass / reference if reference > 0 else 1.0
+
+
+def sync_linked_reagents(scenario):
+    """
+    Aggiorna le voci OpEx dei reagenti collegati. Solo le voci il cui valore
+    cambia vengono riscritte; restituisce i loro nomi.
+    """
+    link = scenario.get("reagent_link") or {}
+    if not link.get("prices"):
+        return []
+    # Senza fasi salvate i volumi sono nulli: le fasi di default sono solo un punto di partenza dell'editor
+    volumes = phase_liquid_volumes(scenario.get("technical_kpis", {}).get("phases") or {})
+    scale = reagent_scale(scenario)
+    opex = dict(scenario.get("opex", {}))
+    changed = []
+    for liquid, unit_price in link["prices"].items():
+        value = round(volumes.get(liquid, 0.0) * unit_price * scale, 6)
+        if opex.get(liquid) != value:
+            opex[liquid] = value
+            changed.append(liquid)
+    if changed:
+        scenario["opex"] = opex
+    return changed
+
+
+def reagent_opex_sweep(volumes, unit_prices, batch_masses, reference_black_mass):
+    """Costo dei reagenti (masse di batch x reagenti) per un intero sweep in un prodotto esterno."""
+    return np.outer(np.asarray(batch_masses, dtype=np.float64) / reference_black_mass,
+                    np.asarray(volumes, dtype=np.float64) * np.asarray(unit_prices, dtype=np.float64))
+
+
+# Rappresentazione compatta degli scenari in memoria: le voci CapEx/OpEx/energia
+# sono array paralleli di nomi e float64 invece di dizionari di float Python.
+@dataclass(slots=True)
+class LineItems:
+    names: tuple
+    values: np.ndarray
+
+    @classmethod
+    def from_dict(cls, data, names_cache=None):
+        names = tuple(data.keys())
+        if names_cache is not None:
+            # Scenari con le stesse voci condividono la stessa tupla di nomi
+            names = names_cache.setdefault(names, names)
+        return cls(names, np.fromiter(data.values(), dtype=np.float64, count=len(names)))
+
+    def to_dict(self):
+        return dict(zip(self.names, self.values.tolist()))
+
+    def total(self):
+        return float(self.values.sum())
+
+
+@dataclass(slots=True)
+class ScenarioModel:
+    capex: LineItems
+    opex: LineItems
+    energy_consumption: LineItems
+    energy_cost: float
+    assumptions: list
+    technical_kpis: dict
+    extra: dict  # Altre chiavi del JSON (schema_version, ...) conservate così come sono
+
+    @classmethod
+    def from_dict(cls, data, names_cache=None):
+        data = dict(data)
+        return cls(
+            capex=LineItems.from_dict(data.pop("capex", {}), names_cache),
+            opex=LineItems.from_dict(data.pop("opex", {}), names_cache),
+            energy_consumption=LineItems.from_dict(data.pop("energy_consumption", {}), names_cache),
+            energy_cost=float(data.pop("energy_cost", 0.12)),
+            assumptions=list(data.pop("assumptions", [])),
+            technical_kpis=copy.deepcopy(data.pop("technical_kpis", {})),
+            extra=data
+        )
+
+    def to_dict(self):
+        return {
+            "capex": self.capex.to_dict(),
+            "opex": self.opex.to_dict(),
+            "energy_cost": self.energy_cost,
+            "energy_consumption": self.energy_consumption.to_dict(),
+            "assumptions": list(self.assumptions),
+            "technical_kpis": copy.deepcopy(self.technical_kpis),
+            **copy.deepcopy(self.extra)
         }
+
+    def energy_total(self):
+        price = effective_energy_price(self.energy_consumption.to_dict(), self.energy_cost,
+                                       self.extra.get("energy_schedule"))
+        return float(self.energy_consumption.values.sum() * price)
+
+
+# Nome riservato del genitore implicito: get_default_scenario()
+DEFAULT_PARENT = "__default__"
+
+
+def scenario_delta(base, data):
+    """
+    Calcola le sole differenze di `data` rispetto a `base` (ricorsivo sui dict).
+    Le chiavi rimosse rispetto al genitore sono marcate con None.
+    """
+    delta = {}
+    for key, value in data.items():
+        base_value = base.get(key)
+        if isinstance(value, dict) and isinstance(base_value, dict):
+            sub_delta = scenario_delta(base_value, value)
+            if sub_delta:
+                delta[key] = sub_delta
+        elif key not in base or value != base_value:
+            delta[key] = copy.deepcopy(value)
+    for key in base:
+        if key not in data:
+            delta[key] = None
+    return delta
+
+
+def apply_scenario_delta(base, delta):
+    merged = copy.deepcopy(base)
+    for key, value in delta.items():
+        if value is None:
+            merged.pop(key, None)
+        elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = apply_scenario_delta(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+@dataclass(slots=True)
+class ScenarioDelta:
+    parent: str
+    overrides: dict
+
+
+class ScenarioStore(MutableMapping):
+    """
+    Contenitore degli scenari in st.session_state. store[name] restituisce
+    una copia dict dello scenario da modificare e riassegnare con
+    store[name] = scenario, come fanno già le pagine; le sole letture usano
+    view(name), che non copia.
+
+    Uno scenario può dichiarare un genitore ("parent"): in quel caso si
+    conservano solo le differenze e lo scenario completo viene risolto al
+    primo accesso e tenuto in cache finché il genitore non cambia.
+    Le voci OpEx dei reagenti collegati sono ricalcolate dalle fasi risolte,
+    quindi seguono anche le fasi ereditate; i delta non le contengono.
+    """
+
+    def __init__(self, scenarios=None):
+        self._entries = {}  # nome -> ScenarioModel (radice) o ScenarioDelta
+        self._resolved = {}  # cache degli scenari derivati già risolti
+        self._dicts = {}  # cache dei dict risolti, valida finché lo scenario non cambia
+        self._names_cache = {}
+        self.version = 0  # Incrementata a ogni modifica (usata dalle cache derivate)
+        for name, data in (scenarios or {}).items():
+            if "parent" in data:
+                overrides = {key: value for key, value in data.items() if key != "parent"}
+                self._entries[name] = ScenarioDelta(data["parent"], overrides)
+            else:
+                self._entries[name] = ScenarioModel.from_dict(data, self._names_cache)
+
+    def __getitem__(self, name):
+        return copy.deepcopy(self._dict(name))
+
+    def view(self, name):
+        """Scenario in sola lettura, senza copia: le strutture annidate non vanno modificate."""
+        return types.MappingProxyType(self._dict(name))
+
+    def _dict(self, name):
+        if name not in self._dicts:
+            if name not in self._entries:
+                raise KeyError(name)
+            self._dicts[name] = self._resolve_dict(name)
+        return self._dicts[name]
+
+    def __setitem__(self, name, data):
+        data = dict(data)
+        parent = data.pop("parent", self.parent(name))
+        # Le voci OpEx collegate seguono sempre le fasi; la copia riceve un nuovo dict OpEx,
+        # quindi lo scenario del chiamante resta invariato
+        sync_linked_reagents(data)
+        if name in self._entries and parent == self.parent(name) and data == self._dict(name):
+            return  # Nessuna modifica: la versione dei dati non cambia
+        if parent is None:
+            self._entries[name] = ScenarioModel.from_dict(data, self._names_cache)
+        else:
+            base = self._dict(parent) if parent in self._entries else get_default_scenario()
+            overrides = scenario_delta(base, data)
+            # Le voci collegate sono ricalcolate alla risoluzione: nel delta resterebbero ferme
+            if isinstance(overrides.get("opex"), dict):
+                for liquid in (data.get("reagent_link") or {}).get("prices", {}):
+                    overrides["opex"].pop(liquid, None)
+                if not overrides["opex"]:
+                    del overrides["opex"]
+            self._entries[name] = ScenarioDelta(parent, overrides)
+        self._invalidate(name)
+
+    def __delitem__(self, name):
+        # I figli dello scenario eliminato vengono riagganciati al suo genitore;
+        # se era una radice diventano radici con i valori già risolti
+        new_parent = self.parent(name)
+        children = {child: self._resolve_dict(child) for child in self.children(name)}
+        del self._entries[name]
+        self._invalidate(name)
+        for child, child_data in children.items():
+            self[child] = {**child_data, "parent": new_parent}
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def parent(self, name):
+        entry = self._entries.get(name)
+        return entry.parent if isinstance(entry, ScenarioDelta) else None
+
+    def overrides(self, name):
+        entry = self._entries.get(name)
+        return entry.overrides if isinstance(entry, ScenarioDelta) else None
+
+    def children(self, name):
+        return [child for child, entry in self._entries.items()
+                if isinstance(entry, ScenarioDelta) and entry.parent == name]
+
+    def create_child(self, name, parent):
+        """Crea uno scenario che eredita tutto da `parent` senza differenze."""
+        self._entries[name] = ScenarioDelta(parent, {})
+        self._invalidate(name)
+
+    def _invalidate(self, name):
+        self.version += 1
+        pending = [name]
+        while pending:
+            current = pending.pop()
+            self._resolved.pop(current, None)
+            self._dicts.pop(current, None)
+            pending.extend(self.children(current))
+
+    def _resolve_dict(self, name, seen=None):
+        if name == DEFAULT_PARENT or name not in self._entries:
+            return get_default_scenario()
+        entry = self._entries[name]
+        if not isinstance(entry, ScenarioDelta):
+            return entry.to_dict()
+        if name in self._resolved:
+            return self._resolved[name].to_dict()
+        seen = set() if seen is None else seen
+        if name in seen:
+            # Ereditarietà ciclica: si riparte dallo scenario di default
+            return get_default_scenario()
+        seen.add(name)
+        resolved = apply_scenario_delta(self._resolve_dict(entry.parent, seen), entry.overrides)
+        sync_linked_reagents(resolved)  # Anche con fasi o collegamenti ereditati dal genitore
+        return resolved
+
+    def model(self, name):
+        entry = self._entries[name]
+        if not isinstance(entry, ScenarioDelta):
+            return entry
+        if name not in self._resolved:
+            self._resolved[name] = ScenarioModel.from_dict(self._dict(name), self._names_cache)
+        return self._resolved[name]
+
+    def to_json_dict(self):
+        json_data = {}
+        for name, entry in self._entries.items():
+            if isinstance(entry, ScenarioDelta):
+                json_data[name] = {"parent": entry.parent, **copy.deepcopy(entry.overrides)}
+            else:
+                json_data[name] = entry.to_dict()
+        return json_data
+
+    def totals(self, names):
+        """Restituisce (energy_cost, capex, opex) come array per gli scenari indicati."""
+        models = [self.model(name) for name in names]
+        energy_costs = np.array([m.energy_cost for m in models], dtype=np.float64)
+        # Voci CapEx e OpEx di tutti gli scenari in un unico array: gruppo 2i (CapEx) e 2i+1 (OpEx)
+        line_items = [items for m in models for items in (m.capex, m.opex)]
+        values = np.concatenate([items.values for items in line_items]) if line_items else np.zeros(0)
+        groups = np.repeat(np.arange(len(line_items)), [items.values.size for items in line_items])
+        totals = np.bincount(groups, weights=values, minlength=len(line_items)).reshape(len(models), 2)
+        return energy_costs, totals[:, 0], totals[:, 1]
+
+
+class VersionHistory:
+    """
+    Storico immutabile delle versioni di scenari e case studies.
+
+    Ogni versione è un albero {chiave: hash} delle chiavi di primo livello
+    (capex, opex, technical_kpis, ...); i valori sono salvati una sola volta
+    per contenuto, quindi le sotto-strutture non modificate sono condivise
+    tra le versioni. Per ogni record si conservano al massimo `max_versions`
+    versioni; i contenuti non più referenziati vengono compattati.
+    """
+
+    def __init__(self, max_versions=50):
+        self.max_versions = max_versions
+        self._blobs = {}  # hash -> JSON di un valore di primo livello
+        self._trees = {}  # id versione -> {chiave: hash}
+        self._timelines = {}  # (tipo, nome) -> [id versione]
+        self._cursors = {}  # (tipo, nome) -> indice della versione corrente
+        self._garbage = 0
+
+    def _put(self, value):
+        # Hash su chiavi ordinate: lo stesso contenuto ha lo stesso hash in qualsiasi ordine,
+        # mentre il blob conserva l'ordine originale delle voci per il checkout
+        digest = hashlib.sha1(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+        self._blobs.setdefault(digest, json.dumps(value))
+        return digest
+
+    def commit(self, kind, name, record):
+        """Registra una nuova versione se il record è cambiato; restituisce l'id della versione."""
+        tree = {key: self._put(value) for key, value in record.items()}
+        version_id = hashlib.sha1(json.dumps(tree, sort_keys=True).encode("utf-8")).hexdigest()
+        timeline = self._timelines.setdefault((kind, name), [])
+        cursor = self._cursors.get((kind, name), -1)
+        if timeline and timeline[cursor] == version_id:
+            return version_id
+
+        # Una nuova modifica dopo un undo scarta le versioni di redo
+        self._garbage += len(timeline) - cursor - 1
+        del timeline[cursor + 1:]
+        self._trees[version_id] = tree
+        timeline.append(version_id)
+        if len(timeline) > self.max_versions:
+            self._garbage += len(timeline) - self.max_versions
+            del timeline[:-self.max_versions]
+        self._cursors[(kind, name)] = len(timeline) - 1
+
+        if self._garbage >= self.max_versions:
+            self.compact()
+        return version_id
+
+    def compact(self):
+        """Elimina versioni e contenuti non più raggiungibili da nessuno storico."""
+        live_trees = {version_id for timeline in self._timelines.values() for version_id in timeline}
+        self._trees = {version_id: tree for version_id, tree in self._trees.items() if version_id in live_trees}
+        live_blobs = {digest for tree in self._trees.values() for digest in tree.values()}
+        self._blobs = {digest: payload for digest, payload in self._blobs.items() if digest in live_blobs}
+        self._garbage = 0
+
+    def forget(self, kind, name):
+        self._garbage += len(self._timelines.pop((kind, name), []))
+        self._cursors.pop((kind, name), None)
+
+    def checkout(self, version_id):
+        return {key: json.loads(self._blobs[digest]) for key, digest in self._trees[version_id].items()}
+
+    def versions(self, kind, name):
+        return list(self._timelines.get((kind, name), []))
+
+    def cursor(self, kind, name):
+        return self._cursors.get((kind, name), -1)
+
+    def can_undo(self, kind, name):
+        return self.cursor(kind, name) > 0
+
+    def can_redo(self, kind, name):
+        return self.cursor(kind, name) < len(self._timelines.get((kind, name), [])) - 1
+
+    def undo(self, kind, name):
+        if not self.can_undo(kind, name):
+            return None
+        self._cursors[(kind, name)] -= 1
+        return self.checkout(self._timelines[(kind, name)][self._cursors[(kind, name)]])
+
+    def redo(self, kind, name):
+        if not self.can_redo(kind, name):
+            return None
+        self._cursors[(kind, name)] += 1
+        return self.checkout(self._timelines[(kind, name)][self._cursors[(kind, name)]])
+
+    def diff(self, version_a, version_b):
+        """Elenca le differenze tra due versioni come righe Path/Before/After."""
+        tree_a, tree_b = self._trees[version_a], self._trees[version_b]
+        rows = []
+        for key in list(tree_a) + [key for key in tree_b if key not in tree_a]:
+            if tree_a.get(key) == tree_b.get(key):
+                continue  # Stesso contenuto: nessun confronto necessario
+            before = json.loads(self._blobs[tree_a[key]]) if key in tree_a else None
+            after = json.loads(self._blobs[tree_b[key]]) if key in tree_b else None
+            _diff_values(key, before, after, rows)
+        return rows
+
+    def stats(self):
+        return {
+            "versions": len(self._trees),
+            "stored_objects": len(self._blobs),
+            "stored_bytes": sum(len(payload) for payload in self._blobs.values())
+        }
+
+
+def _diff_values(path, before, after, rows):
+    if isinstance(before, dict) and isinstance(after, dict):
+        for key in list(before) + [key for key in after if key not in before]:
+            if before.get(key) != after.get(key):
+                _diff_values(f"{path}/{key}", before.get(key), after.get(key), rows)
+    else:
+        rows.append({"Path": path, "Before": json.dumps(before), "After": json.dumps(after)})
+
+
+def widget_key_prefix(kind, name):
+    # repr() delimita il nome: "a" non è un prefisso di "a_b" né di "default"
+    return f"{kind}:{name!r}:"
+
+
+def widget_key(kind, name, *parts):
+    """Chiave di un widget legato a uno scenario ("scenario") o a un case study ("case_study")."""
+    return widget_key_prefix(kind, name) + "_".join(str(part) for part in parts)
+
+
+def reset_widget_state(kind, name, *parts):
+    """
+    Elimina lo stato dei widget legati a uno scenario o case study (o solo a
+    quelli con le parti iniziali indicate), così dopo un undo/redo i widget
+    mostrano i valori ripristinati.
+    """
+    prefix = widget_key(kind, name, *parts)
+    for key in list(st.session_state.keys()):
+        if isinstance(key, str) and key.startswith(prefix):
+            del st.session_state[key]
+
+
+# --- Esecuzione in background delle analisi lunghe ---
+class JobCancelled(Exception):
+    pass
+
+
+@dataclass
+class Job:
+    job_id: str
+    label: str
+    status: str = "queued"  # queued, running, done, failed, cancelled
+    progress: float = 0.0
+    result: object = None
+    error: str = ""
+    cancel_requested: bool = False
+    submitted_at: float = 0.0
+    finished_at: float = 0.0
+
+
+def result_nbytes(result):
+    """Memoria approssimativa occupata dal risultato di un job (array numpy e contenitori)."""
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    if isinstance(result, dict):
+        return sum(result_nbytes(value) for value in result.values())
+    if isinstance(result, (list, tuple)):
+        return sum(result_nbytes(value) for value in result)
+    return 64
+
+
+class JobRunner:
+    """
+    Coda di job eseguiti da un pool di thread, condivisa tra tutte le sessioni.
+    I job sono identificati dall'hash dei loro input: due richieste identiche
+    condividono la stessa esecuzione e lo stesso risultato.
+    """
+
+    def __init__(self, max_workers=2, max_result_bytes=64 << 20, max_age=3600):
+        self.max_result_bytes = max_result_bytes  # Memoria complessiva dei risultati conservati
+        self.max_age = max_age  # Secondi dopo la fine oltre i quali un job viene dimenticato
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="amelie-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def job_key(kind, params):
+        payload = json.dumps([kind, params], sort_keys=True, default=str)
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def submit(self, kind, label, fn, params):
+        job_id = self.job_key(kind, params)
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.status not in ("failed", "cancelled"):
+                return job
+            job = Job(job_id, label, submitted_at=time.time())
+            self._jobs[job_id] = job
+            self._evict()
+        self._executor.submit(self._run, job, fn, params)
+        return job
+
+    def _evict(self):
+        # Dal più vecchio: scadono i job finiti da più di max_age, poi si libera memoria fino al limite
+        now = time.time()
+        finished = sorted((job for job in self._jobs.values() if job.status in ("done", "failed", "cancelled")),
+                          key=lambda job: job.finished_at)
+        retained_bytes = sum(result_nbytes(job.result) for job in finished)
+        for job in finished:
+            if now - job.finished_at <= self.max_age and retained_bytes <= self.max_result_bytes:
+                break
+            retained_bytes -= result_nbytes(job.result)
+            del self._jobs[job.job_id]
+
+    def _run(self, job, fn, params):
+        if job.cancel_requested:
+            self._finish(job, "cancelled")
+            return
+        job.status = "running"
+
+        def report_progress(fraction):
+            # Punto di cancellazione cooperativa per il job
+            if job.cancel_requested:
+                raise JobCancelled()
+            job.progress = min(max(float(fraction), 0.0), 1.0)
+
+        try:
+            result = fn(params, report_progress)
+        except JobCancelled:
+            self._finish(job, "cancelled")
+        except Exception as e:
+            self._finish(job, "failed", error=str(e))
+        else:
+            self._finish(job, "done", result=result)
+
+    def _finish(self, job, status, result=None, error=""):
+        # Stato finale e finished_at cambiano insieme sotto il lock: _evict non vede mai
+        # un job concluso con finished_at ancora a zero
+        with self._lock:
+            job.result = result
+            job.error = error
+            if status == "done":
+                job.progress = 1.0
+            job.finished_at = time.time()
+            job.status = status
+            self._evict()
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def find(self, kind, params):
+        return self._jobs.get(self.job_key(kind, params))
+
+    def recent(self, limit=10):
+        """Ultimi job inviati, dal più recente."""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return sorted(jobs, key=lambda job: job.submitted_at, reverse=True)[:limit]
+
+    def cancel(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is not None and job.status in ("queued", "running"):
+            job.cancel_requested = True
+
+
+@st.cache_resource
+def get_job_runner():
+    return JobRunner()
+
+
+MONTE_CARLO_PERCENTILES = [5, 50, 95]
+MONTE_CARLO_BINS = 50
+
+
+def run_cost_monte_carlo(params, report_progress):
+    """
+    Campiona ogni voce CapEx/OpEx con una variazione uniforme di ±uncertainty%
+    e restituisce le distribuzioni dei totali.
+    """
+    rng = np.random.default_rng(params["seed"])
+    capex = np.asarray(params["capex"], dtype=np.float64)
+    opex = np.asarray(params["opex"], dtype=np.float64)
+    samples = int(params["samples"])
+    spread = params["uncertainty"] / 100
+    chunk_size = max(1, samples // 20)
+
+    capex_totals = np.empty(samples)
+    opex_totals = np.empty(samples)
+    for start in range(0, samples, chunk_size):
+        stop = min(start + chunk_size, samples)
+        capex_totals[start:stop] = rng.uniform(1 - spread, 1 + spread, (stop - start, capex.size)) @ capex
+        opex_totals[start:stop] = rng.uniform(1 - spread, 1 + spread, (stop - start, opex.size)) @ opex
+        report_progress(stop / samples)
+    # Il runner conserva solo percentili e istogrammi, non i campioni
+    summary = {}
+    for name, totals in (("capex", capex_totals), ("opex", opex_totals)):
+        counts, edges = np.histogram(totals, bins=MONTE_CARLO_BINS)
+        summary[name] = {"percentiles": np.percentile(totals, MONTE_CARLO_PERCENTILES), "counts": counts,
+                         "edges": edges}
+    return summary
+
+
+JOB_POLL_SECONDS = 1.0  # Intervallo di aggiornamento dei pannelli mentre un job è in corso
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def _poll_job_status(job_id):
+    job = get_job_runner().get(job_id)
+    if job is None or job.status not in ("queued", "running"):
+        # Job concluso: si riesegue l'intera pagina per mostrarne il risultato
+        st.rerun()
+    st.progress(job.progress, text=f"{job.label}: {job.status} ({job.progress:.0%})")
+    if st.button("Cancel", key=f"cancel_job_{job.job_id}"):
+        get_job_runner().cancel(job.job_id)
+
+
+def show_job_status(job):
+    """Mostra stato e avanzamento di un job; restituisce True se il risultato è pronto."""
+    if job.status in ("queued", "running"):
+        _poll_job_status(job.job_id)
+        return False
+    if job.status == "failed":
+        st.error(f"{job.label} failed: {job.error}")
+    elif job.status == "cancelled":
+        st.warning(f"{job.label} was cancelled.")
+    return job.status == "done"
+
+
+def show_recent_jobs():
+    """Elenco degli ultimi job; si aggiorna da solo finché almeno uno è in corso."""
+    polling = any(job.status in ("queued", "running") for job in get_job_runner().recent())
+
+    def job_list():
+        recent_jobs = get_job_runner().recent()
+        if polling and not any(job.status in ("queued", "running") for job in recent_jobs):
+            st.rerun()  # Nessun job attivo: la riesecuzione completa ferma l'aggiornamento periodico
+        if not recent_jobs:
+            st.write("No jobs.")
+        for job in recent_jobs:
+            st.caption(f"{job.label}: {job.status} ({job.progress:.0%})")
+
+    st.fragment(job_list, run_every=JOB_POLL_SECONDS if polling else None)()
+
+
+# --- Corpus della letteratura in formato colonnare ---
+# Una versione del corpus è una cartella di array .npy letti in memory mapping:
+# per ogni gruppo di voci (capex, opex, ...) offsets/names/values in formato
+# CSR, più colonne per case study (energy_cost, totali, efficienza, ...).
+# Benchmarking legge da qui senza deserializzare ogni case study.
+CORPUS_ITEM_GROUPS = ("capex", "opex", "energy_consumption", "composition", "recovered_masses")
+CORPUS_FORMAT = 2  # v2: colonne currency e cost_year
+CORPUS_KEEP_VERSIONS = 2  # Versione corrente e precedente, per le sessioni che non hanno ancora ricaricato
+
+
+def _ragged_columns(rows, strings):
+    """Converte una lista di dict nome->valore in (offsets, id dei nomi, valori)."""
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    name_ids = []
+    values = []
+    for row_index, row in enumerate(rows):
+        for name, value in row.items():
+            name_ids.append(strings.setdefault(name, len(strings)))
+            values.append(value)
+        offsets[row_index + 1] = len(values)
+    return offsets, np.array(name_ids, dtype=np.int32), np.array(values, dtype=np.float64)
+
+
+def _row_sums(offsets, values):
+    rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    return np.bincount(rows, weights=values, minlength=len(offsets) - 1)
+
+
+def write_literature_corpus(case_studies, directory):
+    """Scrive i case studies come colonne tipizzate nella cartella `directory`."""
+    records = [migrate_record(copy.deepcopy(data), get_default_case_study()) for data in case_studies.values()]
+    strings = {}
+    columns = {}
+
+    for group in CORPUS_ITEM_GROUPS:
+        if group in ("composition", "recovered_masses"):
+            rows = [record["technical_kpis"].get(group, {}) for record in records]
+        else:
+            rows = [record[group] for record in records]
+        columns[f"{group}_offsets"], columns[f"{group}_names"], columns[f"{group}_values"] = \
+            _ragged_columns(rows, strings)
+
+    # Fasi: un livello per le fasi di ogni case study e uno per masse/liquidi di ogni fase
+    phase_rows = [dict.fromkeys(record["technical_kpis"]["phases"], 0.0) for record in records]
+    columns["phases_offsets"], columns["phases_names"], _ = _ragged_columns(phase_rows, strings)
+    all_phases = [phase for record in records for phase in record["technical_kpis"]["phases"].values()]
+    for group in ("masses", "liquids"):
+        columns[f"phase_{group}_offsets"], columns[f"phase_{group}_names"], columns[f"phase_{group}_values"] = \
+            _ragged_columns([phase[group] for phase in all_phases], strings)
+
+    columns["energy_cost"] = np.array([record["energy_cost"] for record in records], dtype=np.float64)
+    columns["currency"] = np.array([strings.setdefault(record["currency"], len(strings)) for record in records],
+                                   dtype=np.int32)
+    columns["cost_year"] = np.array([record["cost_year"] for record in records], dtype=np.int32)
+    columns["efficiency"] = np.array(
+        [_to_float(record["technical_kpis"].get("efficiency", 0.0)) for record in records], dtype=np.float64
+    )
+    columns["capex_total"] = _row_sums(columns["capex_offsets"], columns["capex_values"])
+    columns["opex_total"] = _row_sums(columns["opex_offsets"], columns["opex_values"])
+    columns["energy_kwh"] = _row_sums(columns["energy_consumption_offsets"], columns["energy_consumption_values"])
+    phase_mass = _row_sums(columns["phase_masses_offsets"], columns["phase_masses_values"])
+    phase_volume = _row_sums(columns["phase_liquids_offsets"], columns["phase_liquids_values"])
+    phase_owner = np.repeat(np.arange(len(records)), np.diff(columns["phases_offsets"]))
+    columns["total_mass"] = np.bincount(phase_owner, weights=phase_mass, minlength=len(records))
+    columns["total_volume"] = np.bincount(phase_owner, weights=phase_volume, minlength=len(records))
+
+    os.makedirs(directory, exist_ok=True)
+    for column_name, values in columns.items():
+        np.save(os.path.join(directory, f"{column_name}.npy"), values)
+    with open(os.path.join(directory, "strings.json"), "w") as file:
+        json.dump({"case_studies": list(case_studies.keys()), "strings": list(strings)}, file)
+
+
+class LiteratureCorpus:
+    """Accesso in sola lettura, tramite memory mapping, a una versione del corpus."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "strings.json"), "r") as file:
+            strings = json.load(file)
+        self.names = strings["case_studies"]
+        self.strings = strings["strings"]
+        self._index = {name: row for row, name in enumerate(self.names)}
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def column(self, column_name):
+        if column_name not in self._columns:
+            self._columns[column_name] = np.load(
+                os.path.join(self.directory, f"{column_name}.npy"), mmap_mode="r"
+            )
+        return self._columns[column_name]
+
+    def index(self, name):
+        return self._index[name]
+
+    def _slice(self, group, row):
+        offsets = self.column(f"{group}_offsets")
+        start, stop = int(offsets[row]), int(offsets[row + 1])
+        return start, stop
+
+    def line_items(self, group, row):
+        start, stop = self._slice(group, row)
+        name_ids = self.column(f"{group}_names")[start:stop]
+        return LineItems(tuple(self.strings[i] for i in name_ids), self.column(f"{group}_values")[start:stop])
+
+    def technical_kpis(self, row):
+        phases = {}
+        start, stop = self._slice("phases", row)
+        for phase_row in range(start, stop):
+            phase_name = self.strings[self.column("phases_names")[phase_row]]
+            phases[phase_name] = {
+                "masses": self.line_items("phase_masses", phase_row).to_dict(),
+                "liquids": self.line_items("phase_liquids", phase_row).to_dict()
+            }
+        return {
+            "composition": self.line_items("composition", row).to_dict(),
+            "recovered_masses": self.line_items("recovered_masses", row).to_dict(),
+            "efficiency": float(self.column("efficiency")[row]),
+            "phases": phases
+        }
+
+    def model(self, row):
+        """ScenarioModel di un case study: i valori delle voci sono viste sul file mappato."""
+        return ScenarioModel(
+            capex=self.line_items("capex", row),
+            opex=self.line_items("opex", row),
+            energy_consumption=self.line_items("energy_consumption", row),
+            energy_cost=float(self.column("energy_cost")[row]),
+            assumptions=[],
+            technical_kpis=self.technical_kpis(row),
+            extra={}
+        )
+
+    def dense(self, group):
+        """Matrice densa case study x nome voce per un gruppo di voci."""
+        offsets = self.column(f"{group}_offsets")
+        used_names, columns = np.unique(np.asarray(self.column(f"{group}_names")), return_inverse=True)
+        rows = np.repeat(np.arange(len(self)), np.diff(offsets))
+        matrix = np.zeros((len(self), used_names.size))
+        np.add.at(matrix, (rows, columns), self.column(f"{group}_values"))
+        return matrix, [self.strings[i] for i in used_names]
+
+    def phase_dense(self, group):
+        """Matrice case study x nome per masse o liquidi ("masses"/"liquids"), sommati su tutte le fasi."""
+        phase_owner = np.repeat(np.arange(len(self)), np.diff(self.column("phases_offsets")))
+        offsets = self.column(f"phase_{group}_offsets")
+        used_names, columns = np.unique(np.asarray(self.column(f"phase_{group}_names")), return_inverse=True)
+        rows = phase_owner[np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))]
+        matrix = np.zeros((len(self), used_names.size))
+        np.add.at(matrix, (rows, columns), self.column(f"phase_{group}_values"))
+        return matrix, [self.strings[i] for i in used_names]
+
+    def filter(self, max_capex=None, max_opex=None, min_efficiency=None, capex_totals=None, opex_totals=None):
+        """
+        Restituisce gli indici dei case studies che rispettano i filtri (scansione
+        vettoriale). capex_totals/opex_totals sostituiscono i totali nominali,
+        ad es. con quelli normalizzati in EUR.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if max_capex is not None:
+            mask &= (self.column("capex_total") if capex_totals is None else capex_totals) <= max_capex
+        if max_opex is not None:
+            mask &= (self.column("opex_total") if opex_totals is None else opex_totals) <= max_opex
+        if min_efficiency is not None:
+            mask &= self.column("efficiency") >= min_efficiency
+        return np.flatnonzero(mask)
+
+
+class CaseStudyIndex:
+    """
+    Indice di similarità tra case studies: ogni case study è un vettore con la
+    composizione della black mass, le quote delle voci CapEx/OpEx sul totale
+    e il rapporto S/L complessivo. Le query sono una ricerca esaustiva in NumPy.
+    """
+
+    FEATURE_GROUPS = ("composition", "capex", "opex")
+
+    def __init__(self, corpus):
+        self.corpus = corpus
+        self._columns = {}
+        blocks = []
+        for group in self.FEATURE_GROUPS:
+            matrix, names = corpus.dense(group)
+            self._columns[group] = {name: column for column, name in enumerate(names)}
+            blocks.append(self._normalize(group, matrix))
+        sl_ratios = self._sl_ratio(corpus.column("total_mass"), corpus.column("total_volume"))
+        self._sl_scale = float(sl_ratios.max()) if sl_ratios.size and sl_ratios.max() > 0 else 1.0
+        blocks.append((sl_ratios / self._sl_scale)[:, None])
+        self.features = np.hstack(blocks).astype(np.float32)
+
+    @staticmethod
+    def _normalize(group, matrix, totals=None):
+        if group == "composition":
+            return matrix / 100
+        if totals is None:
+            totals = matrix.sum(axis=1, keepdims=True)
+        return np.divide(matrix, totals, out=np.zeros_like(matrix), where=totals > 0)
+
+    @staticmethod
+    def _sl_ratio(mass, volume):
+        mass = np.asarray(mass, dtype=np.float64)
+        volume = np.asarray(volume, dtype=np.float64)
+        return np.divide(mass, volume, out=np.zeros_like(mass), where=volume > 0)
+
+    def vectorize(self, record):
+        """Proietta uno scenario (o case study) nello spazio delle feature dell'indice."""
+        blocks = []
+        for group in self.FEATURE_GROUPS:
+            if group == "composition":
+                values = record.get("technical_kpis", {}).get(group, {})
+            else:
+                values = record.get(group, {})
+            row = np.zeros((1, len(self._columns[group])))
+            for name, value in values.items():
+                if name in self._columns[group]:
+                    row[0, self._columns[group][name]] = value
+            # Le quote sono sul totale del record, voci assenti dal corpus comprese,
+            # come per le righe del corpus
+            totals = np.array([[sum(_to_float(value) for value in values.values())]])
+            blocks.append(self._normalize(group, row, totals)[0])
+        phases = record.get("technical_kpis", {}).get("phases", {}).values()
+        total_mass = sum(phase_totals(phase)[0] for phase in phases)
+        total_volume = sum(phase_totals(phase)[1] for phase in phases)
+        sl_ratio = total_mass / total_volume if total_volume > 0 else 0.0
+        blocks.append(np.array([sl_ratio / self._sl_scale]))
+        return np.concatenate(blocks).astype(np.float32)
+
+    def query(self, record, k=5, rows=None):
+        """Restituisce (righe del corpus, distanze) dei k case studies più simili."""
+        rows = np.arange(len(self.corpus)) if rows is None else np.asarray(rows)
+        if rows.size == 0:
+            return rows, np.array([])
+        differences = self.features[rows] - self.vectorize(record)
+        distances = np.sqrt(np.einsum("ij,ij->i", differences, differences))
+        k = min(k, rows.size)
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest])]
+        return rows[nearest], distances[nearest]
+
+
+@st.cache_resource(max_entries=4)
+def get_case_study_index(version):
+    return CaseStudyIndex(open_literature_corpus(version))
+
+
+class ProcessClusters:
+    """
+    Famiglie di processi della letteratura: k-means sulle quote delle voci
+    CapEx/OpEx e sull'intensità energetica (kWh per kg di black mass).
+    Assegnazioni e centroidi sono calcolati una volta per versione del corpus.
+    """
+
+    def __init__(self, corpus, n_clusters, iterations=100, seed=0):
+        self.corpus = corpus
+        self.groups = {}
+        blocks = []
+        for group in ("capex", "opex", "energy_consumption", "composition", "recovered_masses"):
+            self.groups[group] = corpus.dense(group)
+        for group in ("capex", "opex"):
+            matrix = self.groups[group][0]
+            totals = matrix.sum(axis=1, keepdims=True)
+            blocks.append(np.divide(matrix, totals, out=np.zeros_like(matrix), where=totals > 0))
+        energy_kwh = np.asarray(corpus.column("energy_kwh"), dtype=np.float64)
+        total_mass = np.asarray(corpus.column("total_mass"), dtype=np.float64)
+        intensity = np.log1p(np.divide(energy_kwh, total_mass, out=np.zeros_like(energy_kwh), where=total_mass > 0))
+        blocks.append((intensity / intensity.max() if intensity.size and intensity.max() > 0 else intensity)[:, None])
+        self.features = np.hstack(blocks)
+        self.labels, self.centers = self._kmeans(self.features, min(n_clusters, len(corpus)), iterations, seed)
+        self._cluster_labels = None
+
+    @staticmethod
+    def _kmeans(features, n_clusters, iterations, seed):
+        if n_clusters == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, features.shape[1]))
+        rng = np.random.default_rng(seed)
+        # Inizializzazione k-means++
+        centers = [features[rng.integers(len(features))]]
+        closest = ((features - centers[0]) ** 2).sum(axis=1)
+        for _ in range(1, n_clusters):
+            probabilities = closest / closest.sum() if closest.sum() > 0 else None
+            centers.append(features[rng.choice(len(features), p=probabilities)])
+            closest = np.minimum(closest, ((features - centers[-1]) ** 2).sum(axis=1))
+        centers = np.array(centers)
+        labels = np.full(len(features), -1)
+        squared_norms = (features ** 2).sum(axis=1)[:, None]
+        for _ in range(iterations):
+            distances = squared_norms - 2 * features @ centers.T + (centers ** 2).sum(axis=1)[None, :]
+            new_labels = distances.argmin(axis=1)
+            if np.array_equal(new_labels, labels):
+                break
+            labels = new_labels
+            counts = np.bincount(labels, minlength=n_clusters)
+            sums = np.zeros_like(centers)
+            np.add.at(sums, labels, features)
+            # I cluster rimasti vuoti conservano il centro precedente
+            centers = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+        return labels, centers
+
+    def __len__(self):
+        return len(self.centers)
+
+    def members(self, cluster):
+        return np.flatnonzero(self.labels == cluster)
+
+    def sizes(self):
+        return np.bincount(self.labels, minlength=len(self))
+
+    def label(self, cluster):
+        """Nome descrittivo del cluster: voci di CapEx e OpEx con la quota media più alta."""
+        if self._cluster_labels is None:
+            # Somme per cluster di tutte le voci in un solo passaggio sul corpus
+            sizes = self.sizes()
+            top_items = []
+            for group in ("capex", "opex"):
+                matrix, names = self.groups[group]
+                if not names:
+                    top_items.append([None] * len(self))
+                    continue
+                sums = np.zeros((len(self), len(names)))
+                np.add.at(sums, self.labels, matrix)
+                top_items.append([names[int(column)] for column in sums.argmax(axis=1)])
+            self._cluster_labels = [
+                f"Cluster {index + 1} ({size} case studies: "
+                f"{' / '.join(item for item in items if item and size) or 'no cost items'})"
+                for index, (size, items) in enumerate(zip(sizes, zip(*top_items)))
+            ]
+        return self._cluster_labels[cluster]
+
+    def centroid_model(self, cluster, capex_factors=None, opex_factors=None):
+        """
+        ScenarioModel con i valori medi dei case studies del cluster; i fattori
+        opzionali convertono i costi di ogni case study prima della media.
+        """
+        rows = self.members(cluster)
+        capex_factors = np.ones(len(self.corpus)) if capex_factors is None else capex_factors
+        opex_factors = np.ones(len(self.corpus)) if opex_factors is None else opex_factors
+
+        def mean_items(group, factors=None):
+            matrix, names = self.groups[group]
+            values = matrix[rows] if factors is None else matrix[rows] * factors[rows, None]
+            return LineItems(tuple(names), values.mean(axis=0) if rows.size else np.zeros(len(names)))
+
+        energy_costs = np.asarray(self.corpus.column("energy_cost"))[rows] * opex_factors[rows]
+        return ScenarioModel(
+            capex=mean_items("capex", capex_factors),
+            opex=mean_items("opex", opex_factors),
+            energy_consumption=mean_items("energy_consumption"),
+            energy_cost=float(energy_costs.mean()) if rows.size else 0.0,
+            assumptions=[],
+            technical_kpis={
+                "composition": mean_items("composition").to_dict(),
+                "recovered_masses": mean_items("recovered_masses").to_dict(),
+                "efficiency": float(np.asarray(self.corpus.column("efficiency"))[rows].mean()) if rows.size else 0.0,
+                "phases": {}
+            },
+            extra={}
+        )
+
+
+@st.cache_resource(max_entries=8)
+def get_process_clusters(version, n_clusters):
+    return ProcessClusters(open_literature_corpus(version), n_clusters)
+
+
+class SearchIndex:
+    """
+    Indice invertito per scenari o case studies: nomi, testo delle assumptions,
+    materiali, macchine, voci CapEx/OpEx e liquidi delle fasi. Supporta la
+    ricerca per prefisso e i filtri per faccette (composizione, voci usate).
+
+    Sintassi della query: parole libere (tutte richieste, anche come prefisso),
+    `Co>=10` per la composizione (>=, <=, >, <, =) e `uses:"Malic Acid"` per
+    le voci usate (anche come prefisso).
+    """
+
+    FACET_PATTERN = re.compile(r"^(\w+)\s*(>=|<=|>|<|=)\s*(\d+(?:\.\d+)?)%?$")
+
+    def __init__(self, records):
+        self.names = list(records)
+        self._postings = {}
+        self._item_postings = {}
+        self._composition = {}
+        for doc, (name, record) in enumerate(records.items()):
+            technical_kpis = record.get("technical_kpis", {})
+            text = [name] + list(record.get("assumptions", []))
+            items = list(record.get("capex", {})) + list(record.get("opex", {})) \
+                + list(record.get("energy_consumption", {}))
+            for phase in technical_kpis.get("phases", {}).values():
+                items += list(phase.get("masses", {})) + list(phase.get("liquids", {}))
+            materials = technical_kpis.get("composition", {})
+
+            for token in self._tokens(" ".join(text + items + list(materials))):
+                self._postings.setdefault(token, set()).add(doc)
+            for item in items:
+                self._item_postings.setdefault(item.lower(), set()).add(doc)
+            for material, percentage in materials.items():
+                column = self._composition.setdefault(material.lower(), np.full(len(self.names), np.nan))
+                column[doc] = percentage
+        self._sorted_tokens = sorted(self._postings)
+        self._sorted_items = sorted(self._item_postings)
+
+    @staticmethod
+    def _tokens(text):
+        return set(re.findall(r"\w+", text.lower()))
+
+    @staticmethod
+    def _prefix_match(sorted_keys, postings, prefix):
+        docs = set()
+        start = bisect.bisect_left(sorted_keys, prefix)
+        for key in sorted_keys[start:]:
+            if not key.startswith(prefix):
+                break
+            docs |= postings[key]
+        return docs
+
+    def materials(self):
+        return sorted(self._composition)
+
+    def items(self):
+        return list(self._sorted_items)
+
+    def search(self, query="", composition=(), uses=()):
+        """
+        Restituisce i nomi che soddisfano query, filtri di composizione
+        [(materiale, operatore, valore)] e voci usate, nell'ordine originale.
+        """
+        composition = list(composition)
+        uses = [item.lower() for item in uses]
+        terms = []
+        try:
+            parts = shlex.split(query)
+        except ValueError:
+            parts = query.split()
+        for part in parts:
+            facet = self.FACET_PATTERN.match(part)
+            if facet:
+                composition.append((facet.group(1), facet.group(2), float(facet.group(3))))
+            elif part.lower().startswith("uses:"):
+                uses.append(part[5:].lower())
+            else:
+                terms.extend(self._tokens(part))
+
+        matches = np.ones(len(self.names), dtype=bool)
+        for term in terms:
+            docs = self._prefix_match(self._sorted_tokens, self._postings, term)
+            term_mask = np.zeros(len(self.names), dtype=bool)
+            term_mask[list(docs)] = True
+            matches &= term_mask
+        for item in uses:
+            docs = self._prefix_match(self._sorted_items, self._item_postings, item)
+            item_mask = np.zeros(len(self.names), dtype=bool)
+            item_mask[list(docs)] = True
+            matches &= item_mask
+        comparisons = {">=": np.greater_equal, "<=": np.less_equal, ">": np.greater, "<": np.less, "=": np.equal}
+        for material, operator, value in composition:
+            column = self._composition.get(material.lower())
+            if column is None:
+                matches[:] = False
+                continue
+            with np.errstate(invalid="ignore"):
+                matches &= comparisons[operator](column, value)
+        return [self.names[doc] for doc in np.flatnonzero(matches)]
+
+
+def get_search_index(kind):
+    """Indice di ricerca per "scenario" o "case_study", ricostruito solo quando cambiano i dati."""
+    if kind == "scenario":
+        version = st.session_state.amelie_scenarios.version
+        records = st.session_state.amelie_scenarios
+    else:
+        version = literature_data_version()
+        records = st.session_state.case_studies
+    search_indexes = st.session_state.setdefault("search_indexes", {})
+    if kind not in search_indexes or search_indexes[kind][0] != version:
+        search_indexes[kind] = (version, SearchIndex({name: records[name] for name in records}))
+    return search_indexes[kind][1]
+
+
+class NearDuplicateIndex:
+    """
+    Rilevamento dei case studies inseriti più volte: firma MinHash sugli
+    shingle di parole delle assumptions e sui valori quantizzati di
+    CapEx/OpEx/composizione, con LSH a bande per trovare le coppie candidate
+    senza confrontare tutte le coppie.
+    """
+
+    NUM_PERMUTATIONS = 128
+    BANDS = 32
+
+    def __init__(self, records, seed=0):
+        self.names = list(records)
+        rng = np.random.default_rng(seed)
+        self._seeds = rng.integers(0, np.iinfo(np.uint64).max, self.NUM_PERMUTATIONS, dtype=np.uint64)
+        self.signatures = np.array([self._signature(self.fingerprint(records[name])) for name in self.names],
+                                   dtype=np.uint64).reshape(len(self.names), self.NUM_PERMUTATIONS)
+        self._candidates = self._band_candidates()
+
+    @staticmethod
+    def fingerprint(record):
+        """Insieme di token che descrive il case study indipendentemente dal nome."""
+        tokens = set()
+        words = re.findall(r"\w+", " ".join(record.get("assumptions", [])).lower())
+        tokens.update("text:" + " ".join(words[i:i + 3]) for i in range(max(len(words) - 2, 0)))
+        tokens.update("word:" + word for word in words if len(words) < 3)
+        # Costi su scala logaritmica (passo ~10%), composizione al punto percentuale
+        for group in ("capex", "opex"):
+            for item, value in record.get(group, {}).items():
+                if value > 0:
+                    tokens.add(f"{group}:{item.lower()}:{round(np.log(value) / np.log(1.1))}")
+        for material, percentage in record.get("technical_kpis", {}).get("composition", {}).items():
+            if percentage > 0:
+                tokens.add(f"composition:{material.lower()}:{round(percentage)}")
+        return tokens
+
+    @staticmethod
+    def _mix(values):
+        """Finalizzatore splitmix64: una permutazione pseudo-casuale degli interi a 64 bit."""
+        values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return values ^ (values >> np.uint64(31))
+
+    def _signature(self, tokens):
+        if not tokens:
+            return np.full(self.NUM_PERMUTATIONS, np.iinfo(np.uint64).max, dtype=np.uint64)
+        hashes = np.array([int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+                           for token in tokens], dtype=np.uint64)
+        return self._mix(self._seeds[:, None] ^ hashes[None, :]).min(axis=1)
+
+    def _band_candidates(self):
+        rows_per_band = self.NUM_PERMUTATIONS // self.BANDS
+        empty = (self.signatures == np.iinfo(np.uint64).max).all(axis=1)
+        candidates = set()
+        for band in range(self.BANDS):
+            buckets = {}
+            band_values = self.signatures[:, band * rows_per_band:(band + 1) * rows_per_band]
+            for row in np.flatnonzero(~empty):
+                buckets.setdefault(band_values[row].tobytes(), []).append(row)
+            for rows in buckets.values():
+                candidates.update((rows[i], rows[j]) for i in range(len(rows)) for j in range(i + 1, len(rows)))
+        return sorted(candidates)
+
+    def similarity(self, first, second):
+        """Stima della similarità di Jaccard tra due righe dell'indice."""
+        return float(np.mean(self.signatures[first] == self.signatures[second]))
+
+    def duplicates(self, threshold=0.7):
+        """Coppie (nome, nome, similarità) oltre la soglia, dalla più simile."""
+        if not self._candidates:
+            return []
+        pairs = np.array(self._candidates)
+        similarities = (self.signatures[pairs[:, 0]] == self.signatures[pairs[:, 1]]).mean(axis=1)
+        order = np.argsort(-similarities, kind="stable")
+        return [(self.names[pairs[i, 0]], self.names[pairs[i, 1]], float(similarities[i]))
+                for i in order if similarities[i] >= threshold]
+
+
+def get_duplicate_index():
+    """Indice dei quasi-duplicati della letteratura, ricostruito solo quando cambiano i dati."""
+    version = literature_data_version()
+    cached = st.session_state.get("duplicate_indexes")
+    if cached is None or cached[0] != version:
+        case_studies = st.session_state.case_studies
+        st.session_state.duplicate_indexes = (version, NearDuplicateIndex(
+            {name: case_studies[name] for name in case_studies}
+        ))
+    return st.session_state.duplicate_indexes[1]
+
+
+def literature_data_version():
+    """Versione dei dati di letteratura persistiti, ricavata da dimensione e data dei file."""
+    signature = [f"corpus-format:{CORPUS_FORMAT}"]
+    for path in (case_studies_file, case_studies_file + ".journal", case_studies_file + ".journal.compacting"):
+        if os.path.exists(path):
+            file_stat = os.stat(path)
+            signature.append(f"{path}:{file_stat.st_mtime_ns}:{file_stat.st_size}")
+    return hashlib.sha1("|".join(signature).encode("utf-8")).hexdigest()[:16]
+
+
+@st.cache_resource
+def open_corpus_references():
+    """Corpora aperti in questo processo: le loro cartelle non vengono eliminate."""
+    return weakref.WeakSet()
+
+
+def collect_corpus_versions(corpus_root, keep):
+    """
+    Elimina le versioni del corpus più vecchie delle ultime CORPUS_KEEP_VERSIONS,
+    salvo `keep` e quelle ancora aperte da una sessione di questo processo.
+    """
+    referenced = {os.path.abspath(corpus.directory) for corpus in list(open_corpus_references())}
+    referenced.add(os.path.abspath(os.path.join(corpus_root, keep)))
+    versions = sorted(
+        (os.path.join(corpus_root, name) for name in os.listdir(corpus_root)),
+        key=lambda path: os.stat(path).st_mtime_ns, reverse=True
+    )
+    for path in versions[CORPUS_KEEP_VERSIONS:]:
+        if os.path.abspath(path) not in referenced:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+@st.cache_resource(max_entries=4)
+def open_literature_corpus(version):
+    """
+    Apre la versione del corpus corrispondente ai dati persistiti. `version` cambia
+    con i file; la cartella è identificata dalla chiave di contenuto del journal,
+    quindi i salvataggi senza modifiche riusano la versione già costruita e i
+    case studies vengono caricati solo per costruirne una nuova.
+    """
+    corpus_root = os.path.join(data_dir, "literature_corpus")
+    journal = EditJournal(case_studies_file)
+    content_version = hashlib.sha1(f"{CORPUS_FORMAT}:{journal.content_key()}".encode("utf-8")).hexdigest()[:16]
+    directory = os.path.join(corpus_root, content_version)
+    if not os.path.exists(directory):
+        case_studies = journal.load() if journal.exists() else {}
+        case_studies = case_studies if isinstance(case_studies, dict) else {}
+        temp_directory = tempfile.mkdtemp(dir=os.path.dirname(corpus_root) or ".", prefix=".corpus_")
+        write_literature_corpus(case_studies, temp_directory)
+        os.makedirs(corpus_root, exist_ok=True)
+        try:
+            os.rename(temp_directory, directory)
+        except OSError:
+            shutil.rmtree(temp_directory, ignore_errors=True)  # Costruita nel frattempo da un'altra sessione
+        collect_corpus_versions(corpus_root, content_version)
+    corpus = LiteratureCorpus(directory)
+    open_corpus_references().add(corpus)
+    return corpus
+
+
+# --- Normalizzazione di valuta e anno dei costi ---
+# I costi della letteratura vengono riportati in EUR dell'anno di riferimento:
+#   CapEx  x  CEPCI(anno rif.) / CEPCI(anno)        / cambio(valuta, anno)
+#   OpEx   x  HICP(anno rif.)  / HICP(anno)          / cambio(valuta, anno)
+# Il cambio è espresso in unità di valuta per 1 EUR (media annua). La tabella
+# può essere sostituita da data/cost_indices.json con la stessa struttura.
+cost_indices_file = os.path.join(data_dir, "cost_indices.json")
+DEFAULT_COST_INDICES = {
+    "reference_currency": "EUR",
+    "reference_year": DEFAULT_COST_YEAR,
+    "plant_cost_index": {
+        "2015": 556.8, "2016": 541.7, "2017": 567.5, "2018": 603.1, "2019": 607.5,
+        "2020": 596.2, "2021": 708.0, "2022": 816.0, "2023": 797.9, "2024": 799.1
+    },
+    "price_index": {
+        "2015": 100.0, "2016": 100.2, "2017": 101.8, "2018": 103.6, "2019": 104.8,
+        "2020": 105.1, "2021": 107.8, "2022": 116.8, "2023": 123.0, "2024": 125.9
+    },
+    "exchange_rates": {
+        "EUR": {},
+        "USD": {"2015": 1.110, "2016": 1.107, "2017": 1.130, "2018": 1.181, "2019": 1.120,
+                "2020": 1.142, "2021": 1.183, "2022": 1.053, "2023": 1.081, "2024": 1.082},
+        "GBP": {"2015": 0.726, "2016": 0.819, "2017": 0.877, "2018": 0.885, "2019": 0.878,
+                "2020": 0.890, "2021": 0.860, "2022": 0.853, "2023": 0.870, "2024": 0.847},
+        "CNY": {"2015": 6.973, "2016": 7.352, "2017": 7.629, "2018": 7.808, "2019": 7.735,
+                "2020": 7.875, "2021": 7.628, "2022": 7.079, "2023": 7.660, "2024": 7.787}
     }
+}
+
+
+def load_cost_indices():
+    """Tabella degli indici: file locale se presente, altrimenti i valori predefiniti."""
+    if os.path.exists(cost_indices_file):
+        try:
+            with open(cost_indices_file, "r") as file:
+                return {**DEFAULT_COST_INDICES, **json.load(file)}
+        except (OSError, ValueError) as e:
+            st.warning(f"Could not read {cost_indices_file}, using default cost indices: {e}")
+    return DEFAULT_COST_INDICES
+
+
+class CostNormalizer:
+    """Fattori di conversione vettoriali (valuta, anno) -> valuta e anno di riferimento."""
+
+    def __init__(self, table):
+        self.reference_currency = table["reference_currency"]
+        self.reference_year = int(table["reference_year"])
+        self.currencies = list(table["exchange_rates"])
+        self._plant_cost_index = self._series(table["plant_cost_index"])
+        self._price_index = self._series(table["price_index"])
+        # La valuta di riferimento ha cambio 1 e nessuna serie
+        self._exchange_rates = {currency: self._series(rates) for currency, rates in table["exchange_rates"].items()
+                                if currency != self.reference_currency}
+        # Anni coperti da entrambi gli indici
+        self.first_year = int(max(self._plant_cost_index[0][0], self._price_index[0][0]))
+        self.last_year = int(min(self._plant_cost_index[0][-1], self._price_index[0][-1]))
+
+    @staticmethod
+    def _series(values):
+        """Anni noti e valori di una serie annuale, ordinati per anno."""
+        known_years = np.array(sorted(int(year) for year in values), dtype=np.float64)
+        known_values = np.array([values[str(int(year))] for year in known_years], dtype=np.float64)
+        return known_years, known_values
+
+    @staticmethod
+    def _at(series, years):
+        # Interpolazione lineare tra gli anni noti; fuori tabella vale l'anno estremo (vedi out_of_range)
+        known_years, known_values = series
+        if not known_years.size:
+            return np.full(np.shape(years), np.nan)
+        return np.interp(years, known_years, known_values)
+
+    def _exchange(self, currencies, years):
+        exchange = np.full(years.shape, np.nan)
+        currencies = np.asarray(currencies, dtype=object)
+        for currency in set(currencies.tolist()):
+            rows = currencies == currency
+            if currency == self.reference_currency:
+                exchange[rows] = 1.0
+            elif currency in self._exchange_rates:
+                exchange[rows] = self._at(self._exchange_rates[currency], years[rows])
+        return exchange
+
+    def factors(self, currencies, years):
+        """
+        Fattori (capex, opex) per array paralleli di codici valuta e anni.
+        Le valute assenti dalla tabella danno NaN.
+        """
+        years = np.asarray(years, dtype=np.float64)
+        exchange = self._exchange(currencies, years)
+        capex_factors = self._at(self._plant_cost_index, self.reference_year) / \
+            self._at(self._plant_cost_index, years) / exchange
+        opex_factors = self._at(self._price_index, self.reference_year) / self._at(self._price_index, years) / exchange
+        return capex_factors, opex_factors
+
+    def out_of_range(self, currencies, years):
+        """Righe con un anno fuori dagli indici o dal cambio della propria valuta (convertite all'anno estremo)."""
+        years = np.asarray(years, dtype=np.float64)
+        outside = (years < self.first_year) | (years > self.last_year)
+        currencies = np.asarray(currencies, dtype=object)
+        for currency, (known_years, _) in self._exchange_rates.items():
+            if known_years.size:
+                rows = currencies == currency
+                outside[rows] |= (years[rows] < known_years[0]) | (years[rows] > known_years[-1])
+        return outside
+
+
+@dataclass(slots=True)
+class NormalizedCosts:
+    capex_factors: np.ndarray
+    opex_factors: np.ndarray
+    capex_totals: np.ndarray
+    opex_totals: np.ndarray
+    unknown_currencies: list
+    out_of_range: np.ndarray  # Righe convertite con gli indici dell'anno più vicino in tabella
+
+
+@st.cache_resource(max_entries=4)
+def normalized_literature_costs(version, table_json):
+    """Totali CapEx/OpEx del corpus nella valuta e nell'anno di riferimento, calcolati in un solo passaggio."""
+    corpus = open_literature_corpus(version)
+    normalizer = CostNormalizer(json.loads(table_json))
+    currencies = [corpus.strings[i] for i in np.asarray(corpus.column("currency"))]
+    capex_factors, opex_factors = normalizer.factors(currencies, corpus.column("cost_year"))
+    out_of_range = normalizer.out_of_range(currencies, corpus.column("cost_year"))
+    unknown_currencies = sorted({currency for currency, factor in zip(currencies, capex_factors)
+                                 if np.isnan(factor)})
+    # Le valute sconosciute restano ai valori nominali
+    capex_factors = np.nan_to_num(capex_factors, nan=1.0)
+    opex_factors = np.nan_to_num(opex_factors, nan=1.0)
+    return NormalizedCosts(
+        capex_factors=capex_factors,
+        opex_factors=opex_factors,
+        capex_totals=corpus.column("capex_total") * capex_factors,
+        opex_totals=corpus.column("opex_total") * opex_factors,
+        unknown_currencies=unknown_currencies,
+        out_of_range=out_of_range
+    )
+
+
+def scale_model_costs(model, capex_factor, opex_factor):
+    """Copia di un ScenarioModel con CapEx, OpEx e prezzo dell'energia convertiti."""
+    return ScenarioModel(
+        capex=LineItems(model.capex.names, model.capex.values * capex_factor),
+        opex=LineItems(model.opex.names, model.opex.values * opex_factor),
+        energy_consumption=model.energy_consumption,
+        energy_cost=model.energy_cost * opex_factor,
+        assumptions=model.assumptions,
+        technical_kpis=model.technical_kpis,
+        extra=model.extra
+    )
+
+
+# --- Ricavi dai materiali recuperati ---
+# Lo storico dei prezzi è un CSV locale (colonna "date" AAAA-MM-GG e una colonna
+# per materiale in EUR/kg) convertito in array .npy letti in memory mapping:
+# dates (giorni), prices (date x materiali), materials.json.
+price_history_file = os.path.join(data_dir, "metal_prices.csv")
+
+
+def _parse_price(value, line_number, material):
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"line {line_number}: '{value}' is not a price for {material}")
+
+
+def write_price_history(csv_path, directory):
+    """
+    Converte il CSV dei prezzi in array; i prezzi mancanti riprendono l'ultimo valore noto.
+    Solleva ValueError, con il numero di riga, per righe di lunghezza diversa dall'intestazione,
+    date non valide e prezzi non numerici.
+    """
+    dates = []
+    rows = []
+    with open(csv_path, "r", encoding="utf-8-sig", newline="") as file:
+        reader = csv.reader(file)
+        header = next(reader, [])
+        columns = [column.strip().lower() for column in header]
+        if "date" not in columns:
+            raise ValueError("the header has no 'date' column")
+        date_column = columns.index("date")
+        materials = [column.strip() for i, column in enumerate(header) if i != date_column]
+        for line in reader:
+            if not any(value.strip() for value in line):
+                continue
+            if len(line) != len(header):
+                raise ValueError(f"line {reader.line_num}: {len(line)} values for {len(header)} columns")
+            date = line[date_column].strip()
+            try:
+                dates.append(np.datetime64(date, "D"))
+            except ValueError:
+                raise ValueError(f"line {reader.line_num}: '{date}' is not a date")
+            rows.append([_parse_price(value, reader.line_num, header[i].strip()) if value.strip() else np.nan
+                         for i, value in enumerate(line) if i != date_column])
+
+    dates = np.array(dates, dtype="datetime64[D]")
+    prices = np.array(rows, dtype=np.float64).reshape(len(rows), len(materials))
+    order = np.argsort(dates, kind="stable")
+    dates, prices = dates[order], prices[order]
+    # Forward fill vettoriale: per ogni cella l'indice dell'ultima riga con un valore
+    last_known = np.where(np.isnan(prices), 0, np.arange(len(prices))[:, None])
+    np.maximum.accumulate(last_known, axis=0, out=last_known)
+    prices = np.nan_to_num(prices[last_known, np.arange(len(materials))], nan=0.0)
+
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, "dates.npy"), dates.astype(np.int64))
+    np.save(os.path.join(directory, "prices.npy"), prices)
+    with open(os.path.join(directory, "materials.json"), "w") as file:
+        json.dump(materials, file)
+
+
+class PriceHistory:
+    """Storico dei prezzi in sola lettura; le valutazioni sono prodotti matriciali sulle date."""
+
+    def __init__(self, directory):
+        self.dates = np.load(os.path.join(directory, "dates.npy"), mmap_mode="r")
+        self.prices = np.load(os.path.join(directory, "prices.npy"), mmap_mode="r")
+        with open(os.path.join(directory, "materials.json"), "r") as file:
+            self.materials = json.load(file)
+        self._columns = {material.lower(): column for column, material in enumerate(self.materials)}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def date_range(self):
+        return np.datetime64(int(self.dates[0]), "D"), np.datetime64(int(self.dates[-1]), "D")
+
+    def rows(self, start=None, end=None):
+        """Intervallo di righe [start, end] (date incluse) come slice."""
+        first = 0 if start is None else np.searchsorted(self.dates, np.datetime64(start, "D").astype(np.int64))
+        last = len(self) if end is None else np.searchsorted(
+            self.dates, np.datetime64(end, "D").astype(np.int64), side="right"
+        )
+        return slice(int(first), int(last))
+
+    def mass_matrix(self, recovered_masses):
+        """
+        Matrice materiali x record delle masse recuperate (kg per batch).
+        Restituisce anche i materiali senza prezzo, che valgono 0.
+        """
+        matrix = np.zeros((len(self.materials), len(recovered_masses)))
+        unpriced = set()
+        for record, masses in enumerate(recovered_masses):
+            for material, mass in masses.items():
+                column = self._columns.get(material.lower())
+                if column is None:
+                    unpriced.add(material)
+                else:
+                    matrix[column, record] += mass
+        return matrix, sorted(unpriced)
+
+    def revenue(self, recovered_masses, start=None, end=None):
+        """Ricavo per batch (date x record) di una lista di dict materiale -> kg."""
+        matrix, unpriced = self.mass_matrix(recovered_masses)
+        return self.prices[self.rows(start, end)] @ matrix, unpriced
+
+    def _row_at(self, date):
+        """Riga dell'ultima data disponibile non successiva a `date`."""
+        return max(int(np.searchsorted(self.dates, np.datetime64(date, "D").astype(np.int64), side="right")) - 1, 0)
+
+    def revenue_at(self, recovered_masses, date):
+        """Ricavo per batch ai prezzi dell'ultima data disponibile non successiva a `date`."""
+        matrix, unpriced = self.mass_matrix(recovered_masses)
+        return self.prices[self._row_at(date)] @ matrix, unpriced
+
+    def prices_at(self, materials, date):
+        """Prezzi (EUR/kg) dei materiali indicati a una data; 0 per i materiali senza prezzo."""
+        row = self.prices[self._row_at(date)]
+        return np.array([row[self._columns[material.lower()]] if material.lower() in self._columns else 0.0
+                         for material in materials])
+
+
+def batch_opex(model):
+    """OpEx per batch: voci OpEx (senza la voce "Energy" calcolata) più il costo dell'energia."""
+    return sum(value for name, value in zip(model.opex.names, model.opex.values) if name != "Energy") + \
+        model.energy_total()
+
+
+def price_history_version():
+    if not os.path.exists(price_history_file):
+        return None
+    file_stat = os.stat(price_history_file)
+    return f"{file_stat.st_mtime_ns}-{file_stat.st_size}"
+
+
+@st.cache_resource(max_entries=2)
+def open_price_history(version):
+    """Apre (costruendola se manca) la versione `version` dello storico dei prezzi."""
+    history_root = os.path.join(data_dir, "price_history")
+    directory = os.path.join(history_root, version)
+    if not os.path.exists(directory):
+        temp_directory = tempfile.mkdtemp(dir=data_dir, prefix=".prices_")
+        try:
+            write_price_history(price_history_file, temp_directory)
+        except BaseException:
+            shutil.rmtree(temp_directory, ignore_errors=True)
+            raise
+        os.makedirs(history_root, exist_ok=True)
+        try:
+            os.rename(temp_directory, directory)
+        except OSError:
+            shutil.rmtree(temp_directory, ignore_errors=True)
+        for old_version in os.listdir(history_root):
+            if old_version != version:
+                shutil.rmtree(os.path.join(history_root, old_version), ignore_errors=True)
+    return PriceHistory(directory)
+
+
+# --- Allocazione dei costi ai materiali recuperati ---
+ALLOCATION_CATEGORIES = ("OpEx", "Energy", "Annualised CapEx")
 
 
+def capital_recovery_factor(rate, years):
+    """Quota annua di un investimento unitario ammortizzato in `years` anni al tasso `rate`."""
+    if years <= 0:
+        return 1.0
+    if rate == 0:
+        return 1 / years
+    return rate * (1 + rate) ** years / ((1 + rate) ** years - 1)
+
+
+def allocation_matrices(models, materials, capex_per_batch_factor):
+    """
+    Matrici per l'allocazione di più record insieme:
+    costi record x categoria (EUR per batch) e masse recuperate record x materiale (kg per batch).
+    """
+    columns = {material: column for column, material in enumerate(materials)}
+    costs = np.zeros((len(models), len(ALLOCATION_CATEGORIES)))
+    masses = np.zeros((len(models), len(materials)))
+    for row, model in enumerate(models):
+        energy = model.energy_total()
+        costs[row] = (batch_opex(model) - energy, energy, model.capex.total() * capex_per_batch_factor)
+        for material, mass in model.technical_kpis.get("recovered_masses", {}).items():
+            if material in columns:
+                masses[row, columns[material]] = mass
+    return costs, masses
+
+
+def allocate_costs(costs, masses, keys):
+    """
+    Ripartisce i costi (record x categoria) sui materiali in proporzione alle
+    chiavi (record x materiale). Restituisce l'allocazione record x categoria x
+    materiale e il costo per kg record x materiale (NaN se nulla è recuperato).
+    Un record con chiavi tutte nulle (es. nessun materiale con prezzo) è ripartito
+    per massa, così i suoi costi non spariscono dall'allocazione.
+    """
+    keys = np.where(keys.sum(axis=1, keepdims=True) > 0, keys, masses)
+    key_totals = keys.sum(axis=1, keepdims=True)
+    shares = np.divide(keys, key_totals, out=np.zeros_like(keys), where=key_totals > 0)
+    allocation = costs[:, :, None] * shares[:, None, :]
+    cost_per_kg = np.divide(allocation.sum(axis=1), masses, out=np.full_like(masses, np.nan), where=masses > 0)
+    return allocation, cost_per_kg
+
+
+# --- Modello energetico orario con tariffe a fasce ---
+# La tabella locale data/hourly_tariff.csv ha 8760 righe (anno non bisestile che
+# inizia di lunedì) con le colonne "price" (EUR/kWh) e "grid_intensity" (kg CO2e/kWh).
+# Senza tabella si usano fasce orarie come moltiplicatori del prezzo flat dello scenario.
+tariff_file = os.path.join(data_dir, "hourly_tariff.csv")
+HOURS_PER_YEAR = 8760
+DEFAULT_TOU_MULTIPLIERS = {"peak": 1.3, "shoulder": 1.0, "off_peak": 0.75}
+DEFAULT_GRID_INTENSITY = 0.25  # kg CO2e/kWh, valore indicativo usato senza tabella locale
+
+
+def _default_tou_multipliers():
+    """Picco 8-19 nei giorni feriali, intermedia 7-8 e 19-23, fuori picco la notte e nel weekend."""
+    hours = np.arange(HOURS_PER_YEAR)
+    hour_of_day = hours % 24
+    weekday = (hours // 24) % 7 < 5
+    multipliers = np.full(HOURS_PER_YEAR, DEFAULT_TOU_MULTIPLIERS["off_peak"])
+    multipliers[weekday & (((hour_of_day >= 7) & (hour_of_day < 8)) | ((hour_of_day >= 19) & (hour_of_day < 23)))] = \
+        DEFAULT_TOU_MULTIPLIERS["shoulder"]
+    multipliers[weekday & (hour_of_day >= 8) & (hour_of_day < 19)] = DEFAULT_TOU_MULTIPLIERS["peak"]
+    return multipliers
+
+
+class HourlyTariff:
+    """
+    Prezzi e intensità della rete per le 8760 ore dell'anno. Se `relative` è vero
+    i prezzi sono moltiplicatori del prezzo flat (energy_cost) di ogni scenario.
+    """
+
+    def __init__(self, prices, grid_intensity, relative=False):
+        self.prices = prices
+        self.grid_intensity = grid_intensity
+        self.relative = relative
+
+    @classmethod
+    def from_csv(cls, path):
+        prices = []
+        grid_intensity = []
+        with open(path, "r", encoding="utf-8-sig", newline="") as file:
+            for row in csv.DictReader(file):
+                prices.append(_to_float(row.get("price", 0.0)))
+                grid_intensity.append(_to_float(row.get("grid_intensity", DEFAULT_GRID_INTENSITY)))
+        if len(prices) < HOURS_PER_YEAR:
+            raise ValueError(f"{path} has {len(prices)} rows, {HOURS_PER_YEAR} are required")
+        return cls(np.array(prices[:HOURS_PER_YEAR]), np.array(grid_intensity[:HOURS_PER_YEAR]))
+
+    def annual(self, loads, energy_costs):
+        """Costo (EUR) ed emissioni (kg CO2e) annui per una matrice di carichi scenari x ore."""
+        costs = loads @ self.prices
+        if self.relative:
+            costs = costs * energy_costs
+        return costs, loads @ self.grid_intensity
+
+
+@st.cache_resource(max_entries=2)
+def load_hourly_tariff(version):
+    if version is None:
+        return HourlyTariff(_default_tou_multipliers(), np.full(HOURS_PER_YEAR, DEFAULT_GRID_INTENSITY),
+                            relative=True)
+    return HourlyTariff.from_csv(tariff_file)
+
+
+def hourly_tariff_version():
+    if not os.path.exists(tariff_file):
+        return None
+    file_stat = os.stat(tariff_file)
+    return f"{file_stat.st_mtime_ns}-{file_stat.st_size}"
+
+
+def get_default_energy_schedule(energy_consumption):
+    """Un batch al giorno alle 8 nei giorni feriali, macchine in sequenza per un'ora ciascuna."""
+    return {
+        "batch_start_hours": [8],
+        "operating_days": "Weekdays",
+        "machines": {machine: {"offset": i, "duration": 1} for i, machine in enumerate(energy_consumption)}
+    }
+
+
+def hourly_load(energy_consumption, schedule):
+    """
+    Carico orario annuo (kWh per ora, 8760 valori) e numero di batch all'anno.
+    Il consumo di ogni macchina è ripartito uniformemente sulle sue ore di funzionamento.
+    """
+    days = np.arange(HOURS_PER_YEAR // 24)
+    if schedule.get("operating_days", "Weekdays") == "Weekdays":
+        days = days[days % 7 < 5]
+    batch_starts = (days[:, None] * 24 + np.asarray(schedule.get("batch_start_hours", [8]))[None, :]).ravel()
+    default_machines = get_default_energy_schedule(energy_consumption)["machines"]
+    hour_indices = []
+    hour_weights = []
+    for machine, kwh in energy_consumption.items():
+        profile = schedule.get("machines", {}).get(machine, default_machines[machine])
+        duration = max(int(profile.get("duration", 1)), 1)
+        hours = batch_starts[:, None] + int(profile.get("offset", 0)) + np.arange(duration)[None, :]
+        hour_indices.append(hours.ravel() % HOURS_PER_YEAR)
+        hour_weights.append(np.full(hours.size, kwh / duration))
+    if not hour_indices:
+        return np.zeros(HOURS_PER_YEAR), batch_starts.size
+    load = np.bincount(np.concatenate(hour_indices), weights=np.concatenate(hour_weights),
+                       minlength=HOURS_PER_YEAR)
+    return load, batch_starts.size
+
+
+@st.cache_data(max_entries=256)
+def _tou_averages(tariff_version, energy_consumption, energy_cost, schedule):
+    """Prezzo (EUR/kWh) e intensità della rete (kg CO2e/kWh) medi pesati sul carico orario."""
+    load, _ = hourly_load(energy_consumption, schedule)
+    annual_kwh = load.sum()
+    if annual_kwh <= 0:
+        return energy_cost, None
+    annual_costs, annual_emissions = load_hourly_tariff(tariff_version).annual(load[None, :],
+                                                                               np.array([energy_cost]))
+    return float(annual_costs[0] / annual_kwh), float(annual_emissions[0] / annual_kwh)
+
+
+def effective_energy_price(energy_consumption, energy_cost, schedule=None):
+    """
+    Prezzo medio dell'energia (EUR/kWh) pesato sul carico orario del profilo di
+    funzionamento. Senza profilo salvato lo scenario resta a prezzo flat.
+    """
+    if not schedule:
+        return energy_cost
+    return _tou_averages(hourly_tariff_version(), dict(energy_consumption), float(energy_cost), schedule)[0]
+
+
+def effective_grid_intensity(energy_consumption, schedule, electricity_factor):
+    """
+    Intensità media della rete (kg CO2e/kWh) sulle ore di funzionamento, se lo
+    scenario ha un profilo e c'è una tabella oraria; altrimenti il fattore flat.
+    """
+    tariff_version = hourly_tariff_version()
+    if not schedule or tariff_version is None:
+        return electricity_factor
+    intensity = _tou_averages(tariff_version, dict(energy_consumption), 1.0, schedule)[1]
+    return electricity_factor if intensity is None else intensity
+
+
+# --- Impronta di carbonio ---
+# Fattori di emissione locali (data/emission_factors.json, stessa struttura dei
+# predefiniti): elettricità in kg CO2e/kWh (scope 2), liquidi delle fasi in
+# kg CO2e/L, voci OpEx di reagenti in kg CO2e/EUR di spesa. Una voce OpEx già
+# presente tra i liquidi delle fasi è contata solo tramite il volume.
+emission_factors_file = os.path.join(data_dir, "emission_factors.json")
+DEFAULT_EMISSION_FACTORS = {
+    "electricity": DEFAULT_GRID_INTENSITY,
+    "liquids": {
+        "Water": 0.0003, "Malic Acid": 2.0, "Citric Acid": 1.6, "Hydrogen Peroxide": 1.3,
+        "Sulfuric Acid": 0.25, "Hydrochloric Acid": 0.9, "Sodium Hydroxide": 1.9
+    },
+    "opex_spend": {
+        "Reagents": 0.8, "Malic Acid": 0.5, "Hydrogen Peroxide": 0.6, "Lithium Precipitation Reagents": 0.7,
+        "Co/Ni/Mn Precipitation Reagents": 0.7, "Wastewater Treatment Chemicals": 0.6, "Disposal": 0.4
+    }
+}
+
+
+def load_emission_factors():
+    """Fattori di emissione: file locale se presente, altrimenti i valori predefiniti."""
+    if os.path.exists(emission_factors_file):
+        try:
+            with open(emission_factors_file, "r") as file:
+                return {**DEFAULT_EMISSION_FACTORS, **json.load(file)}
+        except (OSError, ValueError) as e:
+            st.warning(f"Could not read {emission_factors_file}, using default emission factors: {e}")
+    return DEFAULT_EMISSION_FACTORS
+
+
+def _factor_vector(names, factors):
+    factors = {name.lower(): value for name, value in factors.items()}
+    return np.array([factors.get(name.lower(), 0.0) for name in names])
+
+
+def carbon_footprints(energy_kwh, liquids, liquid_names, opex, opex_names, black_mass, factors,
+                      electricity_intensity=None):
+    """
+    Impronta per batch di molti record insieme. energy_kwh e black_mass sono
+    vettori per record, liquids (L) e opex (EUR) matrici record x nome.
+    electricity_intensity (kg CO2e/kWh per record) sostituisce il fattore flat dell'elettricità.
+    Restituisce un dict di array: scope 2, reagenti, totale e kg CO2e per kg di black mass.
+    """
+    liquid_keys = {name.lower() for name in liquid_names}
+    opex_factors = _factor_vector(opex_names, factors["opex_spend"])
+    opex_factors[[name.lower() in liquid_keys for name in opex_names]] = 0.0
+    if electricity_intensity is None:
+        electricity_intensity = factors["electricity"]
+    scope2 = np.asarray(energy_kwh, dtype=np.float64) * np.asarray(electricity_intensity, dtype=np.float64)
+    reagents = liquids @ _factor_vector(liquid_names, factors["liquids"]) + opex @ opex_factors
+    total = scope2 + reagents
+    black_mass = np.asarray(black_mass, dtype=np.float64)
+    return {
+        "scope2": scope2,
+        "reagents": reagents,
+        "total": total,
+        "per_kg": np.divide(total, black_mass, out=np.full_like(total, np.nan), where=black_mass > 0)
+    }
+
+
+def _dense_rows(rows):
+    """Lista di dict nome -> valore come (matrice record x nome, nomi)."""
+    names = sorted({name for row in rows for name in row})
+    columns = {name: column for column, name in enumerate(names)}
+    matrix = np.zeros((len(rows), len(names)))
+    for row_index, row in enumerate(rows):
+        for name, value in row.items():
+            matrix[row_index, columns[name]] += value
+    return matrix, names
+
+
+def record_black_mass(technical_kpis):
+    """Black mass per batch: total_black_mass se indicata, altrimenti la somma delle masse delle fasi."""
+    if technical_kpis.get("total_black_mass"):
+        return float(technical_kpis["total_black_mass"])
+    return sum(phase_totals(phase)[0] for phase in technical_kpis.get("phases", {}).values())
+
+
+def model_footprints(models, factors):
+    """Impronta di una lista di ScenarioModel in un unico passaggio."""
+    liquids, liquid_names = _dense_rows([
+        {name: volume for phase in model.technical_kpis.get("phases", {}).values()
+         for name, volume in phase["liquids"].items()}
+        for model in models
+    ])
+    opex, opex_names = _dense_rows([model.opex.to_dict() for model in models])
+    # Scope 2 sulle ore di funzionamento per gli scenari con profilo orario
+    electricity_intensity = [
+        effective_grid_intensity(model.energy_consumption.to_dict(), model.extra.get("energy_schedule"),
+                                 factors["electricity"])
+        for model in models
+    ]
+    return carbon_footprints(
+        [model.energy_consumption.total() for model in models], liquids, liquid_names, opex, opex_names,
+        [record_black_mass(model.technical_kpis) for model in models], factors, electricity_intensity
+    )
+
+
+def scenario_footprints(factors):
+    """Impronta di tutti gli scenari, ricalcolata solo quando cambiano scenari o fattori."""
+    store = st.session_state.amelie_scenarios
+    cache_key = (store.version, json.dumps(factors, sort_keys=True), hourly_tariff_version())
+    cached = st.session_state.get("scenario_footprints")
+    if cached is None or cached[0] != cache_key:
+        names = list(store)
+        footprints = model_footprints([store.model(name) for name in names], factors)
+        st.session_state.scenario_footprints = (cache_key, {"names": names, **footprints})
+    return st.session_state.scenario_footprints[1]
+
+
+@st.cache_resource(max_entries=4)
+def literature_footprints(version, factors_json, cost_table_json=None):
+    """
+    Impronta di tutto il corpus. Con una tabella degli indici la spesa OpEx è prima
+    normalizzata come in Benchmarking; senza, resta ai valori nominali.
+    """
+    corpus = open_literature_corpus(version)
+    opex, opex_names = corpus.dense("opex")
+    if cost_table_json is not None:
+        opex = opex * normalized_literature_costs(version, cost_table_json).opex_factors[:, None]
+    liquids, liquid_names = corpus.phase_dense("liquids")
+    # Per i case studies la black mass è la somma delle masse delle fasi
+    return carbon_footprints(corpus.column("energy_kwh"), liquids, liquid_names, opex, opex_names,
+                             corpus.column("total_mass"), json.loads(factors_json))
+
+
+# --- Curve di apprendimento (nth-of-a-kind) ---
+# Legge di Wright per ogni voce: costo(n) = costo(1) * n ** log2(1 - LR), dove n
+# sono le unità cumulative installate (o il throughput cumulativo in multipli di
+# quello del primo impianto) e LR la riduzione di costo a ogni raddoppio.
+def learning_exponents(learning_rates):
+    return np.log2(1 - np.clip(learning_rates, 0.0, 0.95))
+
+
+def sample_learning_rates(central, spread, samples, seed=0):
+    """Campioni (campioni x voci) uniformi in [LR - spread, LR + spread]."""
+    rng = np.random.default_rng(seed)
+    central = np.asarray(central, dtype=np.float64)
+    draws = central[None, :] + rng.uniform(-1.0, 1.0, (samples, central.size)) * np.asarray(spread)[None, :]
+    return np.clip(draws, 0.0, 0.95)
+
+
+def project_learning_curve(costs, learning_rates, cumulative_units):
+    """
+    Proiezione per scenari x campioni x passi del percorso di deployment.
+    costs: scenari x voci (costo del primo impianto); learning_rates: campioni x voci.
+    """
+    units = np.maximum(np.asarray(cumulative_units, dtype=np.float64), 1.0)
+    factors = units[None, None, :] ** learning_exponents(learning_rates)[:, :, None]
+    return np.einsum("si,kin->skn", costs, factors)
+
+
+def learning_curve_percentiles(costs, learning_rates, cumulative_units, percentiles=(5, 50, 95),
+                               max_elements=1 << 22):
+    """
+    Percentili (scenari x percentili x passi) della proiezione sui campioni.
+    I passi sono elaborati a blocchi, così la memoria resta limitata a circa
+    max_elements float per blocco qualunque siano campioni e orizzonte.
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    cumulative_units = np.asarray(cumulative_units, dtype=np.float64)
+    samples, items = np.shape(learning_rates)
+    chunk = max(1, max_elements // (samples * max(items, costs.shape[0], 1)))
+    result = np.empty((costs.shape[0], len(percentiles), cumulative_units.size))
+    for start in range(0, cumulative_units.size, chunk):
+        projection = project_learning_curve(costs, learning_rates, cumulative_units[start:start + chunk])
+        result[:, :, start:start + chunk] = np.percentile(projection, percentiles, axis=1).transpose(1, 0, 2)
+    return result
+
+
+# --- Localizzazione dell'impianto e logistica della black mass ---
+# Grafo locale in due CSV:
+#   data/logistics_nodes.csv: id, type ("site" o "source"), supply_kg_per_year (per le fonti),
+#                             capex_multiplier (opzionale, per i siti)
+#   data/logistics_edges.csv: from, to, distance_km (archi percorribili nei due sensi)
+logistics_nodes_file = os.path.join(data_dir, "logistics_nodes.csv")
+logistics_edges_file = os.path.join(data_dir, "logistics_edges.csv")
+
+
+class LogisticsNetwork:
+    """Grafo di fonti e siti candidati con le distanze minime fonti x siti precalcolate."""
+
+    def __init__(self, nodes_path, edges_path):
+        with open(nodes_path, "r", encoding="utf-8-sig", newline="") as file:
+            nodes = list(csv.DictReader(file))
+        node_ids = [row["id"].strip() for row in nodes]
+        index = {node_id: i for i, node_id in enumerate(node_ids)}
+        adjacency = [[] for _ in node_ids]
+        with open(edges_path, "r", encoding="utf-8-sig", newline="") as file:
+            for row in csv.DictReader(file):
+                start, end = index.get(row["from"].strip()), index.get(row["to"].strip())
+                if start is None or end is None:
+                    raise ValueError(f"edge {row['from']} -> {row['to']} references an unknown node")
+                distance = _to_float(row["distance_km"])
+                adjacency[start].append((end, distance))
+                adjacency[end].append((start, distance))
+
+        node_types = [row.get("type", "").strip().lower() for row in nodes]
+        source_rows = [i for i, node_type in enumerate(node_types) if node_type == "source"]
+        site_rows = [i for i, node_type in enumerate(node_types) if node_type == "site"]
+        self.sources = [node_ids[i] for i in source_rows]
+        self.sites = [node_ids[i] for i in site_rows]
+        self.supply = np.array([_to_float(nodes[i].get("supply_kg_per_year") or 0) for i in source_rows])
+        self.capex_multipliers = np.array([_to_float(nodes[i].get("capex_multiplier") or 1) for i in site_rows])
+        # Dijkstra da ogni fonte: distanze fonti x siti (inf se irraggiungibile)
+        self.distances = np.full((len(source_rows), len(site_rows)), np.inf)
+        for source_index, source_row in enumerate(source_rows):
+            node_distances = self._dijkstra(adjacency, source_row)
+            self.distances[source_index] = node_distances[site_rows]
+
+    @staticmethod
+    def _dijkstra(adjacency, start):
+        distances = np.full(len(adjacency), np.inf)
+        distances[start] = 0.0
+        queue = [(0.0, start)]
+        while queue:
+            distance, node = heapq.heappop(queue)
+            if distance > distances[node]:
+                continue
+            for neighbour, length in adjacency[node]:
+                candidate = distance + length
+                if candidate < distances[neighbour]:
+                    distances[neighbour] = candidate
+                    heapq.heappush(queue, (candidate, neighbour))
+        return distances
+
+    def site_costs(self, transport_rate, annual_capex, opex_per_kg):
+        """
+        Costo per kg di black mass trattata in ogni sito: trasporto medio pesato sulla
+        fornitura (transport_rate in EUR per kg e km) + CapEx annualizzata + OpEx.
+        Le fonti con fornitura non collegate a un sito lo rendono non ammissibile (costo inf);
+        quelle senza fornitura non contano, anche se irraggiungibili (eviterebbero inf x 0 = NaN).
+        """
+        total_supply = self.supply.sum()
+        supplying = self.supply > 0
+        transport = (self.supply[supplying] @ self.distances[supplying]) * transport_rate / total_supply \
+            if total_supply > 0 else np.zeros(len(self.sites))
+        capex = annual_capex * self.capex_multipliers / total_supply if total_supply > 0 else \
+            np.full(len(self.sites), np.inf)
+        return transport, capex, transport + capex + opex_per_kg
+
+
+def logistics_version():
+    signature = []
+    for path in (logistics_nodes_file, logistics_edges_file):
+        if not os.path.exists(path):
+            return None
+        file_stat = os.stat(path)
+        signature.append(f"{file_stat.st_mtime_ns}-{file_stat.st_size}")
+    return "|".join(signature)
+
+
+@st.cache_resource(max_entries=2)
+def load_logistics_network(version):
+    return LogisticsNetwork(logistics_nodes_file, logistics_edges_file)
+
+
+# --- Simulatore del flowsheet ---
+# Ogni unità divide la somma dei suoi ingressi in due uscite: la prima riceve,
+# elemento per elemento, la frazione data dallo split factor, la seconda il resto.
+# Le unità sono in ordine topologico.
+FLOWSHEET_UNITS = (
+    ("Water Leaching", ("Feed",), "Water Leachate", "Water Leach Residue"),
+    ("Lithium Precipitation", ("Water Leachate",), "Li Product", "Li Mother Liquor"),
+    ("Acid Leaching", ("Water Leach Residue",), "Acid Leachate", "Acid Leach Residue"),
+    ("Press Filter", ("Acid Leachate",), "Filtrate", "Filter Cake"),
+    ("Co/Ni/Mn Precipitation", ("Filtrate",), "Co/Ni/Mn Product", "Spent Liquor"),
+    ("Wastewater Treatment", ("Li Mother Liquor", "Spent Liquor"), "Treated Effluent", "Sludge"),
+)
+# Prodotti e relativi elementi recuperati; gli altri elementi in un prodotto sono impurezze
+FLOWSHEET_PRODUCTS = {"Li Product": ("Li",), "Co/Ni/Mn Product": ("Co", "Ni", "Mn")}
+# Split factor predefiniti verso la prima uscita ("*" per gli elementi non elencati)
+DEFAULT_SPLIT_FACTORS = {
+    "Water Leaching": {"Li": 0.85, "Co": 0.01, "Ni": 0.01, "Mn": 0.01, "*": 0.10},
+    "Lithium Precipitation": {"Li": 0.90, "*": 0.0},
+    "Acid Leaching": {"Li": 0.90, "Co": 0.95, "Ni": 0.95, "Mn": 0.93, "*": 0.30},
+    "Press Filter": {"*": 0.97},
+    "Co/Ni/Mn Precipitation": {"Li": 0.02, "Co": 0.97, "Ni": 0.97, "Mn": 0.95, "*": 0.05},
+    "Wastewater Treatment": {"*": 0.95},
+}
+
+
+def split_matrix(splits, elements):
+    """Matrice unità x elementi degli split factor, con i predefiniti dove mancano."""
+    matrix = np.zeros((len(FLOWSHEET_UNITS), len(elements)))
+    for row, (unit, *_) in enumerate(FLOWSHEET_UNITS):
+        defaults = DEFAULT_SPLIT_FACTORS[unit]
+        unit_splits = splits.get(unit, {})
+        matrix[row] = [unit_splits.get(element, defaults.get(element, defaults["*"])) for element in elements]
+    return matrix
+
+
+def simulate_flowsheet(feed, splits):
+    """
+    Propaga le portate per elemento lungo il flowsheet per un lotto di set di split factor.
+    feed: kg per elemento (E,); splits: lotti x unità x elementi.
+    Restituisce {nome della corrente: array lotti x elementi}.
+    """
+    splits = np.clip(np.asarray(splits, dtype=np.float64), 0.0, 1.0)
+    streams = {"Feed": np.broadcast_to(np.asarray(feed, dtype=np.float64), (splits.shape[0], splits.shape[2]))}
+    for unit_index, (_, inputs, first_output, second_output) in enumerate(FLOWSHEET_UNITS):
+        inflow = sum(streams[name] for name in inputs)
+        streams[first_output] = inflow * splits[:, unit_index, :]
+        streams[second_output] = inflow - streams[first_output]
+    return streams
+
+
+def flowsheet_recovery(streams, elements):
+    """Masse recuperate (lotti x elementi): solo gli elementi obiettivo di ogni prodotto."""
+    recovered = np.zeros_like(streams["Feed"])
+    for product, targets in FLOWSHEET_PRODUCTS.items():
+        recovered = recovered + streams[product] * np.isin(elements, targets)
+    return recovered
+
+
+# --- Grafici di confronto a pannelli multipli ---
+def small_multiples(labels, panels, columns=3, panel_size=(5.0, 3.5)):
+    """
+    Disegna tutti i pannelli di confronto in un'unica figura, uno per metrica,
+    con le fonti sull'asse x. panels: lista di (titolo, valori, colore).
+    Le etichette delle fonti compaiono solo nel pannello più basso di ogni colonna.
+    """
+    columns = max(1, min(columns, len(panels)))
+    rows = -(-len(panels) // columns)
+    fig, axes = plt.subplots(rows, columns, figsize=(panel_size[0] * columns, panel_size[1] * rows), squeeze=False)
+    positions = np.arange(len(labels))
+    for index, (ax, (title, values, color)) in enumerate(zip(axes.flat, panels)):
+        ax.bar(positions, np.asarray(values, dtype=np.float64), color=color)
+        ax.set_title(title, fontsize=10)
+        ax.set_xticks(positions)
+        if index + columns < len(panels):
+            ax.tick_params(labelbottom=False)
+        else:
+            ax.set_xticklabels(labels, rotation=45, ha="right", fontsize=8)
+    for ax in axes.flat[len(panels):]:
+        ax.set_visible(False)
+    fig.tight_layout()
+    return fig
+
+
+def bar_facets_spec(labels, panels, columns=3):
+    """Specifica Vega-Lite equivalente a small_multiples: un facet per pannello, asse y indipendente."""
+    titles = [title for title, _, _ in panels]
+    frame = pd.DataFrame({
+        "Source": np.tile(np.asarray(labels, dtype=object), len(panels)),
+        "Metric": np.repeat(titles, len(labels)),
+        "Value": np.concatenate([np.asarray(values, dtype=np.float64) for _, values, _ in panels])
+    })
+    spec = {
+        "columns": max(1, min(columns, len(panels))),
+        "facet": {"field": "Metric", "type": "nominal", "sort": titles, "title": None},
+        "spec": {
+            "mark": {"type": "bar", "tooltip": True},
+            "encoding": {
+                "x": {"field": "Source", "type": "nominal", "sort": list(labels), "title": None,
+                      "axis": {"labelAngle": -45}},
+                "y": {"field": "Value", "type": "quantitative", "title": None},
+                "color": {"field": "Metric", "type": "nominal", "legend": None,
+                          "scale": {"domain": titles, "range": [color for _, _, color in panels]}}
+            }
+        },
+        "resolve": {"scale": {"y": "independent"}}
+    }
+    return frame, spec
+
+
+def show_small_multiples(labels, panels, columns=3, name="comparison"):
+    show_figure(lambda: small_multiples(labels, panels, columns), *bar_facets_spec(labels, panels, columns),
+                name=name)
+
+
+# --- Confronto a coppie tra fonti ---
+PAIRWISE_METRICS = ("CapEx", "OpEx", "Overall Efficiency (%)", "Total Mass (kg)", "Total Volume (L)",
+                    "Average S/L Ratio")
+
+
+def pairwise_relative_differences(values):
+    """
+    Differenze relative di tutte le coppie in un'unica operazione di broadcast.
+    values: fonti x metriche. Restituisce metriche x fonti x fonti con
+    (riga / colonna - 1) * 100, NaN dove il valore della colonna è zero.
+    """
+    values = np.asarray(values, dtype=np.float64).T
+    rows = values[:, :, None]
+    columns = np.broadcast_to(values[:, None, :], (values.shape[0], values.shape[1], values.shape[1]))
+    return np.divide(rows - columns, columns, out=np.full(columns.shape, np.nan), where=columns != 0) * 100
+
 
 # Initialize Model
 model = AmelieEconomicModel()
@@ -204,24 +3010,55 @@ amelie_scenarios_file = os.path.join(data_dir, "amelie_scenarios.json")
 if "amelie_scenarios" not in st.session_state:
     # Usa il file di configurazione o crea un valore di default
     amelie_scenarios_file = os.path.join(data_dir, "amelie_scenarios.json")
-    if os.path.exists(amelie_scenarios_file):
-        with open(amelie_scenarios_file, "r") as file:
-            try:
-                # Carica gli scenari da file
-                st.session_state.amelie_scenarios = json.load(file)
-                # Assicura che ogni scenario abbia i valori di default
-                for scenario_name, scenario_data in st.session_state.amelie_scenarios.items():
-                    default_scenario = get_default_scenario()
-                    for key, default_value in default_scenario.items():
-                        if key not in scenario_data:
-                            scenario_data[key] = default_value
-            except json.JSONDecodeError:
-                # Se il file è corrotto, usa il default
-                st.warning("File 'amelie_scenarios.json' non valido. Uso del valore di default.")
-                st.session_state.amelie_scenarios = {"default": get_default_scenario()}
+    st.session_state.amelie_scenarios_journal = EditJournal(amelie_scenarios_file)
+    if st.session_state.amelie_scenarios_journal.exists():
+        try:
+            # Carica gli scenari da file (snapshot + journal)
+            loaded_scenarios = st.session_state.amelie_scenarios_journal.load()
+            # Assicura che ogni scenario abbia i valori di default e lo schema corrente
+            # (gli scenari derivati contengono solo le differenze e non vanno completati)
+            st.session_state.amelie_scenarios = ScenarioStore({
+                scenario_name: migrate_delta(scenario_data) if "parent" in scenario_data
+                else migrate_record(scenario_data, get_default_scenario())
+                for scenario_name, scenario_data in loaded_scenarios.items()
+            })
+        except json.JSONDecodeError:
+            # Se il file è corrotto, usa il default
+            st.warning("File 'amelie_scenarios.json' non valido. Uso del valore di default.")
+            st.session_state.amelie_scenarios = ScenarioStore({"default": get_default_scenario()})
     else:
         # Nessun file trovato, inizializza con il default
-        st.session_state.amelie_scenarios = {"default": get_default_scenario()}
+        st.session_state.amelie_scenarios = ScenarioStore({"default": get_default_scenario()})
+
+# Storico delle versioni: la prima versione di ogni record è lo stato caricato
+if "history" not in st.session_state:
+    st.session_state.history = VersionHistory()
+    for scenario_name in st.session_state.amelie_scenarios:
+        st.session_state.history.commit("scenario", scenario_name,
+                                        st.session_state.amelie_scenarios.view(scenario_name))
+    for case_study_name, case_study in st.session_state.case_studies.items():
+        st.session_state.history.commit("case_study", case_study_name, case_study)
+
+
+def save_amelie_scenarios():
+    try:
+        journal = st.session_state.setdefault("amelie_scenarios_journal", EditJournal(amelie_scenarios_file))
+        store = st.session_state.amelie_scenarios
+        ops = journal.record(store.to_json_dict())
+        # Nuova versione per ogni scenario toccato (anche i figli riscritti da una cancellazione)
+        # e per i suoi discendenti, il cui valore risolto cambia con il genitore
+        pending = list(store) if ops is None else [_pointer_parts(op["path"])[0] for op in ops]
+        changed_names = set()
+        while pending:
+            name = pending.pop()
+            if name in store and name not in changed_names:
+                changed_names.add(name)
+                pending.extend(store.children(name))
+        for name in changed_names:
+            st.session_state.history.commit("scenario", name, store.view(name))
+        st.success("Amelie scenarios saved successfully.")
+    except Exception as e:
+        st.error(f"Failed to save Amelie scenarios: {e}")
 
 
 
@@ -245,19 +3082,80 @@ st.set_page_config(
 st.sidebar.title("Amelie Scenarios")
 scenario_names = list(st.session_state.amelie_scenarios.keys())
 
-selected_scenario = st.sidebar.selectbox("Select Amelie Scenario:", scenario_names + ["Create New Scenario"])
+# Ricerca nell'indice invertito prima di costruire la lista del selectbox
+scenario_query = st.sidebar.text_input(
+    "Search Scenarios:", key="scenario_search",
+    help='Words or prefixes, composition filters like Co>=10, used items like uses:"Malic Acid".'
+)
+visible_scenario_names = get_search_index("scenario").search(scenario_query) if scenario_query else scenario_names
+if scenario_query:
+    st.sidebar.caption(f"{len(visible_scenario_names)} of {len(scenario_names)} scenarios match.")
+
+selected_scenario = st.sidebar.selectbox("Select Amelie Scenario:", visible_scenario_names + ["Create New Scenario"])
 
 if selected_scenario == "Create New Scenario":
     new_scenario_name = st.sidebar.text_input("New Scenario Name:")
+    # Il nuovo scenario eredita dal genitore e salva solo le proprie modifiche
+    parent_scenario = st.sidebar.selectbox("Based On:", ["Default Values", "Independent Copy of Default"] + scenario_names)
     if st.sidebar.button("Create Scenario"):
         if new_scenario_name and new_scenario_name not in st.session_state.amelie_scenarios:
-            st.session_state.amelie_scenarios[new_scenario_name] = get_default_scenario()
+            if parent_scenario == "Independent Copy of Default":
+                st.session_state.amelie_scenarios[new_scenario_name] = get_default_scenario()
+            elif parent_scenario == "Default Values":
+                st.session_state.amelie_scenarios.create_child(new_scenario_name, DEFAULT_PARENT)
+            else:
+                st.session_state.amelie_scenarios.create_child(new_scenario_name, parent_scenario)
             st.success(f"Scenario '{new_scenario_name}' created.")
             selected_scenario = new_scenario_name
         else:
             st.error("Invalid or duplicate scenario name!")
+else:
+    scenario_parent = st.session_state.amelie_scenarios.parent(selected_scenario)
+    if scenario_parent is not None:
+        parent_label = "default values" if scenario_parent == DEFAULT_PARENT else f"'{scenario_parent}'"
+        st.sidebar.caption(
+            f"Inherits from {parent_label}; "
+            f"{len(st.session_state.amelie_scenarios.overrides(selected_scenario))} overridden entries."
+        )
+
+    # Undo/Redo e storico delle versioni dello scenario selezionato
+    history = st.session_state.history
+    undo_col, redo_col = st.sidebar.columns(2)
+    restored_scenario = None
+    with undo_col:
+        if st.button("Undo", key="undo_scenario", disabled=not history.can_undo("scenario", selected_scenario)):
+            restored_scenario = history.undo("scenario", selected_scenario)
+    with redo_col:
+        if st.button("Redo", key="redo_scenario", disabled=not history.can_redo("scenario", selected_scenario)):
+            restored_scenario = history.redo("scenario", selected_scenario)
+    if restored_scenario is not None:
+        st.session_state.amelie_scenarios[selected_scenario] = restored_scenario
+        reset_widget_state("scenario", selected_scenario)
+        save_amelie_scenarios()
+
+    with st.sidebar.expander("Scenario History"):
+        scenario_versions = history.versions("scenario", selected_scenario)
+        st.caption(
+            f"Version {history.cursor('scenario', selected_scenario) + 1} of {len(scenario_versions)} "
+            f"({history.stats()['stored_objects']} stored objects)"
+        )
+        if len(scenario_versions) > 1:
+            version_labels = list(range(1, len(scenario_versions) + 1))
+            version_a = st.selectbox("Compare Version:", version_labels, index=len(version_labels) - 2,
+                                     key="history_version_a")
+            version_b = st.selectbox("With Version:", version_labels, index=len(version_labels) - 1,
+                                     key="history_version_b")
+            version_diff = history.diff(scenario_versions[version_a - 1], scenario_versions[version_b - 1])
+            if version_diff:
+                st.dataframe(pd.DataFrame(version_diff), hide_index=True)
+            else:
+                st.write("No differences.")
 
 
+# Job in background avviati da qualsiasi pagina
+with st.sidebar.expander("Background Jobs"):
+    show_recent_jobs()
+
 # Pulsante per resettare la sessione
 if st.sidebar.button("Reset Session"):
     st.session_state.clear()
@@ -266,6 +3164,7 @@ if st.sidebar.button("Reset Session"):
 # Sidebar navigation
 st.sidebar.title("Navigation")
 page = st.sidebar.radio("Select a Page:", ["Economic KPIs", "Technical KPIs", "Literature", "Benchmarking"])
+chart_payload_report = st.sidebar.empty()
 
 # Initialize session state for case studies
 if "case_studies" not in st.session_state:
@@ -335,9 +3234,11 @@ def economic_kpis():
     model.opex = current_scenario["opex"]
     model.energy_cost = current_scenario["energy_cost"]
     model.energy_consumption = current_scenario["energy_consumption"]
+    model.energy_schedule = current_scenario.get("energy_schedule")
 
     # Add a section dropdown
-    sections = ["General Assumptions", "CapEx Configuration", "OpEx Configuration", "Results"]
+    sections = ["General Assumptions", "CapEx Configuration", "OpEx Configuration", "Energy Schedule & Tariffs",
+                "Results", "Revenue & Margin", "Learning Curve Projection", "Plant Siting & Logistics"]
     selected_section = st.selectbox("Jump to Section:", sections)
 
     # General Assumptions Section
@@ -352,7 +3253,7 @@ def economic_kpis():
                 new_assumption = st.text_input(
                     f"Edit Assumption {idx + 1}:",
                     value=assumption,
-                    key=f"assumption_{selected_scenario}_{idx}"
+                    key=widget_key("scenario", selected_scenario, "assumption", idx)
                 )
 
                 if assumption.startswith("Batch Size") and new_assumption.startswith("Batch Size"):
@@ -374,9 +3275,9 @@ def economic_kpis():
         # Aggiungi nuova assumption
         new_assumption = st.text_input(
             "New Assumption:",
-            key=f"new_assumption_{selected_scenario}"
+            key=widget_key("scenario", selected_scenario, "new_assumption")
         )
-        if st.button("Add Assumption", key=f"add_assumption_{selected_scenario}"):
+        if st.button("Add Assumption", key=widget_key("scenario", selected_scenario, "add_assumption")):
             if new_assumption:
                 current_scenario["assumptions"].append(new_assumption)
                 st.success(f"Added new assumption: {new_assumption}")
@@ -405,14 +3306,15 @@ def economic_kpis():
             col1, col2, col3 = st.columns([3, 2, 1])
             with col1:
                 new_name = st.text_input(f"Edit CapEx Name ({key}):", value=key,
-                                         key=f"capex_name_{selected_scenario}_{key}")
+                                         key=widget_key("scenario", selected_scenario, "capex_name", key))
             with col2:
                 new_cost = st.number_input(
                     f"CapEx Cost ({key}):", value=float(value), min_value=0.0,
-                    key=f"capex_cost_{selected_scenario}_{key}"
+                    key=widget_key("scenario", selected_scenario, "capex_cost", key)
                 )
             with col3:
-                if st.button(f"Remove CapEx ({key})", key=f"remove_capex_{selected_scenario}_{key}"):
+                if st.button(f"Remove CapEx ({key})",
+                             key=widget_key("scenario", selected_scenario, "remove_capex", key)):
                     capex_to_delete.append(key)
 
             # Se il nome o il costo sono cambiati, aggiorna
@@ -430,8 +3332,7 @@ def economic_kpis():
 
         # Grafici e tabelle aggiornati
         st.subheader("Updated CapEx Breakdown")
-        capex_chart = model.generate_pie_chart(current_scenario["capex"], "CapEx Breakdown")
-        st.image(capex_chart, caption="CapEx Breakdown", use_container_width=True)
+        model.show_pie_chart(current_scenario["capex"], "CapEx Breakdown", caption="CapEx Breakdown")
 
         capex_table = model.generate_table(current_scenario["capex"])
         st.table(capex_table)
@@ -451,8 +3352,7 @@ def economic_kpis():
             save_amelie_scenarios()
 
             # Rigenera i grafici e le tabelle
-            capex_chart = model.generate_pie_chart(current_scenario["capex"], "CapEx Breakdown")
-            st.image(capex_chart, caption="CapEx Breakdown", use_container_width=True)
+            model.show_pie_chart(current_scenario["capex"], "CapEx Breakdown", caption="CapEx Breakdown")
 
             capex_table = model.generate_table(current_scenario["capex"])
             st.table(capex_table)
@@ -484,11 +3384,19 @@ def economic_kpis():
 
             min_value=0.0,
 
-            key=f"energy_cost_{selected_scenario}"
+            key=widget_key("scenario", selected_scenario, "energy_cost")
 
         )
 
         current_scenario["energy_cost"] = energy_cost
+        # Con la tariffa oraria attiva il prezzo effettivo dipende dalla fonte dei prezzi orari
+        if current_scenario.get("energy_schedule"):
+            if hourly_tariff_version() is None:
+                st.caption("Time-of-use tariff applied: hourly bands scale this energy cost "
+                           "(see Energy Schedule & Tariffs).")
+            else:
+                st.caption(f"Time-of-use tariff applied: energy is priced from {tariff_file}, "
+                           f"this energy cost is not used (see Energy Schedule & Tariffs).")
 
         # Modifica delle apparecchiature di consumo energetico
 
@@ -506,7 +3414,7 @@ def economic_kpis():
 
                     value=machine,
 
-                    key=f"machine_name_{selected_scenario}_{machine}"
+                    key=widget_key("scenario", selected_scenario, "machine_name", machine)
 
                 )
 
@@ -520,13 +3428,14 @@ def economic_kpis():
 
                     min_value=0.0,
 
-                    key=f"machine_consumption_{selected_scenario}_{machine}"
+                    key=widget_key("scenario", selected_scenario, "machine_consumption", machine)
 
                 )
 
             with col3:
 
-                if st.button(f"Remove {machine}", key=f"remove_machine_{selected_scenario}_{machine}"):
+                if st.button(f"Remove {machine}",
+                             key=widget_key("scenario", selected_scenario, "remove_machine", machine)):
                     energy_to_delete.append(machine)
 
             # Aggiorna il dizionario se il nome è stato modificato
@@ -544,7 +3453,8 @@ def economic_kpis():
 
         # Aggiungi una nuova apparecchiatura
 
-        new_machine_name = st.text_input("New Machine Name:", key=f"new_machine_name_{selected_scenario}")
+        new_machine_name = st.text_input("New Machine Name:",
+                                         key=widget_key("scenario", selected_scenario, "new_machine_name"))
 
         new_machine_consumption = st.number_input(
 
@@ -552,11 +3462,11 @@ def economic_kpis():
 
             min_value=0.0,
 
-            key=f"new_machine_consumption_{selected_scenario}"
+            key=widget_key("scenario", selected_scenario, "new_machine_consumption")
 
         )
 
-        if st.button("Add Machine", key=f"add_machine_{selected_scenario}"):
+        if st.button("Add Machine", key=widget_key("scenario", selected_scenario, "add_machine")):
 
             if new_machine_name and new_machine_name not in current_scenario["energy_consumption"]:
 
@@ -572,12 +3482,77 @@ def economic_kpis():
 
         total_energy_consumption = sum(current_scenario["energy_consumption"].values())
 
-        total_energy_cost = total_energy_consumption * energy_cost
+        total_energy_cost = total_energy_consumption * effective_energy_price(
+            current_scenario["energy_consumption"], energy_cost, current_scenario.get("energy_schedule")
+        )
 
         current_opex["Energy"] = total_energy_cost
 
         st.markdown(f"**Total Energy Cost:** {total_energy_cost:.2f} EUR")
 
+        # --- Reagenti collegati ai volumi delle fasi Solid/Liquid ---
+
+        st.markdown("### Reagents Linked to Solid/Liquid Phases")
+        technical_kpis_data = current_scenario.get("technical_kpis", {})
+        phase_volumes = phase_liquid_volumes(technical_kpis_data.get("phases") or {})
+        if not phase_volumes:
+            st.info("No Solid/Liquid phases saved for this scenario: define them under Technical KPIs to link "
+                    "reagents.")
+        reagent_link = current_scenario.get("reagent_link") or {
+            "prices": {}, "reference_black_mass": technical_kpis_data.get("total_black_mass", 10.0)
+        }
+        reagent_link["reference_black_mass"] = st.number_input(
+            "Black Mass the Phase Volumes Refer To (kg):", min_value=0.1,
+            value=float(reagent_link.get("reference_black_mass") or 10.0),
+            key=widget_key("scenario", selected_scenario, "reagent_reference_mass")
+        )
+        linked_prices = {}
+        for liquid, volume in phase_volumes.items():
+            col1, col2 = st.columns(2)
+            with col1:
+                linked = st.checkbox(f"Link {liquid} ({volume:.2f} L per reference batch)",
+                                     value=liquid in reagent_link["prices"],
+                                     key=widget_key("scenario", selected_scenario, "link_reagent", liquid))
+            with col2:
+                unit_price = st.number_input(f"Unit Price for {liquid} (EUR/L):", min_value=0.0,
+                                             value=float(reagent_link["prices"].get(liquid, 0.0)), disabled=not linked,
+                                             key=widget_key("scenario", selected_scenario, "reagent_price", liquid))
+            if linked:
+                linked_prices[liquid] = unit_price
+        # Le voci OpEx ricavate dai liquidi scollegati vengono rimosse
+        for liquid in set(reagent_link["prices"]) - set(linked_prices):
+            current_opex.pop(liquid, None)
+        reagent_link["prices"] = linked_prices
+        current_scenario["reagent_link"] = reagent_link
+        current_scenario["opex"] = current_opex
+        sync_linked_reagents(current_scenario)
+        current_opex = current_scenario["opex"]
+
+        if linked_prices:
+            st.caption(f"Linked OpEx items follow the phase volumes, scaled by batch mass "
+                       f"(x{reagent_scale(current_scenario):.2f}): {', '.join(linked_prices)}.")
+            # Sweep sulla dimensione del batch: un solo prodotto esterno
+            batch_masses = np.linspace(0.25, 3.0, 12) * reagent_link["reference_black_mass"]
+            sweep = reagent_opex_sweep([phase_volumes[liquid] for liquid in linked_prices],
+                                       list(linked_prices.values()), batch_masses,
+                                       reagent_link["reference_black_mass"])
+
+            def draw_reagent_sweep():
+                fig_sweep, ax_sweep = plt.subplots(figsize=(10, 4))
+                ax_sweep.stackplot(batch_masses, sweep.T, labels=list(linked_prices))
+                ax_sweep.set_xlabel("Batch Black Mass (kg)")
+                ax_sweep.set_ylabel("Reagent OpEx (EUR per batch)")
+                ax_sweep.set_title("Linked Reagent OpEx vs Batch Size")
+                ax_sweep.legend(loc="upper left")
+                return fig_sweep
+
+            sweep_frame = pd.DataFrame(sweep, columns=list(linked_prices))
+            sweep_frame.insert(0, "Batch Black Mass (kg)", batch_masses)
+            show_figure(draw_reagent_sweep, *line_spec(sweep_frame, "Batch Black Mass (kg)", linked_prices,
+                                                       "Reagent OpEx (EUR per batch)",
+                                                       "Linked Reagent OpEx vs Batch Size", mark="area"),
+                        name="reagent_opex_sweep")
+
         # --- Configurazione OpEx Generale ---
 
         st.markdown("### General OpEx Configuration")
@@ -586,7 +3561,8 @@ def economic_kpis():
 
         for key, value in current_opex.items():
 
-            if key != "Energy":  # Non permettere modifiche dirette al costo energia
+            # Non permettere modifiche dirette al costo energia e ai reagenti collegati
+            if key != "Energy" and key not in linked_prices:
 
                 col1, col2, col3 = st.columns([3, 2, 1])
 
@@ -598,7 +3574,7 @@ def economic_kpis():
 
                         value=key,
 
-                        key=f"opex_name_{selected_scenario}_{key}"
+                        key=widget_key("scenario", selected_scenario, "opex_name", key)
 
                     )
 
@@ -612,13 +3588,13 @@ def economic_kpis():
 
                         min_value=0.0,
 
-                        key=f"opex_cost_{selected_scenario}_{key}"
+                        key=widget_key("scenario", selected_scenario, "opex_cost", key)
 
                     )
 
                 with col3:
 
-                    if st.button(f"Remove {key}", key=f"remove_opex_{selected_scenario}_{key}"):
+                    if st.button(f"Remove {key}", key=widget_key("scenario", selected_scenario, "remove_opex", key)):
                         opex_to_delete.append(key)
 
                 # Aggiorna il dizionario se il nome è stato modificato
@@ -635,7 +3611,7 @@ def economic_kpis():
 
         # Aggiungi un nuovo elemento OpEx
 
-        new_opex_name = st.text_input("New OpEx Name:", key=f"new_opex_name_{selected_scenario}")
+        new_opex_name = st.text_input("New OpEx Name:", key=widget_key("scenario", selected_scenario, "new_opex_name"))
 
         new_opex_cost = st.number_input(
 
@@ -643,11 +3619,11 @@ def economic_kpis():
 
             min_value=0.0,
 
-            key=f"new_opex_cost_{selected_scenario}"
+            key=widget_key("scenario", selected_scenario, "new_opex_cost")
 
         )
 
-        if st.button("Add OpEx", key=f"add_opex_{selected_scenario}"):
+        if st.button("Add OpEx", key=widget_key("scenario", selected_scenario, "add_opex")):
 
             if new_opex_name and new_opex_name not in current_opex:
 
@@ -669,9 +3645,7 @@ def economic_kpis():
 
         # --- Visualizza grafico e tabella OpEx ---
 
-        opex_chart = model.generate_pie_chart(current_opex, "OpEx Breakdown")
-
-        st.image(opex_chart, caption="OpEx Breakdown", use_column_width=True)
+        model.show_pie_chart(current_opex, "OpEx Breakdown", caption="OpEx Breakdown")
 
         opex_table = model.generate_table(current_opex)
 
@@ -689,19 +3663,438 @@ def economic_kpis():
         capex_total, opex_total = model.calculate_totals()
         st.write(f"**Total CapEx:** {capex_total} EUR")
         st.write(f"**Total OpEx (including energy):** {opex_total} EUR")
+        footprints = scenario_footprints(load_emission_factors())
+        footprint_row = footprints["names"].index(selected_scenario)
+        st.write(f"**Carbon Footprint:** {footprints['per_kg'][footprint_row]:.3f} kg CO2e per kg black mass "
+                 f"(scope 2: {footprints['scope2'][footprint_row]:.2f}, "
+                 f"reagents: {footprints['reagents'][footprint_row]:.2f} kg CO2e per batch)")
 
-        capex_chart = model.generate_pie_chart(current_scenario["capex"], "CapEx Breakdown")
-        st.image(capex_chart, caption="CapEx Breakdown", use_container_width=True)
+        model.show_pie_chart(current_scenario["capex"], "CapEx Breakdown", caption="CapEx Breakdown")
 
         capex_table = model.generate_table(current_scenario["capex"])
         st.table(capex_table)
 
-        opex_chart = model.generate_pie_chart(current_scenario["opex"], "OpEx Breakdown")
-        st.image(opex_chart, caption="OpEx Breakdown", use_container_width=True)
+        model.show_pie_chart(current_scenario["opex"], "OpEx Breakdown", caption="OpEx Breakdown")
 
         opex_table = model.generate_table(current_scenario["opex"])
         st.table(opex_table)
 
+        # Analisi di incertezza eseguita in background
+        st.subheader("Cost Uncertainty (Monte Carlo)")
+        col1, col2 = st.columns(2)
+        with col1:
+            mc_samples = st.number_input("Samples:", min_value=1000, max_value=5000000, value=100000, step=1000,
+                                         key=widget_key("scenario", selected_scenario, "mc_samples"))
+        with col2:
+            mc_uncertainty = st.slider("Uncertainty per Item (±%):", 0, 100, 20,
+                                       key=widget_key("scenario", selected_scenario, "mc_uncertainty"))
+        opex_items = [value for key, value in current_scenario["opex"].items() if key != "Energy"]
+        mc_params = {
+            "capex": list(current_scenario["capex"].values()),
+            "opex": opex_items + [model.calculate_total_energy_cost()],
+            "samples": int(mc_samples),
+            "uncertainty": float(mc_uncertainty),
+            "seed": 0
+        }
+        job_runner = get_job_runner()
+        if st.button("Run in Background", key=widget_key("scenario", selected_scenario, "run_mc")):
+            job_runner.submit("cost_monte_carlo", f"Monte Carlo ({selected_scenario})",
+                              run_cost_monte_carlo, mc_params)
+
+        mc_job = job_runner.find("cost_monte_carlo", mc_params)
+        if mc_job is not None and show_job_status(mc_job):
+            mc_result = mc_job.result
+            st.table(pd.DataFrame({
+                "Percentile": [f"P{p}" for p in MONTE_CARLO_PERCENTILES],
+                "Total CapEx (EUR)": mc_result["capex"]["percentiles"],
+                "Total OpEx (EUR)": mc_result["opex"]["percentiles"]
+            }))
+
+            def draw_monte_carlo():
+                fig_mc, (ax_mc_capex, ax_mc_opex) = plt.subplots(1, 2, figsize=(12, 4))
+                for ax_mc, histogram, color in ((ax_mc_capex, mc_result["capex"], "blue"),
+                                                (ax_mc_opex, mc_result["opex"], "green")):
+                    ax_mc.hist(histogram["edges"][:-1], bins=histogram["edges"], weights=histogram["counts"],
+                               color=color)
+                ax_mc_capex.set_title("Total CapEx Distribution")
+                ax_mc_opex.set_title("Total OpEx Distribution")
+                return fig_mc
+
+            # Il browser riceve gli istogrammi già aggregati, non i campioni
+            histogram_frames = [
+                pd.DataFrame({"Metric": label, "From": histogram["edges"][:-1], "To": histogram["edges"][1:],
+                              "Count": histogram["counts"]})
+                for label, histogram in (("Total CapEx (EUR)", mc_result["capex"]),
+                                         ("Total OpEx (EUR)", mc_result["opex"]))
+            ]
+            show_figure(draw_monte_carlo, pd.concat(histogram_frames, ignore_index=True), {
+                "facet": {"field": "Metric", "type": "nominal", "title": None},
+                "spec": {
+                    "mark": {"type": "bar", "tooltip": True},
+                    "encoding": {
+                        "x": {"field": "From", "type": "quantitative", "bin": {"binned": True}, "title": "EUR"},
+                        "x2": {"field": "To"},
+                        "y": {"field": "Count", "type": "quantitative"},
+                        "color": {"field": "Metric", "type": "nominal", "legend": None,
+                                  "scale": {"range": ["blue", "green"]}}
+                    }
+                },
+                "resolve": {"scale": {"x": "independent", "y": "independent"}}
+            }, name="cost_monte_carlo")
+
+    elif selected_section == "Energy Schedule & Tariffs":
+        st.subheader("Energy Schedule & Time-of-Use Tariffs")
+        tariff = load_hourly_tariff(hourly_tariff_version())
+        if tariff.relative:
+            st.info(f"No hourly tariff found at {tariff_file}: using default time-of-use bands "
+                    f"({', '.join(f'{band} x{factor}' for band, factor in DEFAULT_TOU_MULTIPLIERS.items())} "
+                    f"of the scenario energy cost) and {DEFAULT_GRID_INTENSITY} kg CO2e/kWh.")
+        else:
+            st.info(f"Using the hourly prices of {tariff_file} (EUR/kWh): while the time-of-use tariff is "
+                    f"applied, the scenario energy cost ({current_scenario['energy_cost']:.4f} EUR/kWh) "
+                    f"is used only for the flat-tariff comparison.")
+
+        # Programma dei batch e profilo di funzionamento di ogni macchina. Il profilo viene
+        # salvato solo se la tariffa oraria è attiva per lo scenario o se è stato modificato.
+        stored_schedule = current_scenario.get("energy_schedule")
+        use_tou = st.checkbox("Apply Time-of-Use Tariff to This Scenario's Energy Costs",
+                              value=bool(stored_schedule),
+                              key=widget_key("scenario", selected_scenario, "use_tou"))
+        schedule = copy.deepcopy(stored_schedule) or get_default_energy_schedule(
+            current_scenario["energy_consumption"]
+        )
+        col1, col2 = st.columns(2)
+        with col1:
+            schedule["batch_start_hours"] = sorted(st.multiselect(
+                "Batch Start Hours:", list(range(24)), default=schedule.get("batch_start_hours", [8]),
+                key=widget_key("scenario", selected_scenario, "batch_start_hours")
+            ))
+        with col2:
+            operating_days = ["Weekdays", "Every Day"]
+            schedule["operating_days"] = st.selectbox(
+                "Operating Days:", operating_days,
+                index=operating_days.index(schedule.get("operating_days", "Weekdays")),
+                key=widget_key("scenario", selected_scenario, "operating_days")
+            )
+        default_machines = get_default_energy_schedule(current_scenario["energy_consumption"])["machines"]
+        machines = {}
+        for machine in current_scenario["energy_consumption"]:
+            profile = schedule.get("machines", {}).get(machine, default_machines[machine])
+            col1, col2 = st.columns(2)
+            with col1:
+                offset = st.number_input(f"{machine}: Start (hours after batch start):", min_value=0, max_value=167,
+                                         value=int(profile.get("offset", 0)),
+                                         key=widget_key("scenario", selected_scenario, "machine_offset", machine))
+            with col2:
+                duration = st.number_input(f"{machine}: Running Time (hours):", min_value=1, max_value=168,
+                                           value=int(profile.get("duration", 1)),
+                                           key=widget_key("scenario", selected_scenario, "machine_duration", machine))
+            machines[machine] = {"offset": int(offset), "duration": int(duration)}
+        schedule["machines"] = machines
+        schedule_changed = (schedule != stored_schedule) if use_tou else stored_schedule is not None
+        if schedule_changed and use_tou:
+            current_scenario["energy_schedule"] = schedule
+        elif schedule_changed:
+            del current_scenario["energy_schedule"]
+
+        # Tutti gli scenari valutati insieme: carichi scenari x ore contro la tariffa
+        scenario_names = list(st.session_state.amelie_scenarios.keys())
+        scenario_records = [current_scenario if name == selected_scenario
+                            else st.session_state.amelie_scenarios.view(name)
+                            for name in scenario_names]
+        loads_and_batches = [
+            hourly_load(record["energy_consumption"],
+                        schedule if name == selected_scenario else
+                        record.get("energy_schedule") or get_default_energy_schedule(record["energy_consumption"]))
+            for name, record in zip(scenario_names, scenario_records)
+        ]
+        loads = np.array([load for load, _ in loads_and_batches])
+        batches = np.array([batch_count for _, batch_count in loads_and_batches], dtype=np.float64)
+        energy_costs = np.array([record["energy_cost"] for record in scenario_records])
+        annual_costs, annual_emissions = tariff.annual(loads, energy_costs)
+        annual_kwh = loads.sum(axis=1)
+        flat_costs = annual_kwh * energy_costs
+        per_batch = np.divide(annual_costs, batches, out=np.zeros_like(annual_costs), where=batches > 0)
+
+        current = scenario_names.index(selected_scenario)
+        st.write(f"**Annual Energy Cost (Time-of-Use):** {annual_costs[current]:.2f} EUR "
+                 f"({int(batches[current])} batches, {annual_kwh[current]:.0f} kWh)")
+        st.write(f"**Energy Cost per Batch:** {per_batch[current]:.2f} EUR "
+                 f"(flat tariff: {sum(current_scenario['energy_consumption'].values()) * energy_costs[current]:.2f} EUR)")
+        st.write(f"**Annual Grid Emissions:** {annual_emissions[current]:.1f} kg CO2e")
+
+        st.table(pd.DataFrame({
+            "Scenario": scenario_names,
+            "Annual kWh": annual_kwh,
+            "Annual Cost ToU (EUR)": annual_costs,
+            "Annual Cost Flat (EUR)": flat_costs,
+            "Cost per Batch ToU (EUR)": per_batch,
+            "Average Price (EUR/kWh)": np.divide(annual_costs, annual_kwh, out=np.zeros_like(annual_costs),
+                                                 where=annual_kwh > 0)
+        }))
+
+        # Profilo di una settimana tipo dello scenario corrente
+        week = slice(0, 24 * 7)
+        hourly_prices = tariff.prices * energy_costs[current] if tariff.relative else tariff.prices
+
+        def draw_load():
+            fig_load, ax_load = plt.subplots(figsize=(10, 4))
+            ax_load.bar(np.arange(24 * 7), loads[current, week], color="orange", label="Load (kWh)")
+            ax_price = ax_load.twinx()
+            ax_price.step(np.arange(24 * 7), hourly_prices[week], color="blue", where="post", label="Price (EUR/kWh)")
+            ax_load.set_xlabel("Hour of the First Week")
+            ax_load.set_ylabel("kWh")
+            ax_price.set_ylabel("EUR/kWh")
+            ax_load.set_title(f"Load and Tariff for '{selected_scenario}'")
+            return fig_load
+
+        load_frame = pd.DataFrame({"Hour": np.arange(24 * 7), "Load (kWh)": loads[current, week],
+                                   "Price (EUR/kWh)": hourly_prices[week]})
+        show_figure(draw_load, load_frame, {
+            "title": f"Load and Tariff for '{selected_scenario}'",
+            "encoding": {"x": {"field": "Hour", "type": "quantitative", "title": "Hour of the First Week"}},
+            "layer": [
+                {"mark": {"type": "bar", "color": "orange"},
+                 "encoding": {"y": {"field": "Load (kWh)", "type": "quantitative", "title": "kWh"}}},
+                {"mark": {"type": "line", "color": "blue", "interpolate": "step-after"},
+                 "encoding": {"y": {"field": "Price (EUR/kWh)", "type": "quantitative", "title": "EUR/kWh"}}}
+            ],
+            "resolve": {"scale": {"y": "independent"}}
+        }, name=f"load_{selected_scenario}")
+
+        if schedule_changed:
+            st.session_state.amelie_scenarios[selected_scenario] = current_scenario
+            save_amelie_scenarios()
+
+    elif selected_section == "Learning Curve Projection":
+        st.subheader("Learning Curve Projection")
+        scenario_names = list(st.session_state.amelie_scenarios.keys())
+        projected_scenarios = st.multiselect("Scenarios:", scenario_names, default=[selected_scenario],
+                                             key="learning_scenarios")
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            pathway = st.selectbox("Deployment Measure:", ["Cumulative Installed Units", "Cumulative Throughput"],
+                                   key="learning_pathway")
+        with col2:
+            horizon = st.number_input("Plants Installed" if pathway == "Cumulative Installed Units" else "Years:",
+                                      min_value=2, max_value=1000, value=50 if pathway == "Cumulative Installed Units"
+                                      else 20, key=f"learning_horizon_{pathway}")
+        with col3:
+            learning_samples = st.number_input("Learning-Rate Samples:", min_value=10, max_value=20000, value=1000,
+                                               step=100, key="learning_samples")
+        steps = np.arange(1, horizon + 1)
+        if pathway == "Cumulative Installed Units":
+            capex_units = opex_units = steps
+            step_label = "Plant Number"
+        else:
+            plants_per_year = st.number_input("New Plants per Year:", min_value=1, value=2, key="plants_per_year")
+            # La CapEx impara dagli impianti installati, la OpEx dal throughput cumulativo
+            # (anni-impianto di esercizio, in multipli di un anno del primo impianto).
+            # Entrambi i conteggi partono dalla prima unità nel primo anno.
+            capex_units = (steps - 1) * plants_per_year + 1
+            opex_units = 1 + np.concatenate([[0], np.cumsum(plants_per_year * steps)[:-1]])
+            step_label = "Year"
+
+        if not projected_scenarios:
+            st.info("Select at least one scenario.")
+            return
+        projected_models = [st.session_state.amelie_scenarios.model(name) for name in projected_scenarios]
+
+        # Tasso di apprendimento per voce (modificabile), con incertezza ±
+        items = []
+        for group, default_rate in (("capex", 12.0), ("opex", 5.0)):
+            for item in dict.fromkeys(name for m in projected_models for name in getattr(m, group).names):
+                items.append({"Group": group.capitalize(), "Item": item,
+                              "Learning Rate (%)": 0.0 if item == "Energy" else default_rate,
+                              "Uncertainty (±%)": 0.0 if item == "Energy" else 3.0})
+        rates_df = st.data_editor(pd.DataFrame(items), disabled=["Group", "Item"], hide_index=True,
+                                  key="learning_rates_" + "_".join(projected_scenarios))
+
+        # Matrice dei costi del primo impianto: scenari x voci
+        costs = np.zeros((len(projected_models), len(rates_df)))
+        for row, projected_model in enumerate(projected_models):
+            item_values = {("Capex", name): value for name, value in projected_model.capex.to_dict().items()}
+            item_values.update({("Opex", name): value for name, value in projected_model.opex.to_dict().items()})
+            costs[row] = [item_values.get((group, item), 0.0) for group, item in zip(rates_df["Group"], rates_df["Item"])]
+        rates = sample_learning_rates(rates_df["Learning Rate (%)"].to_numpy(dtype=np.float64) / 100,
+                                      rates_df["Uncertainty (±%)"].to_numpy(dtype=np.float64) / 100,
+                                      int(learning_samples))
+        is_capex = (rates_df["Group"] == "Capex").to_numpy()
+        capex_bands = learning_curve_percentiles(costs * is_capex, rates, capex_units)
+        opex_bands = learning_curve_percentiles(costs * ~is_capex, rates, opex_units)
+
+        # Bande: scenari x (P5, P50, P95) x passi
+        def draw_learning():
+            fig_learning, (ax_capex_lc, ax_opex_lc) = plt.subplots(1, 2, figsize=(12, 4))
+            for row, name in enumerate(projected_scenarios):
+                for axis, bands in ((ax_capex_lc, capex_bands), (ax_opex_lc, opex_bands)):
+                    low, median, high = bands[row]
+                    axis.plot(steps, median, label=name)
+                    axis.fill_between(steps, low, high, alpha=0.2)
+            ax_capex_lc.set_title("CapEx per Plant (median, P5-P95)")
+            ax_opex_lc.set_title("OpEx per Batch (median, P5-P95)")
+            for axis in (ax_capex_lc, ax_opex_lc):
+                axis.set_xlabel(step_label)
+                axis.set_ylabel("EUR")
+                axis.legend()
+            return fig_learning
+
+        learning_frame = pd.concat([
+            pd.DataFrame({"Metric": metric, "Scenario": name, "Step": steps,
+                          "P5": bands[row, 0], "P50": bands[row, 1], "P95": bands[row, 2]})
+            for metric, bands in (("CapEx per Plant (EUR)", capex_bands), ("OpEx per Batch (EUR)", opex_bands))
+            for row, name in enumerate(projected_scenarios)
+        ], ignore_index=True)
+        show_figure(draw_learning, learning_frame, {
+            "facet": {"field": "Metric", "type": "nominal", "title": None},
+            "spec": {
+                "encoding": {"x": {"field": "Step", "type": "quantitative", "title": step_label},
+                             "color": {"field": "Scenario", "type": "nominal"}},
+                "layer": [
+                    {"mark": {"type": "area", "opacity": 0.2},
+                     "encoding": {"y": {"field": "P5", "type": "quantitative", "title": "EUR"}, "y2": {"field": "P95"}}},
+                    {"mark": {"type": "line", "tooltip": True},
+                     "encoding": {"y": {"field": "P50", "type": "quantitative"}}}
+                ]
+            },
+            "resolve": {"scale": {"y": "independent"}}
+        }, name="learning_curve")
+
+        st.table(pd.DataFrame({
+            "Scenario": projected_scenarios,
+            f"CapEx at {step_label} 1 (P50)": capex_bands[:, 1, 0],
+            f"CapEx at {step_label} {horizon} (P50)": capex_bands[:, 1, -1],
+            f"OpEx at {step_label} 1 (P50)": opex_bands[:, 1, 0],
+            f"OpEx at {step_label} {horizon} (P50)": opex_bands[:, 1, -1]
+        }))
+
+    elif selected_section == "Plant Siting & Logistics":
+        st.subheader("Plant Siting & Feedstock Logistics")
+        if logistics_version() is None:
+            st.info(f"No logistics graph found. Add {logistics_nodes_file} (id, type = site/source, "
+                    f"supply_kg_per_year, capex_multiplier) and {logistics_edges_file} (from, to, distance_km).")
+            return
+        try:
+            network = load_logistics_network(logistics_version())
+        except (OSError, KeyError, ValueError) as e:
+            st.error(f"Failed to read the logistics graph: {e}")
+            return
+        if not network.sites or not network.sources:
+            st.info("The logistics graph needs at least one site and one source.")
+            return
+
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            transport_rate = st.number_input("Transport Cost (EUR per t·km):", min_value=0.0, value=0.15,
+                                             key="transport_rate")
+        with col2:
+            siting_lifetime = st.number_input("Plant Lifetime (years):", min_value=1, value=10,
+                                              key="siting_lifetime")
+        with col3:
+            siting_rate = st.number_input("Discount Rate (%):", min_value=0.0, value=8.0, key="siting_rate")
+
+        # Costi del processo per kg: OpEx per batch sulla black mass del batch, CapEx annualizzata
+        scenario_model = st.session_state.amelie_scenarios.model(selected_scenario)
+        batch_mass = current_scenario.get("technical_kpis", {}).get("total_black_mass", 10.0) or 10.0
+        opex_per_kg = batch_opex(scenario_model) / batch_mass
+        annual_capex = scenario_model.capex.total() * capital_recovery_factor(siting_rate / 100, siting_lifetime)
+        transport, capex_per_kg, total_per_kg = network.site_costs(transport_rate / 1000, annual_capex,
+                                                                   opex_per_kg)
+
+        st.write(f"**Feedstock:** {network.supply.sum():,.0f} kg/year from {len(network.sources)} sources "
+                 f"({network.supply.sum() / batch_mass:,.0f} batches of {batch_mass} kg)")
+        feasible = np.isfinite(total_per_kg)
+        if feasible.any():
+            best = int(np.argmin(np.where(feasible, total_per_kg, np.inf)))
+            st.success(f"Best site: {network.sites[best]} at {total_per_kg[best]:.3f} EUR per kg of black mass.")
+        else:
+            st.warning("No site is reachable from every source.")
+        st.table(pd.DataFrame({
+            "Site": network.sites,
+            "Transport (EUR/kg)": transport,
+            "Annualised CapEx (EUR/kg)": capex_per_kg,
+            "OpEx (EUR/kg)": np.full(len(network.sites), opex_per_kg),
+            "Total (EUR/kg)": total_per_kg
+        }).sort_values("Total (EUR/kg)"))
+
+    elif selected_section == "Revenue & Margin":
+        st.subheader("Revenue & Margin from Recovered Materials")
+        uploaded_prices = st.file_uploader("Price History (CSV: date, then one column per material in EUR/kg):",
+                                           type=["csv"], key="price_history_upload")
+        if uploaded_prices is not None and st.button("Save Price History", key="save_price_history"):
+            with open(price_history_file, "wb") as file:
+                file.write(uploaded_prices.getvalue())
+            st.success(f"Price history saved to {price_history_file}")
+
+        if price_history_version() is None:
+            st.info(f"No price history found. Upload a CSV or place it at {price_history_file}.")
+            return
+        try:
+            prices = open_price_history(price_history_version())
+        except (OSError, ValueError) as e:
+            st.error(f"Failed to read the price history: {e}")
+            return
+        if len(prices) == 0:
+            st.info("The price history has no rows.")
+            return
+
+        first_date, last_date = prices.date_range()
+        col1, col2 = st.columns(2)
+        with col1:
+            start_date = st.date_input("From:", value=first_date.astype(object), min_value=first_date.astype(object),
+                                       max_value=last_date.astype(object), key="revenue_start")
+        with col2:
+            end_date = st.date_input("To:", value=last_date.astype(object), min_value=first_date.astype(object),
+                                     max_value=last_date.astype(object), key="revenue_end")
+
+        # Tutti gli scenari valutati insieme su tutte le date dell'intervallo
+        scenario_names = list(st.session_state.amelie_scenarios.keys())
+        scenario_models = [st.session_state.amelie_scenarios.model(name) for name in scenario_names]
+        revenues, unpriced = prices.revenue(
+            [scenario_model.technical_kpis.get("recovered_masses", {}) for scenario_model in scenario_models],
+            start_date, end_date
+        )
+        if unpriced:
+            st.warning(f"No prices for {', '.join(unpriced)}: their recovered mass is valued at 0.")
+        if revenues.shape[0] == 0:
+            st.info("No prices in the selected date range.")
+            return
+        margins = revenues - np.array([batch_opex(scenario_model) for scenario_model in scenario_models])
+        range_dates = np.asarray(prices.dates[prices.rows(start_date, end_date)]).astype("datetime64[D]")
+
+        current = scenario_names.index(selected_scenario)
+        latest_revenue, _ = prices.revenue_at([current_scenario["technical_kpis"].get("recovered_masses", {})],
+                                              end_date)
+        st.write(f"**Revenue per Batch on {end_date}:** {latest_revenue[0]:.2f} EUR")
+        st.write(f"**Margin per Batch on {end_date}:** {margins[-1, current]:.2f} EUR")
+
+        st.markdown("#### Margin Across the Price History")
+        st.table(pd.DataFrame({
+            "Scenario": scenario_names,
+            "Min Margin (EUR/batch)": margins.min(axis=0),
+            "Mean Margin (EUR/batch)": margins.mean(axis=0),
+            "Max Margin (EUR/batch)": margins.max(axis=0),
+            "Days Profitable (%)": (margins > 0).mean(axis=0) * 100
+        }))
+
+
+        def draw_margin():
+            fig_margin, ax_margin = plt.subplots(figsize=(10, 4))
+            ax_margin.plot(range_dates, revenues[:, current], label="Revenue per Batch", color="green")
+            ax_margin.plot(range_dates, margins[:, current], label="Margin per Batch", color="blue")
+            ax_margin.axhline(0, color="grey", linewidth=0.8)
+            ax_margin.set_ylabel("EUR per Batch")
+            ax_margin.set_title(f"Revenue and Margin for '{selected_scenario}'")
+            ax_margin.legend()
+            return fig_margin
+
+        margin_frame = pd.DataFrame({"Date": pd.to_datetime(range_dates), "Revenue per Batch": revenues[:, current],
+                                     "Margin per Batch": margins[:, current]})
+        show_figure(draw_margin, *line_spec(margin_frame, "Date", ["Revenue per Batch", "Margin per Batch"],
+                                            "EUR per Batch", f"Revenue and Margin for '{selected_scenario}'",
+                                            x_type="temporal"),
+                    name=f"margin_{selected_scenario}")
+
 
 import pandas as pd
 import streamlit as st
@@ -711,7 +4104,7 @@ def technical_kpis():
     st.title("Technical KPIs")
 
     # Dropdown per selezionare la sezione
-    sections = ["Material Composition & Efficiency", "Solid/Liquid Ratios"]
+    sections = ["Material Composition & Efficiency", "Solid/Liquid Ratios", "Flowsheet Simulation"]
     selected_section = st.selectbox("Select Section:", sections)
 
     # Recupera lo scenario selezionato
@@ -758,7 +4151,7 @@ def technical_kpis():
             "Total Black Mass (kg):",
             min_value=0.1,
             value=current_scenario["technical_kpis"].get("total_black_mass", 10.0),
-            key=f"total_black_mass_{selected_scenario}"
+            key=widget_key("scenario", selected_scenario, "total_black_mass")
         )
 
         # Aggiorna sia il valore tecnico che l'assumption
@@ -780,38 +4173,40 @@ def technical_kpis():
             with col1:
                 new_material = st.text_input(
                     f"Material ({material}):", value=material,
-                    key=f"edit_material_{selected_scenario}_{material}"
+                    key=widget_key("scenario", selected_scenario, "edit_material", material)
                 )
             with col2:
                 new_percentage = st.number_input(
                     f"Percentage of {material} in BM (%)", min_value=0.0, max_value=100.0,
-                    value=percentage, key=f"edit_percentage_{selected_scenario}_{material}"
+                    value=percentage, key=widget_key("scenario", selected_scenario, "edit_percentage", material)
                 )
             with col3:
                 recovered_mass = st.number_input(
                     f"Recovered Mass of {material} (kg):",
                     min_value=0.0, value=recovered_masses.get(material, 0.0),
-                    key=f"recovered_mass_{selected_scenario}_{material}"
+                    key=widget_key("scenario", selected_scenario, "recovered_mass", material)
                 )
                 recovered_masses[material] = recovered_mass
             with col4:
-                if st.button(f"Remove {material}", key=f"remove_material_{selected_scenario}_{material}"):
+                if st.button(f"Remove {material}",
+                             key=widget_key("scenario", selected_scenario, "remove_material", material)):
                     continue
 
             updated_composition[new_material] = new_percentage
             total_percentage += new_percentage
 
         # Aggiungi nuovo materiale
-        new_material_name = st.text_input("New Material Name:", key=f"new_material_name_{selected_scenario}")
+        new_material_name = st.text_input("New Material Name:",
+                                          key=widget_key("scenario", selected_scenario, "new_material_name"))
         new_material_percentage = st.number_input(
             "New Material Percentage (%):", min_value=0.0, max_value=100.0,
-            key=f"new_material_percentage_{selected_scenario}"
+            key=widget_key("scenario", selected_scenario, "new_material_percentage")
         )
         new_recovered_mass = st.number_input(
             "New Material Recovered Mass (kg):", min_value=0.0,
-            key=f"new_material_recovered_mass_{selected_scenario}"
+            key=widget_key("scenario", selected_scenario, "new_material_recovered_mass")
         )
-        if st.button("Add Material", key=f"add_material_{selected_scenario}"):
+        if st.button("Add Material", key=widget_key("scenario", selected_scenario, "add_material")):
             if new_material_name and new_material_name not in updated_composition:
                 updated_composition[new_material_name] = new_material_percentage
                 recovered_masses[new_material_name] = new_recovered_mass
@@ -865,64 +4260,149 @@ def technical_kpis():
         save_amelie_scenarios()
         st.success("Material and Efficiency data saved successfully!")
 
+    # Simulazione del flowsheet: recuperi calcolati dalle correnti invece che inseriti a mano
+    elif selected_section == "Flowsheet Simulation":
+        st.subheader("Flowsheet Stream Simulation")
+        technical_kpis_data = current_scenario["technical_kpis"]
+        total_black_mass = technical_kpis_data.get("total_black_mass", 10.0)
+        composition = technical_kpis_data.get("composition", {})
+        elements = list(composition) + ["Impurities"]
+        feed = np.array([total_black_mass * percentage / 100 for percentage in composition.values()] +
+                        [max(total_black_mass * (1 - sum(composition.values()) / 100), 0.0)])
+
+        # Solo gli split modificati dall'utente vengono salvati: aprire la sezione non scrive nulla
+        flowsheet = current_scenario.get("flowsheet") or {}
+        stored_splits = split_matrix(flowsheet.get("splits", {}), elements)
+        splits = stored_splits.copy()
+        for unit_index, (unit, inputs, first_output, second_output) in enumerate(FLOWSHEET_UNITS):
+            with st.expander(f"{unit}: {' + '.join(inputs)} → {first_output} / {second_output}"):
+                split_columns = st.columns(len(elements))
+                for element_index, element in enumerate(elements):
+                    with split_columns[element_index]:
+                        splits[unit_index, element_index] = st.number_input(
+                            f"{element} to {first_output}:", min_value=0.0, max_value=1.0, step=0.01,
+                            value=float(splits[unit_index, element_index]),
+                            key=widget_key("scenario", selected_scenario, "split", unit, element)
+                        )
+        changed_splits = np.argwhere(splits != stored_splits)
+        flowsheet_changed = changed_splits.size > 0
+        if flowsheet_changed:
+            updated_splits = copy.deepcopy(flowsheet.get("splits", {}))
+            for unit_index, element_index in changed_splits:
+                updated_splits.setdefault(FLOWSHEET_UNITS[unit_index][0], {})[elements[element_index]] = \
+                    float(splits[unit_index, element_index])
+            current_scenario["flowsheet"] = {**flowsheet, "splits": updated_splits}
+
+        streams = simulate_flowsheet(feed, splits[None, :, :])
+        recovered = flowsheet_recovery(streams, elements)[0]
+        st.markdown("#### Streams (kg per batch)")
+        st.dataframe(pd.DataFrame({name: flow[0] for name, flow in streams.items()}, index=elements).T)
+
+        st.markdown("#### Recovery")
+        st.table(pd.DataFrame({
+            "Element": elements,
+            "Feed (kg)": feed,
+            "Recovered (kg)": recovered,
+            "Efficiency (%)": np.divide(recovered, feed, out=np.zeros_like(feed), where=feed > 0) * 100
+        }))
+        simulated_efficiency = recovered.sum() / total_black_mass * 100 if total_black_mass > 0 else 0.0
+        st.write(f"**Overall Process Efficiency:** {simulated_efficiency:.2f}%")
+        if st.button("Apply to Technical KPIs", key=widget_key("scenario", selected_scenario, "apply_flowsheet")):
+            technical_kpis_data["recovered_masses"] = {
+                element: float(mass) for element, mass in zip(elements, recovered) if element in composition
+            }
+            technical_kpis_data["efficiency"] = simulated_efficiency
+            flowsheet_changed = True
+            # I widget delle masse recuperate devono mostrare i nuovi valori
+            reset_widget_state("scenario", selected_scenario, "recovered_mass", "")
+            st.success("Recovered masses and efficiency updated from the flowsheet.")
+
+        # Sweep di uno split factor: tutti i set valutati in un'unica propagazione
+        st.markdown("#### Split Factor Sweep")
+        col1, col2 = st.columns(2)
+        with col1:
+            sweep_unit = st.selectbox("Unit Operation:", [unit for unit, *_ in FLOWSHEET_UNITS],
+                                      key="sweep_unit")
+        with col2:
+            sweep_element = st.selectbox("Element:", elements, key="sweep_element")
+        sweep_values = np.linspace(0.0, 1.0, 51)
+        sweep_splits = np.repeat(splits[None, :, :], sweep_values.size, axis=0)
+        sweep_splits[:, [unit for unit, *_ in FLOWSHEET_UNITS].index(sweep_unit), elements.index(sweep_element)] = \
+            sweep_values
+        sweep_recovered = flowsheet_recovery(simulate_flowsheet(feed, sweep_splits), elements)
+        recovered_elements = [element for element_index, element in enumerate(elements)
+                              if sweep_recovered[:, element_index].any()]
+
+        def draw_flowsheet_sweep():
+            fig_sweep, ax_sweep = plt.subplots(figsize=(10, 4))
+            for element in recovered_elements:
+                ax_sweep.plot(sweep_values, sweep_recovered[:, elements.index(element)], label=element)
+            ax_sweep.set_xlabel(f"Split of {sweep_element} in {sweep_unit}")
+            ax_sweep.set_ylabel("Recovered Mass (kg)")
+            ax_sweep.legend()
+            return fig_sweep
+
+        sweep_frame = pd.DataFrame(sweep_recovered, columns=elements)[recovered_elements]
+        sweep_frame.insert(0, f"Split of {sweep_element} in {sweep_unit}", sweep_values)
+        show_figure(draw_flowsheet_sweep, *line_spec(sweep_frame, f"Split of {sweep_element} in {sweep_unit}",
+                                                     recovered_elements, "Recovered Mass (kg)"),
+                    name=f"flowsheet_sweep_{selected_scenario}")
+
+        if flowsheet_changed:
+            st.session_state.amelie_scenarios[selected_scenario] = current_scenario
+            save_amelie_scenarios()
+
     # Solid/Liquid Ratios Section
     elif selected_section == "Solid/Liquid Ratios":
         st.subheader("Solid/Liquid Ratios for Each Phase")
 
-        if "phases" not in st.session_state:
-            st.session_state.phases = {
-                "Leaching in Water": {"liquids": [{"type": "Water", "volume": 20.0}], "mass": 5.0},
-                "Leaching in Acid": {
-                    "liquids": [{"type": "Malic Acid", "volume": 5.0}, {"type": "Water", "volume": 2.0}], "mass": 5.0}
-            }
-
-        phases = st.session_state.phases
+        # Le fasi sono già nel formato canonico (vedi migrate_record)
+        phases = current_scenario["technical_kpis"].get("phases") or get_default_phases()
         updated_phases = {}
 
         for phase_name, phase_data in phases.items():
             st.subheader(f"Phase: {phase_name}")
-            liquids = phase_data.get("liquids", [])
-            updated_liquids = []
+            updated_masses = {}
+            updated_liquids = {}
 
-            phase_mass = st.number_input(
-                f"Mass for {phase_name} (kg):", min_value=0.0, value=phase_data.get("mass", 0.0), step=0.1,
-                key=f"mass_{phase_name}"
-            )
+            for mass_type, mass_value in phase_data["masses"].items():
+                updated_masses[mass_type] = st.number_input(
+                    f"Mass for {phase_name} (kg):", min_value=0.0, value=float(mass_value), step=0.1,
+                    key=widget_key("scenario", selected_scenario, "mass", phase_name, mass_type)
+                )
 
-            for idx, liquid in enumerate(liquids):
+            for idx, (liquid_type, liquid_volume) in enumerate(phase_data["liquids"].items()):
                 col1, col2, col3 = st.columns([2, 1, 1])
                 with col1:
-                    liquid_type = st.text_input(
-                        f"Liquid Type ({liquid['type']}):", value=liquid["type"], key=f"liquid_type_{phase_name}_{idx}"
+                    new_liquid_type = st.text_input(
+                        f"Liquid Type ({liquid_type}):", value=liquid_type,
+                        key=widget_key("scenario", selected_scenario, "liquid_type", phase_name, idx)
                     )
                 with col2:
-                    liquid_volume = st.number_input(
-                        f"Volume ({liquid['type']}, L):", min_value=0.0, value=liquid["volume"], step=0.1,
-                        key=f"volume_{phase_name}_{idx}"
+                    new_liquid_volume = st.number_input(
+                        f"Volume ({liquid_type}, L):", min_value=0.0, value=float(liquid_volume), step=0.1,
+                        key=widget_key("scenario", selected_scenario, "volume", phase_name, idx)
                     )
                 with col3:
-                    if st.button(f"Remove {liquid['type']}", key=f"remove_{phase_name}_{idx}"):
+                    if st.button(f"Remove {liquid_type}",
+                                 key=widget_key("scenario", selected_scenario, "remove_liquid", phase_name, idx)):
                         continue
 
-                updated_liquids.append({"type": liquid_type, "volume": liquid_volume})
-
-            updated_phases[phase_name] = {"liquids": updated_liquids, "mass": phase_mass}
+                updated_liquids[new_liquid_type] = new_liquid_volume
 
-        st.session_state.phases = updated_phases
+            updated_phases[phase_name] = {"masses": updated_masses, "liquids": updated_liquids}
 
         sl_results = []
-        for phase_name, phase_data in st.session_state.phases.items():
-            phase_mass = phase_data["mass"]
-            phase_liquids = phase_data["liquids"]
-            total_liquid_volume = sum(liquid["volume"] for liquid in phase_liquids)
+        for phase_name, phase_data in updated_phases.items():
+            phase_mass, total_liquid_volume = phase_totals(phase_data)
 
-            for liquid in phase_liquids:
-                liquid_ratio = phase_mass / liquid["volume"] if liquid["volume"] > 0 else 0
+            for liquid_type, liquid_volume in phase_data["liquids"].items():
+                liquid_ratio = phase_mass / liquid_volume if liquid_volume > 0 else 0
                 sl_results.append({
                     "Phase": phase_name,
-                    "Liquid Type": liquid["type"],
+                    "Liquid Type": liquid_type,
                     "Phase Mass (kg)": phase_mass,
-                    "Liquid Volume (L)": liquid["volume"],
+                    "Liquid Volume (L)": liquid_volume,
                     "S/L Ratio": liquid_ratio
                 })
 
@@ -939,7 +4419,7 @@ def technical_kpis():
         st.table(sl_df)
 
         # Salva i dati aggiornati nello scenario corrente
-        current_scenario["technical_kpis"]["phases"] = st.session_state.phases
+        current_scenario["technical_kpis"]["phases"] = updated_phases
 
         # Aggiorna lo stato della sessione
         st.session_state.amelie_scenarios[selected_scenario] = current_scenario
@@ -949,7 +4429,7 @@ def technical_kpis():
         st.success("Solid/Liquid Ratios saved successfully!")
 
 
-def save_case_studies():
+def save_case_studies(notify=True, commit_history=True):
     try:
         for case_study_name, case_study in st.session_state.case_studies.items():
             if not isinstance(case_study, dict):
@@ -969,24 +4449,23 @@ def save_case_studies():
                 case_study.setdefault("energy_consumption", {})
                 case_study.setdefault("technical_kpis", {})  # Aggiunta dei KPI tecnici
 
-        with open(case_studies_file, "w") as file:
-            json.dump(st.session_state.case_studies, file, indent=4)
-        st.info(f"Case studies saved to {case_studies_file}")
+        journal = st.session_state.setdefault("case_studies_journal", EditJournal(case_studies_file))
+        ops = journal.record(st.session_state.case_studies)
+        # Nuova versione solo per i case studies toccati da questo salvataggio (non per gli import massivi)
+        changed_names = set()
+        if commit_history:
+            changed_names = (set(st.session_state.case_studies) if ops is None
+                             else {_pointer_parts(op["path"])[0] for op in ops})
+        for case_study_name in changed_names & set(st.session_state.case_studies):
+            st.session_state.history.commit("case_study", case_study_name,
+                                            st.session_state.case_studies[case_study_name])
+        if notify:
+            st.info(f"Case studies saved to {case_studies_file}")
     except Exception as e:
         st.error(f"Failed to save case studies: {e}")
 
 
 
-def save_amelie_scenarios():
-    try:
-        with open(amelie_scenarios_file, "w") as file:
-            json.dump(st.session_state.amelie_scenarios, file, indent=4)
-        st.success("Amelie scenarios saved successfully.")
-    except Exception as e:
-        st.error(f"Failed to save Amelie scenarios: {e}")
-
-
-
 def literature():
     st.title("Literature: Case Studies")
 
@@ -996,6 +4475,41 @@ def literature():
 
 
 
+    # Import massivo da file: un solo salvataggio per tutto il file
+    with st.expander("Bulk Import Case Studies (CSV/JSONL)"):
+        st.caption('CSV: a "name" column plus dotted columns such as capex.Reactor, opex.Labor, composition.Co, '
+                   'phases.Leach.liquids.Water; separate assumptions with "|". JSONL: one case study object '
+                   'with a "name" field per line.')
+        import_file = st.file_uploader("Case Studies File:", type=["csv", "jsonl"], key="import_case_studies_file")
+        overwrite_existing = st.checkbox("Overwrite Existing Case Studies", key="import_overwrite")
+        if import_file is not None and st.button("Import Case Studies", key="import_case_studies"):
+            import_progress = st.empty()
+            file_format = "csv" if import_file.name.lower().endswith(".csv") else "jsonl"
+            existing_names = set(st.session_state.case_studies)
+            imported_names = []
+
+            def write_import_batch(batch):
+                # I lotti validati entrano nello stato; il journal viene scritto una volta a fine import
+                st.session_state.case_studies.update(batch)
+                imported_names.extend(batch)
+
+            imported_count, import_errors = import_case_studies(
+                import_file, file_format, existing_names, write_import_batch, overwrite_existing,
+                lambda done, failed: import_progress.caption(f"{done} rows imported, {failed} rejected...")
+            )
+            import_progress.empty()
+            if imported_count:
+                # Nessuna versione per i case studies nuovi; quelli sovrascritti che hanno già
+                # uno storico ricevono la versione importata, così l'undo torna al valore precedente
+                save_case_studies(notify=False, commit_history=False)
+                for case_study_name in imported_names:
+                    if st.session_state.history.versions("case_study", case_study_name):
+                        st.session_state.history.commit("case_study", case_study_name,
+                                                        st.session_state.case_studies[case_study_name])
+            st.success(f"Imported {imported_count} case studies, rejected {len(import_errors)} rows.")
+            if import_errors:
+                st.dataframe(pd.DataFrame(import_errors, columns=["Line", "Error"]))
+
     case_study_names = list(st.session_state.case_studies.keys())
 
     col1, col2 = st.columns([4, 1])
@@ -1005,21 +4519,38 @@ def literature():
     with col2:
         if selected_case_study != "Add New Case Study" and st.button("Remove Case Study", key="remove_case_study"):
             del st.session_state.case_studies[selected_case_study]
+            st.session_state.history.forget("case_study", selected_case_study)
             save_case_studies()
             st.success(f"Case Study '{selected_case_study}' removed.")
             return
 
+    # Undo/Redo per il case study selezionato
+    if selected_case_study != "Add New Case Study":
+        history = st.session_state.history
+        undo_col, redo_col, _ = st.columns([1, 1, 3])
+        restored_case_study = None
+        with undo_col:
+            if st.button("Undo", key="undo_case_study",
+                         disabled=not history.can_undo("case_study", selected_case_study)):
+                restored_case_study = history.undo("case_study", selected_case_study)
+        with redo_col:
+            if st.button("Redo", key="redo_case_study",
+                         disabled=not history.can_redo("case_study", selected_case_study)):
+                restored_case_study = history.redo("case_study", selected_case_study)
+        if restored_case_study is not None:
+            st.session_state.case_studies[selected_case_study] = restored_case_study
+            reset_widget_state("case_study", selected_case_study)
+            save_case_studies()
+
     if selected_case_study == "Add New Case Study":
         new_case_study_name = st.text_input("New Case Study Name:")
         if st.button("Create Case Study"):
             if new_case_study_name and new_case_study_name not in st.session_state.case_studies:
-                st.session_state.case_studies[new_case_study_name] = {
-                    "assumptions": [],
-                    "capex": {},
-                    "opex": {},
-                    "energy_cost": 0.0,
-                    "energy_consumption": {}
-                }
+                new_case_study = get_default_case_study()
+                new_case_study["energy_cost"] = 0.0
+                st.session_state.case_studies[new_case_study_name] = migrate_record(
+                    new_case_study, get_default_case_study()
+                )
                 save_case_studies()
                 st.success(f"Case Study '{new_case_study_name}' created.")
 
@@ -1027,6 +4558,16 @@ def literature():
                 st.error("Invalid or duplicate case study name!")
         return
 
+    # Case studies probabilmente inseriti più volte con nomi diversi
+    duplicate_index = get_duplicate_index()
+    duplicate_threshold = st.slider("Duplicate Similarity Threshold:", min_value=0.3, max_value=1.0, value=0.7,
+                                    step=0.05, key="duplicate_threshold")
+    duplicate_pairs = duplicate_index.duplicates(duplicate_threshold)
+    if duplicate_pairs:
+        with st.expander(f"Possible Duplicates ({len(duplicate_pairs)})", expanded=False):
+            st.warning("These case studies look like the same source entered more than once.")
+            st.table(pd.DataFrame(duplicate_pairs, columns=["Case Study", "Possible Duplicate Of", "Similarity"]))
+
     st.markdown("### Case Studies")
 
     for case_study_name in st.session_state.case_studies.keys():
@@ -1050,17 +4591,17 @@ def literature():
                 col1, col2 = st.columns([4, 1])
                 with col1:
                     st.text_input(f"Edit Assumption {idx + 1}:", value=assumption,
-                                  key=f"assumption_{case_study_name}_{idx}")
+                                  key=widget_key("case_study", case_study_name, "assumption", idx))
                 with col2:
-                    if st.button("Remove", key=f"remove_assumption_{case_study_name}_{idx}"):
+                    if st.button("Remove", key=widget_key("case_study", case_study_name, "remove_assumption", idx)):
                         assumptions_to_delete.append(idx)
 
             for idx in sorted(assumptions_to_delete, reverse=True):
                 case_study["assumptions"].pop(idx)
 
             new_assumption = st.text_input(f"New Assumption for {case_study_name}:",
-                                           key=f"new_assumption_{case_study_name}")
-            if st.button(f"Add Assumption", key=f"add_assumption_{case_study_name}"):
+                                           key=widget_key("case_study", case_study_name, "new_assumption"))
+            if st.button(f"Add Assumption", key=widget_key("case_study", case_study_name, "add_assumption")):
                 if new_assumption:
                     case_study["assumptions"].append(new_assumption)
                     save_case_studies()  # Salva le modifiche
@@ -1068,6 +4609,25 @@ def literature():
                 else:
                     st.error("Assumption cannot be empty!")
 
+            # Valuta e anno dei costi, usati da Benchmarking per la normalizzazione
+            st.markdown("#### Cost Basis")
+            currency_options = list(load_cost_indices()["exchange_rates"])
+            if case_study.get("currency", "EUR") not in currency_options:
+                currency_options.append(case_study["currency"])
+            col1, col2 = st.columns(2)
+            with col1:
+                case_study["currency"] = st.selectbox(
+                    f"Currency for {case_study_name}:", currency_options,
+                    index=currency_options.index(case_study.get("currency", "EUR")),
+                    key=widget_key("case_study", case_study_name, "currency")
+                )
+            with col2:
+                case_study["cost_year"] = int(st.number_input(
+                    f"Cost Year for {case_study_name}:", min_value=1950, max_value=2100, step=1,
+                    value=int(case_study.get("cost_year", DEFAULT_COST_YEAR)),
+                    key=widget_key("case_study", case_study_name, "cost_year")
+                ))
+
             # CapEx Section
             st.markdown("#### CapEx")
             capex_to_delete = []
@@ -1075,17 +4635,18 @@ def literature():
                 col1, col2, col3 = st.columns([3, 2, 1])
                 with col1:
                     new_name = st.text_input(f"CapEx Name ({key}):", value=key,
-                                             key=f"capex_name_{case_study_name}_{key}")
+                                             key=widget_key("case_study", case_study_name, "capex_name", key))
                 with col2:
                     new_cost = st.number_input(
                         f"CapEx Cost ({key}):",
                         value=float(value),  # Converti sempre in float
                         min_value=0.0,
-                        key=f"capex_cost_{selected_scenario}_{key}"
+                        key=widget_key("case_study", case_study_name, "capex_cost", key)
                     )
 
                 with col3:
-                    if st.button(f"Remove CapEx ({key})", key=f"remove_capex_{case_study_name}_{key}"):
+                    if st.button(f"Remove CapEx ({key})",
+                                 key=widget_key("case_study", case_study_name, "remove_capex", key)):
                         capex_to_delete.append(key)
                 if new_name != key:
                     case_study["capex"][new_name] = case_study["capex"].pop(key)
@@ -1095,9 +4656,9 @@ def literature():
                 del case_study["capex"][item]
 
             new_capex_name = st.text_input(f"New CapEx Name for {case_study_name}:",
-                                           key=f"new_capex_name_{case_study_name}")
+                                           key=widget_key("case_study", case_study_name, "new_capex_name"))
             new_capex_cost = st.number_input(f"New CapEx Cost for {case_study_name}:", min_value=0.0,
-                                             key=f"new_capex_cost_{case_study_name}")
+                                             key=widget_key("case_study", case_study_name, "new_capex_cost"))
             if st.button(f"Add CapEx for {case_study_name}"):
                 if new_capex_name and new_capex_name not in case_study["capex"]:
                     case_study["capex"][new_capex_name] = new_capex_cost
@@ -1114,12 +4675,13 @@ def literature():
                     col1, col2, col3 = st.columns([3, 2, 1])
                     with col1:
                         new_name = st.text_input(f"OpEx Name ({key}):", value=key,
-                                                 key=f"opex_name_{case_study_name}_{key}")
+                                                 key=widget_key("case_study", case_study_name, "opex_name", key))
                     with col2:
                         new_cost = st.number_input(f"OpEx Cost ({key}):", value=float(value), min_value=0.0,
-                                                   key=f"opex_cost_{case_study_name}_{key}")
+                                                   key=widget_key("case_study", case_study_name, "opex_cost", key))
                     with col3:
-                        if st.button(f"Remove OpEx ({key})", key=f"remove_opex_{case_study_name}_{key}"):
+                        if st.button(f"Remove OpEx ({key})",
+                                     key=widget_key("case_study", case_study_name, "remove_opex", key)):
                             opex_to_delete.append(key)
                     if new_name != key:
                         case_study["opex"][new_name] = case_study["opex"].pop(key)
@@ -1129,9 +4691,9 @@ def literature():
                 del case_study["opex"][item]
 
             new_opex_name = st.text_input(f"New OpEx Name for {case_study_name}:",
-                                          key=f"new_opex_name_{case_study_name}")
+                                          key=widget_key("case_study", case_study_name, "new_opex_name"))
             new_opex_cost = st.number_input(f"New OpEx Cost for {case_study_name}:", min_value=0.0,
-                                            key=f"new_opex_cost_{case_study_name}")
+                                            key=widget_key("case_study", case_study_name, "new_opex_cost"))
             if st.button(f"Add OpEx for {case_study_name}"):
                 if new_opex_name and new_opex_name not in case_study["opex"]:
                     case_study["opex"][new_opex_name] = new_opex_cost
@@ -1182,7 +4744,7 @@ def literature():
                 f"Energy Cost (EUR per kWh) for {case_study_name}:",
                 value=case_study.get("energy_cost", 0.12),  # Default value if missing
                 min_value=0.0,
-                key=f"energy_cost_{case_study_name}"
+                key=widget_key("case_study", case_study_name, "energy_cost")
             )
             save_case_studies()  # Salva automaticamente al cambio del valore
 
@@ -1195,17 +4757,18 @@ def literature():
                     new_machine = st.text_input(
                         f"Machine Name ({machine}):",
                         value=machine,
-                        key=f"machine_name_{case_study_name}_{machine}"
+                        key=widget_key("case_study", case_study_name, "machine_name", machine)
                     )
                 with col2:
                     new_consumption = st.number_input(
                         f"Consumption (kWh) for {machine}:",
                         value=consumption,
                         min_value=0.0,
-                        key=f"machine_consumption_{case_study_name}_{machine}"
+                        key=widget_key("case_study", case_study_name, "machine_consumption", machine)
                     )
                 with col3:
-                    if st.button(f"Remove {machine}", key=f"remove_machine_{case_study_name}_{machine}"):
+                    if st.button(f"Remove {machine}",
+                                 key=widget_key("case_study", case_study_name, "remove_machine", machine)):
                         energy_to_delete.append(machine)
 
                 # Update the dictionary
@@ -1218,10 +4781,12 @@ def literature():
 
             # Add a new machine
             new_machine_name = st.text_input(f"New Machine Name for {case_study_name}:",
-                                             key=f"new_machine_name_{case_study_name}")
+                                             key=widget_key("case_study", case_study_name, "new_machine_name"))
             new_machine_consumption = st.number_input(f"New Machine Consumption (kWh) for {case_study_name}:",
-                                                      min_value=0.0, key=f"new_machine_consumption_{case_study_name}")
-            if st.button(f"Add Machine for {case_study_name}", key=f"add_machine_{case_study_name}"):
+                                                      min_value=0.0, key=widget_key("case_study", case_study_name,
+                                                                                    "new_machine_consumption"))
+            if st.button(f"Add Machine for {case_study_name}",
+                         key=widget_key("case_study", case_study_name, "add_machine")):
                 if new_machine_name and new_machine_name not in case_study["energy_consumption"]:
                     case_study["energy_consumption"][new_machine_name] = new_machine_consumption
                     save_case_studies()  # Salva le modifiche
@@ -1245,29 +4810,28 @@ def literature():
                 f"Total CapEx (EUR) for {case_study_name}:",
                 value=float(sum(case_study["capex"].values())),
                 min_value=0.0,
-                key=f"direct_capex_{case_study_name}"
+                key=widget_key("case_study", case_study_name, "direct_capex")
             )
             direct_opex = st.number_input(
                 f"Total OpEx (EUR) for {case_study_name}:",
                 value=float(sum(case_study["opex"].values())),
                 min_value=0.0,
-                key=f"direct_opex_{case_study_name}"
+                key=widget_key("case_study", case_study_name, "direct_opex")
             )
 
-            if st.button(f"Update Total CapEx and OpEx for {case_study_name}", key=f"update_totals_{case_study_name}"):
+            if st.button(f"Update Total CapEx and OpEx for {case_study_name}",
+                         key=widget_key("case_study", case_study_name, "update_totals")):
                 case_study["capex"] = {"Total CapEx": float(direct_capex)}
                 case_study["opex"]["Direct OpEx"] = float(direct_opex)  # Keep other OpEx like energy
                 save_case_studies()  # Salva i dati aggiornati
                 st.success("Total CapEx and OpEx updated!")
 
-            capex_chart = model.generate_pie_chart(capex_data, f"CapEx Breakdown for {case_study_name}")
-            st.image(capex_chart, caption="CapEx Breakdown", use_container_width=True)
+            model.show_pie_chart(capex_data, f"CapEx Breakdown for {case_study_name}", caption="CapEx Breakdown")
 
             capex_table = model.generate_table(capex_data)
             st.table(capex_table)
 
-            opex_chart = model.generate_pie_chart(opex_data, f"OpEx Breakdown for {case_study_name}")
-            st.image(opex_chart, caption="OpEx Breakdown", use_container_width=True)
+            model.show_pie_chart(opex_data, f"OpEx Breakdown for {case_study_name}", caption="OpEx Breakdown")
 
             opex_table = model.generate_table(opex_data)
             st.table(opex_table)
@@ -1285,7 +4849,8 @@ def literature():
 
             # Sezioni per KPI Tecnici
             sections = ["Material Composition & Efficiency", "Solid/Liquid Ratios", "Add/Modify Custom KPIs"]
-            selected_section = st.selectbox("Select Technical KPI Section:", sections)
+            selected_section = st.selectbox("Select Technical KPI Section:", sections,
+                                            key=widget_key("case_study", case_study_name, "technical_kpi_section"))
 
             # === Material Composition & Efficiency ===
             if selected_section == "Material Composition & Efficiency":
@@ -1298,27 +4863,31 @@ def literature():
                     col1, col2, col3 = st.columns([2, 1, 1])
                     with col1:
                         new_material = st.text_input(f"Edit Material Name ({material})", value=material,
-                                                     key=f"edit_material_{case_study_name}_{material}")
+                                                     key=widget_key("case_study", case_study_name,
+                                                                    "edit_material", material))
                     with col2:
                         new_percentage = st.number_input(
                             f"Percentage of {material} in BM (%)",
                             min_value=0.0,
                             max_value=100.0,
                             value=percentage,
-                            key=f"edit_percentage_{case_study_name}_{material}"
+                            key=widget_key("case_study", case_study_name, "edit_percentage", material)
                         )
                     with col3:
-                        if st.button(f"Remove {material}", key=f"remove_material_{case_study_name}_{material}"):
+                        if st.button(f"Remove {material}",
+                                     key=widget_key("case_study", case_study_name, "remove_material", material)):
                             continue
 
                     updated_composition[new_material] = new_percentage
                     total_percentage += new_percentage
 
                 # Aggiungi nuovo materiale
-                new_material_name = st.text_input("New Material Name", key=f"new_material_name_{case_study_name}")
+                new_material_name = st.text_input("New Material Name",
+                                                  key=widget_key("case_study", case_study_name, "new_material_name"))
                 new_material_percentage = st.number_input("New Material Percentage (%)", min_value=0.0, max_value=100.0,
-                                                          key=f"new_material_percentage_{case_study_name}")
-                if st.button("Add Material", key=f"add_material_{case_study_name}"):
+                                                          key=widget_key("case_study", case_study_name,
+                                                                         "new_material_percentage"))
+                if st.button("Add Material", key=widget_key("case_study", case_study_name, "add_material")):
                     if new_material_name and new_material_name not in updated_composition:
                         updated_composition[new_material_name] = new_material_percentage
                         st.success(f"Added new material: {new_material_name}")
@@ -1335,7 +4904,7 @@ def literature():
 
                 st.subheader("Efficiency Calculation")
                 total_black_mass = st.number_input("Total Black Mass (kg):", min_value=0.1, value=10.0,
-                                                   key=f"total_black_mass_{case_study_name}")
+                                                   key=widget_key("case_study", case_study_name, "total_black_mass"))
                 recovered_masses = technical_kpis.get("recovered_masses", {})
                 efficiencies = {}
                 total_recovered_mass = 0
@@ -1346,7 +4915,7 @@ def literature():
                         f"Recovered Mass of {material} (kg):",
                         min_value=0.0,
                         value=recovered_masses.get(material, 0.0),
-                        key=f"recovered_mass_{case_study_name}_{material}"
+                        key=widget_key("case_study", case_study_name, "recovered_mass", material)
                     )
                     recovered_masses[material] = recovered_mass
                     efficiency = (recovered_mass / initial_mass) * 100 if initial_mass > 0 else 0.0
@@ -1386,29 +4955,32 @@ def literature():
                         with col1:
                             new_mass_type = st.text_input(
                                 f"Mass Type ({mass_type})", value=mass_type,
-                                key=f"mass_type_{case_study_name}_{phase_name}_{mass_type}"
+                                key=widget_key("case_study", case_study_name, "mass_type", phase_name, mass_type)
                             )
                         with col2:
                             new_mass_value = st.number_input(
                                 f"Mass (kg) for {mass_type}:", min_value=0.0,
                                 value=mass_value, step=0.1,
-                                key=f"mass_value_{case_study_name}_{phase_name}_{mass_type}"
+                                key=widget_key("case_study", case_study_name, "mass_value", phase_name, mass_type)
                             )
                         with col3:
                             if st.button(f"Remove Mass ({mass_type})",
-                                         key=f"remove_mass_{case_study_name}_{phase_name}_{mass_type}"):
+                                         key=widget_key("case_study", case_study_name,
+                                                        "remove_mass", phase_name, mass_type)):
                                 continue
 
                         updated_masses[new_mass_type] = new_mass_value
 
                     # Aggiungi nuovo tipo di massa
                     new_mass_type = st.text_input(f"New Mass Type for {phase_name}:",
-                                                  key=f"new_mass_type_{case_study_name}_{phase_name}")
+                                                  key=widget_key("case_study", case_study_name,
+                                                                 "new_mass_type", phase_name))
                     new_mass_value = st.number_input(
                         f"New Mass Value (kg):", min_value=0.0, step=0.1,
-                        key=f"new_mass_value_{case_study_name}_{phase_name}"
+                        key=widget_key("case_study", case_study_name, "new_mass_value", phase_name)
                     )
-                    if st.button(f"Add Mass for {phase_name}", key=f"add_mass_{case_study_name}_{phase_name}"):
+                    if st.button(f"Add Mass for {phase_name}",
+                                 key=widget_key("case_study", case_study_name, "add_mass", phase_name)):
                         if new_mass_type and new_mass_type not in updated_masses:
                             updated_masses[new_mass_type] = new_mass_value
                             st.success(f"Added new mass type: {new_mass_type}")
@@ -1418,47 +4990,43 @@ def literature():
                     # Aggiorna le masse della fase
                     masses = updated_masses
 
-                    # Liquidi per la fase
-                    liquids = phase_data.get("liquids", {})
+                    # Liquidi per la fase (formato canonico garantito da migrate_record)
+                    liquids = phase_data["liquids"]
                     updated_liquids = {}
 
                     st.markdown("##### Liquid Types")
-                    # Verifica che `liquids` sia un dizionario
-                    if isinstance(liquids, list):
-                        liquids = {f"Liquid {i + 1}": vol for i, vol in enumerate(liquids)}
-                    elif not isinstance(liquids, dict):
-                        liquids = {}
-
-                    # Iterazione sicura
                     for liquid_type, liquid_volume in liquids.items():
 
                         col1, col2, col3 = st.columns([2, 1, 1])
                         with col1:
                             new_liquid_type = st.text_input(
                                 f"Liquid Type ({liquid_type})", value=liquid_type,
-                                key=f"liquid_type_{case_study_name}_{phase_name}_{liquid_type}"
+                                key=widget_key("case_study", case_study_name, "liquid_type", phase_name, liquid_type)
                             )
                         with col2:
                             new_liquid_volume = st.number_input(
                                 f"Volume (L) for {liquid_type}:", min_value=0.0,
                                 value=liquid_volume, step=0.1,
-                                key=f"liquid_volume_{case_study_name}_{phase_name}_{liquid_type}"
+                                key=widget_key("case_study", case_study_name, "liquid_volume", phase_name, liquid_type)
                             )
                         with col3:
                             if st.button(f"Remove Liquid ({liquid_type})",
-                                         key=f"remove_liquid_{case_study_name}_{phase_name}_{liquid_type}"):
+                                         key=widget_key("case_study", case_study_name,
+                                                        "remove_liquid", phase_name, liquid_type)):
                                 continue
 
                         updated_liquids[new_liquid_type] = new_liquid_volume
 
                     # Aggiungi nuovo tipo di liquido
                     new_liquid_type = st.text_input(f"New Liquid Type for {phase_name}:",
-                                                    key=f"new_liquid_type_{case_study_name}_{phase_name}")
+                                                    key=widget_key("case_study", case_study_name,
+                                                                   "new_liquid_type", phase_name))
                     new_liquid_volume = st.number_input(
                         f"New Liquid Volume (L):", min_value=0.0, step=0.1,
-                        key=f"new_liquid_volume_{case_study_name}_{phase_name}"
+                        key=widget_key("case_study", case_study_name, "new_liquid_volume", phase_name)
                     )
-                    if st.button(f"Add Liquid for {phase_name}", key=f"add_liquid_{case_study_name}_{phase_name}"):
+                    if st.button(f"Add Liquid for {phase_name}",
+                                 key=widget_key("case_study", case_study_name, "add_liquid", phase_name)):
                         if new_liquid_type and new_liquid_type not in updated_liquids:
                             updated_liquids[new_liquid_type] = new_liquid_volume
                             st.success(f"Added new liquid type: {new_liquid_type}")
@@ -1472,34 +5040,9 @@ def literature():
                     st.markdown("##### Solid/Liquid Ratios")
                     sl_results = []
 
-                    # Assicura che `liquids` sia un dizionario
-                    # Assicura che `liquids` sia un dizionario
-                    if isinstance(liquids, list):
-                        # Converti lista in dizionario, usando l'indice come chiave
-                        st.warning(f"'liquids' was a list. Converting to dictionary with indexed keys.")
-                        liquids = {f"Liquid {i + 1}": vol for i, vol in enumerate(liquids)}
-                    elif not isinstance(liquids, dict):
-                        # Inizializza come dizionario vuoto se non è valido
-                        st.warning(f"'liquids' was of type {type(liquids)}. Resetting to empty dictionary.")
-                        liquids = {}
-
                     # Iterazione su masse e liquidi
                     for mass_type, mass_value in masses.items():
-                        # Verifica che `liquids` sia un dizionario
-                        if isinstance(liquids, list):
-                            liquids = {f"Liquid {i + 1}": vol for i, vol in enumerate(liquids)}
-                        elif not isinstance(liquids, dict):
-                            liquids = {}
-
-                        # Iterazione sicura
                         for liquid_type, liquid_volume in liquids.items():
-
-                            # Verifica che `liquid_volume` sia numerico
-                            if not isinstance(liquid_volume, (int, float)):
-                                st.warning(
-                                    f"Invalid liquid volume for '{liquid_type}' in phase '{phase_name}'. Resetting to 0.")
-                                liquid_volume = 0  # Imposta un valore predefinito se non è numerico
-
                             # Calcola il rapporto massa/liquido
                             ratio = mass_value / liquid_volume if liquid_volume > 0 else 0
                             sl_results.append({
@@ -1511,9 +5054,11 @@ def literature():
                                 "S/L Ratio": ratio
                             })
 
+                    # Salva la fase aggiornata
+                    updated_phases[phase_name] = {"masses": masses, "liquids": liquids}
+
                     # Calcolo rapporto complessivo
-                    total_mass = sum(masses.values())
-                    total_volume = sum(liquids.values()) if liquids else 0
+                    total_mass, total_volume = phase_totals(updated_phases[phase_name])
                     overall_ratio = total_mass / total_volume if total_volume > 0 else 0
                     sl_results.append({
                         "Phase": phase_name,
@@ -1529,8 +5074,9 @@ def literature():
                     st.table(sl_df)
 
                 # Aggiungi nuova fase
-                new_phase_name = st.text_input("New Phase Name:", key=f"new_phase_name_{case_study_name}")
-                if st.button("Add Phase", key=f"add_phase_{case_study_name}"):
+                new_phase_name = st.text_input("New Phase Name:",
+                                               key=widget_key("case_study", case_study_name, "new_phase_name"))
+                if st.button("Add Phase", key=widget_key("case_study", case_study_name, "add_phase")):
                     if new_phase_name and new_phase_name not in updated_phases:
                         updated_phases[new_phase_name] = {"masses": {}, "liquids": {}}
                         st.success(f"Added new phase: {new_phase_name}")
@@ -1552,16 +5098,18 @@ def literature():
                     col1, col2, col3 = st.columns([3, 2, 1])
                     with col1:
                         new_kpi_name = st.text_input(f"Edit KPI Name ({kpi_name}):", value=kpi_name,
-                                                     key=f"custom_kpi_name_{case_study_name}_{kpi_name}")
+                                                     key=widget_key("case_study", case_study_name,
+                                                                    "custom_kpi_name", kpi_name))
                     with col2:
                         new_kpi_value = st.number_input(
                             f"Value for {kpi_name}:",
                             value=kpi_value,
                             min_value=0.0,
-                            key=f"custom_kpi_value_{case_study_name}_{kpi_name}"
+                            key=widget_key("case_study", case_study_name, "custom_kpi_value", kpi_name)
                         )
                     with col3:
-                        if st.button(f"Remove KPI ({kpi_name})", key=f"remove_custom_kpi_{case_study_name}_{kpi_name}"):
+                        if st.button(f"Remove KPI ({kpi_name})",
+                                     key=widget_key("case_study", case_study_name, "remove_custom_kpi", kpi_name)):
                             del custom_kpis[kpi_name]
 
                     # Aggiorna KPI personalizzati se modificati
@@ -1570,10 +5118,13 @@ def literature():
                     custom_kpis[new_kpi_name] = new_kpi_value
 
                 # Aggiungi nuovi KPI personalizzati
-                new_custom_kpi_name = st.text_input("New KPI Name:", key=f"new_custom_kpi_name_{case_study_name}")
+                new_custom_kpi_name = st.text_input("New KPI Name:",
+                                                    key=widget_key("case_study", case_study_name,
+                                                                   "new_custom_kpi_name"))
                 new_custom_kpi_value = st.number_input("New KPI Value:", min_value=0.0,
-                                                       key=f"new_custom_kpi_value_{case_study_name}")
-                if st.button("Add Custom KPI", key=f"add_custom_kpi_{case_study_name}"):
+                                                       key=widget_key("case_study", case_study_name,
+                                                                      "new_custom_kpi_value"))
+                if st.button("Add Custom KPI", key=widget_key("case_study", case_study_name, "add_custom_kpi")):
                     if new_custom_kpi_name and new_custom_kpi_name not in custom_kpis:
                         custom_kpis[new_custom_kpi_name] = new_custom_kpi_value
                         st.success(f"Added new custom KPI: {new_custom_kpi_name}")
@@ -1597,11 +5148,12 @@ compare_scenarios = st.sidebar.multiselect(
 
 if len(compare_scenarios) > 1:
     st.subheader("Comparison of Selected Scenarios")
+    energy_costs, capex_totals, opex_totals = st.session_state.amelie_scenarios.totals(compare_scenarios)
     comparison_data = {
         "Scenario": compare_scenarios,
-        "Energy Cost": [st.session_state.amelie_scenarios[sc]["energy_cost"] for sc in compare_scenarios],
-        "Total CapEx": [sum(st.session_state.amelie_scenarios[sc]["capex"].values()) for sc in compare_scenarios],
-        "Total OpEx": [sum(st.session_state.amelie_scenarios[sc]["opex"].values()) for sc in compare_scenarios]
+        "Energy Cost": energy_costs,
+        "Total CapEx": capex_totals,
+        "Total OpEx": opex_totals
     }
     comparison_df = pd.DataFrame(comparison_data)
     st.table(comparison_df)
@@ -1610,16 +5162,112 @@ if len(compare_scenarios) > 1:
 def benchmarking():
     st.title("Benchmarking: Unified Comparison Across Scenarios and Literature")
 
-    # Selezione delle fonti (scenari e letteratura)
+    # Selezione delle fonti (scenari e letteratura), ristretta dalla ricerca
+    benchmark_scenario_query = st.text_input(
+        "Search Scenarios:", key="benchmarking_scenario_search",
+        help='Words or prefixes, composition filters like Co>=10, used items like uses:"Malic Acid".'
+    )
+    scenario_options = list(st.session_state.amelie_scenarios.keys())
+    if benchmark_scenario_query:
+        scenario_options = get_search_index("scenario").search(benchmark_scenario_query)
     selected_scenarios = st.multiselect(
         "Select Scenarios to Compare:",
-        list(st.session_state.amelie_scenarios.keys()),
-        default=["default"],
+        scenario_options,
+        default=["default"] if "default" in scenario_options else [],
         key="benchmarking_scenarios"
     )
+
+    # Il corpus della letteratura viene letto dal formato colonnare su disco
+    corpus = open_literature_corpus(literature_data_version())
+
+    # Costi della letteratura riportati nella valuta e nell'anno di riferimento
+    cost_indices = load_cost_indices()
+    normalize_costs = st.checkbox(
+        f"Normalise Literature Costs to {cost_indices['reference_currency']} {cost_indices['reference_year']}",
+        value=True, key="normalize_literature_costs",
+        help="Converts each case study from its currency and cost year using the plant cost index (CapEx), "
+             "the price index (OpEx, energy price) and yearly exchange rates."
+    )
+    if normalize_costs:
+        normalized_costs = normalized_literature_costs(literature_data_version(),
+                                                       json.dumps(cost_indices, sort_keys=True))
+        capex_factors, opex_factors = normalized_costs.capex_factors, normalized_costs.opex_factors
+        capex_totals, opex_totals = normalized_costs.capex_totals, normalized_costs.opex_totals
+        if normalized_costs.unknown_currencies:
+            st.warning(f"No exchange rates for {', '.join(normalized_costs.unknown_currencies)}: "
+                       f"those case studies are compared at nominal values.")
+        if normalized_costs.out_of_range.any():
+            st.warning(f"Cost year outside the index table for "
+                       f"{', '.join(np.asarray(corpus.names)[normalized_costs.out_of_range][:10])}"
+                       f"{' and others' if normalized_costs.out_of_range.sum() > 10 else ''}: "
+                       f"converted with the indices of the nearest year in the table.")
+        cost_unit = cost_indices["reference_currency"]
+    else:
+        capex_factors = opex_factors = np.ones(len(corpus))
+        capex_totals, opex_totals = corpus.column("capex_total"), corpus.column("opex_total")
+        cost_unit = "nominal"
+    capex_label, opex_label = f"CapEx ({cost_unit})", f"OpEx ({cost_unit})"
+    with st.expander("Filter Literature Corpus"):
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            max_capex = st.number_input(f"Max Total CapEx ({cost_unit}, 0 = no limit):", min_value=0.0,
+                                        key="corpus_max_capex")
+        with col2:
+            max_opex = st.number_input(f"Max Total OpEx ({cost_unit}, 0 = no limit):", min_value=0.0,
+                                       key="corpus_max_opex")
+        with col3:
+            min_efficiency = st.number_input("Min Overall Efficiency (%):", min_value=0.0, max_value=100.0,
+                                             key="corpus_min_efficiency")
+
+        # Ricerca testuale e faccette sull'indice invertito dei case studies
+        case_study_index = get_search_index("case_study")
+        case_study_query = st.text_input(
+            "Search Case Studies:", key="benchmarking_case_study_search",
+            help='Words or prefixes, composition filters like Co>=10, used items like uses:"Malic Acid".'
+        )
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            facet_material = st.selectbox("Contains Material:", ["Any"] + case_study_index.materials(),
+                                          key="facet_material")
+        with col2:
+            facet_min_percentage = st.number_input("Minimum Percentage (%):", min_value=0.0, max_value=100.0,
+                                                   key="facet_min_percentage")
+        with col3:
+            facet_items = st.multiselect("Uses Items:", case_study_index.items(), key="facet_items")
+    candidate_rows = corpus.filter(
+        max_capex=max_capex or None,
+        max_opex=max_opex or None,
+        min_efficiency=min_efficiency or None,
+        capex_totals=capex_totals,
+        opex_totals=opex_totals
+    )
+    if case_study_query or facet_material != "Any" or facet_items:
+        composition_facets = [] if facet_material == "Any" else [(facet_material, ">=", facet_min_percentage)]
+        matching_names = set(case_study_index.search(case_study_query, composition_facets, facet_items))
+        candidate_rows = np.array([row for row in candidate_rows if corpus.names[row] in matching_names],
+                                  dtype=np.int64)
+    st.caption(f"{len(candidate_rows)} of {len(corpus)} literature case studies match the filters.")
+
+    # Case studies più simili allo scenario selezionato nella sidebar
+    if selected_scenario in st.session_state.amelie_scenarios and len(candidate_rows):
+        st.markdown("### Suggested Comparisons")
+        similarity_index = get_case_study_index(literature_data_version())
+        nearest_rows, distances = similarity_index.query(
+            st.session_state.amelie_scenarios.view(selected_scenario), k=5, rows=candidate_rows
+        )
+        suggested_names = [corpus.names[row] for row in nearest_rows]
+        st.table(pd.DataFrame({
+            "Case Study": suggested_names,
+            "Distance": distances,
+            capex_label: capex_totals[nearest_rows],
+            opex_label: opex_totals[nearest_rows]
+        }))
+        if st.button(f"Compare '{selected_scenario}' With Suggested Case Studies", key="compare_suggested"):
+            st.session_state.benchmarking_case_studies = suggested_names
+
     selected_case_studies = st.multiselect(
         "Select Literature Case Studies to Compare:",
-        list(st.session_state.case_studies.keys()),
+        [corpus.names[row] for row in candidate_rows],
         key="benchmarking_case_studies"
     )
 
@@ -1628,51 +5276,82 @@ def benchmarking():
 
     # Aggiungi gli scenari
     for scenario_name in selected_scenarios:
-        scenario_data = st.session_state.amelie_scenarios.get(scenario_name, {})
+        scenario_data = st.session_state.amelie_scenarios[scenario_name]  # Copia: process_source la completa
         sources.append({
             "name": scenario_name,
             "type": "Scenario",
-            "data": scenario_data
+            "data": scenario_data,
+            "model": st.session_state.amelie_scenarios.model(scenario_name)
         })
 
+    # Famiglie di processi: i centroidi sostituiscono i singoli case studies
+    with st.expander("Literature Process Clusters"):
+        n_clusters = st.number_input("Number of Clusters:", min_value=1, max_value=max(len(corpus), 1),
+                                     value=min(3, max(len(corpus), 1)), key="n_clusters")
+        compare_clusters = st.checkbox("Compare Against Cluster Centroids Instead of Case Studies",
+                                       key="compare_clusters")
+        clusters = get_process_clusters(literature_data_version(), int(n_clusters))
+        if len(corpus):
+            cluster_sizes = clusters.sizes()
+            st.dataframe(pd.DataFrame({
+                "Cluster": [clusters.label(cluster) for cluster in range(len(clusters))],
+                "Case Studies": cluster_sizes,
+                "Examples": [", ".join(corpus.names[row] for row in clusters.members(cluster)[:3])
+                             for cluster in range(len(clusters))]
+            }), hide_index=True)
+            # Membri di un cluster, una pagina alla volta
+            col1, col2 = st.columns([3, 1])
+            with col1:
+                shown_cluster = st.selectbox("Show Members of:", range(len(clusters)), format_func=clusters.label,
+                                             key="cluster_members")
+            members = clusters.members(shown_cluster)
+            page_size = 100
+            with col2:
+                member_page = st.number_input("Page:", min_value=1, max_value=max(1, -(-members.size // page_size)),
+                                              value=1, key="cluster_members_page")
+            page_rows = members[(member_page - 1) * page_size:member_page * page_size]
+            st.dataframe(pd.DataFrame({"Case Study": [corpus.names[row] for row in page_rows]}), hide_index=True)
+
+    if compare_clusters:
+        for cluster in range(len(clusters)):
+            cluster_model = clusters.centroid_model(cluster, capex_factors, opex_factors)
+            sources.append({
+                "name": clusters.label(cluster),
+                "type": "Cluster",
+                "data": cluster_model.to_dict(),
+                "model": cluster_model,
+                "rows": clusters.members(cluster)
+            })
+        selected_case_studies = []
+
     # Aggiungi i casi di letteratura
     for case_study_name in selected_case_studies:
-        case_study_data = st.session_state.case_studies.get(case_study_name, {})
+        case_study_row = corpus.index(case_study_name)
+        case_study_model = scale_model_costs(corpus.model(case_study_row),
+                                             capex_factors[case_study_row], opex_factors[case_study_row])
         sources.append({
             "name": case_study_name,
             "type": "Literature",
-            "data": case_study_data
+            "data": case_study_model.to_dict(),
+            "model": case_study_model,
+            "rows": np.array([case_study_row])
         })
 
     # Confronto dei KPI economici
     st.markdown("### Economic KPI Comparison: CapEx and OpEx")
 
-    # Raccogli i dati per CapEx e OpEx
-    economic_data_capex = []
-    economic_data_opex = []
-
-    for source in sources:
-        source_name = source["name"]
-        source_type = source["type"]
-        source_data = source["data"]
+    # Raccogli i dati per CapEx e OpEx: i totali sono riduzioni sugli array dei modelli compatti
+    source_labels = [f"{source['type']}: {source['name']}" for source in sources]
+    source_models = [source["model"] for source in sources]
 
-        # Calcolo totale CapEx
-        total_capex = sum(source_data.get("capex", {}).values())
-        economic_data_capex.append({
-            "Source": f"{source_type}: {source_name}",
-            "CapEx (EUR)": total_capex
-        })
-
-        # Calcolo totale OpEx
-        total_opex = sum(source_data.get("opex", {}).values())
-        economic_data_opex.append({
-            "Source": f"{source_type}: {source_name}",
-            "OpEx (EUR)": total_opex
-        })
-
-    # Converti i dati in DataFrame per la visualizzazione
-    capex_df = pd.DataFrame(economic_data_capex)
-    opex_df = pd.DataFrame(economic_data_opex)
+    capex_df = pd.DataFrame({
+        "Source": source_labels,
+        capex_label: [source_model.capex.total() for source_model in source_models]
+    })
+    opex_df = pd.DataFrame({
+        "Source": source_labels,
+        opex_label: [source_model.opex.total() for source_model in source_models]
+    })
 
     # Visualizza le tabelle
     st.markdown("#### CapEx Comparison Table")
@@ -1681,25 +5360,12 @@ def benchmarking():
     st.markdown("#### OpEx Comparison Table")
     st.table(opex_df)
 
-    # Visualizza il grafico per CapEx
-    st.markdown("#### CapEx Comparison Chart")
-    fig_capex, ax_capex = plt.subplots(figsize=(10, 6))
-    ax_capex.bar(capex_df["Source"], capex_df["CapEx (EUR)"], color='blue')
-    ax_capex.set_xlabel("Sources")
-    ax_capex.set_ylabel("CapEx (EUR)")
-    ax_capex.set_title("CapEx Comparison")
-    ax_capex.set_xticklabels(capex_df["Source"], rotation=45, ha="right")
-    st.pyplot(fig_capex)
-
-    # Visualizza il grafico per OpEx
-    st.markdown("#### OpEx Comparison Chart")
-    fig_opex, ax_opex = plt.subplots(figsize=(10, 6))
-    ax_opex.bar(opex_df["Source"], opex_df["OpEx (EUR)"], color='green')
-    ax_opex.set_xlabel("Sources")
-    ax_opex.set_ylabel("OpEx (EUR)")
-    ax_opex.set_title("OpEx Comparison")
-    ax_opex.set_xticklabels(opex_df["Source"], rotation=45, ha="right")
-    st.pyplot(fig_opex)
+    # Grafici di CapEx e OpEx affiancati in un'unica figura
+    st.markdown("#### CapEx and OpEx Comparison Charts")
+    show_small_multiples(source_labels, [
+        (capex_label, capex_df[capex_label], "blue"),
+        (opex_label, opex_df[opex_label], "green")
+    ], columns=2, name="capex_opex_comparison")
 
     # Confronto delle efficienze (overall e per materiale)
     st.markdown("### Efficiency Comparison: Overall and Per Material")
@@ -1742,26 +5408,148 @@ def benchmarking():
     st.markdown("#### Overall Efficiency Table")
     st.table(efficiency_df[["Source", "Overall Efficiency (%)"]])
 
-    # Visualizza un grafico a barre per l'efficienza totale
-    st.markdown("#### Overall Efficiency Chart")
-    fig_overall, ax_overall = plt.subplots(figsize=(10, 6))
-    ax_overall.bar(efficiency_df["Source"], efficiency_df["Overall Efficiency (%)"], color="purple")
-    ax_overall.set_xlabel("Sources")
-    ax_overall.set_ylabel("Overall Efficiency (%)")
-    ax_overall.set_title("Overall Efficiency Comparison")
-    ax_overall.set_xticklabels(efficiency_df["Source"], rotation=45, ha="right")
-    st.pyplot(fig_overall)
-
-    # Visualizza i grafici a barre per i materiali
-    for material in sorted(materials):
-        st.markdown(f"#### Efficiency Comparison for {material}")
-        fig_material, ax_material = plt.subplots(figsize=(10, 6))
-        ax_material.bar(efficiency_df["Source"], efficiency_df.get(material, 0), color="orange")
-        ax_material.set_xlabel("Sources")
-        ax_material.set_ylabel(f"Efficiency for {material} (%)")
-        ax_material.set_title(f"{material} Efficiency Comparison")
-        ax_material.set_xticklabels(efficiency_df["Source"], rotation=45, ha="right")
-        st.pyplot(fig_material)
+    # Efficienza totale e per materiale: un pannello per grafico, tutti nella stessa figura
+    st.markdown("#### Overall and Per-Material Efficiency Charts")
+    show_small_multiples(efficiency_df["Source"].tolist(), [
+        ("Overall Efficiency (%)", efficiency_df["Overall Efficiency (%)"], "purple")
+    ] + [(f"{material} Efficiency (%)", efficiency_df[material], "orange") for material in sorted(materials)],
+        name="efficiency_comparison")
+
+    # Impronta di carbonio: valori già calcolati per tutti gli scenari e tutto il corpus
+    st.markdown("### Carbon Footprint")
+    emission_factors = load_emission_factors()
+    all_scenario_footprints = scenario_footprints(emission_factors)
+    corpus_footprints = literature_footprints(literature_data_version(), json.dumps(emission_factors, sort_keys=True),
+                                              json.dumps(cost_indices, sort_keys=True) if normalize_costs else None)
+    footprint_rows = []
+    for source in sources:
+        if source["type"] == "Scenario":
+            position = all_scenario_footprints["names"].index(source["name"])
+            values = {key: all_scenario_footprints[key][position] for key in ("scope2", "reagents", "total", "per_kg")}
+        else:
+            # Case study o media dei case studies del cluster
+            with np.errstate(all="ignore"):
+                values = {key: np.nanmean(corpus_footprints[key][source["rows"]]) if len(source["rows"]) else np.nan
+                          for key in ("scope2", "reagents", "total", "per_kg")}
+        footprint_rows.append(values)
+    footprint_df = pd.DataFrame({
+        "Source": source_labels,
+        "Scope 2 (kg CO2e/batch)": [values["scope2"] for values in footprint_rows],
+        "Reagents (kg CO2e/batch)": [values["reagents"] for values in footprint_rows],
+        "Total (kg CO2e/batch)": [values["total"] for values in footprint_rows],
+        "kg CO2e per kg Black Mass": [values["per_kg"] for values in footprint_rows]
+    })
+    st.table(footprint_df)
+    if len(footprint_df):
+        def draw_footprint():
+            fig_footprint, ax_footprint = plt.subplots(figsize=(10, 6))
+            ax_footprint.bar(footprint_df["Source"], footprint_df["kg CO2e per kg Black Mass"], color="grey")
+            ax_footprint.set_ylabel("kg CO2e per kg Black Mass")
+            ax_footprint.set_title("Carbon Footprint Comparison")
+            ax_footprint.set_xticks(range(len(footprint_df)))
+            ax_footprint.set_xticklabels(footprint_df["Source"], rotation=45, ha="right")
+            return fig_footprint
+
+        show_figure(draw_footprint, footprint_df[["Source", "kg CO2e per kg Black Mass"]], {
+            "title": "Carbon Footprint Comparison",
+            "mark": {"type": "bar", "color": "grey", "tooltip": True},
+            "encoding": {
+                "x": {"field": "Source", "type": "nominal", "sort": None, "title": None, "axis": {"labelAngle": -45}},
+                "y": {"field": "kg CO2e per kg Black Mass", "type": "quantitative"}
+            }
+        }, name="carbon_footprint")
+
+    # Costo per kg di ogni materiale recuperato, per tutte le fonti in un'unica operazione matriciale
+    st.markdown("### Cost per kg of Recovered Material")
+    allocation_materials = sorted({material for source_model in source_models
+                                   for material in source_model.technical_kpis.get("recovered_masses", {})})
+    if not allocation_materials:
+        st.info("None of the selected sources has recovered masses to allocate costs to.")
+    else:
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            allocation_basis = st.selectbox("Allocation Key:", ["Mass", "Value", "Custom"], key="allocation_basis")
+        with col2:
+            plant_lifetime = st.number_input("Plant Lifetime (years):", min_value=1, value=10, key="plant_lifetime")
+        with col3:
+            discount_rate = st.number_input("Discount Rate (%):", min_value=0.0, value=8.0, key="discount_rate")
+        with col4:
+            batches_per_year = st.number_input("Batches per Year:", min_value=1, value=250, key="batches_per_year")
+        capex_per_batch_factor = capital_recovery_factor(discount_rate / 100, plant_lifetime) / batches_per_year
+        allocation_costs, allocation_masses = allocation_matrices(source_models, allocation_materials,
+                                                                  capex_per_batch_factor)
+
+        allocation_keys = allocation_masses
+        if allocation_basis == "Value":
+            if price_history_version() is None:
+                st.warning("No price history available: allocating by mass instead of value.")
+            else:
+                try:
+                    prices = open_price_history(price_history_version())
+                except (OSError, ValueError) as e:
+                    st.error(f"Failed to read the price history: {e}")
+                    prices = None
+                if prices is None or len(prices) == 0:
+                    st.warning("No usable price history: allocating by mass instead of value.")
+                else:
+                    # Valore recuperato ai prezzi dell'ultima data disponibile
+                    allocation_keys = allocation_masses * prices.prices_at(allocation_materials,
+                                                                           prices.date_range()[1])
+        elif allocation_basis == "Custom":
+            weight_columns = st.columns(min(len(allocation_materials), 4))
+            weights = np.array([
+                weight_columns[i % len(weight_columns)].number_input(
+                    f"Weight for {material}:", min_value=0.0, value=1.0, key=f"allocation_weight_{material}"
+                )
+                for i, material in enumerate(allocation_materials)
+            ])
+            allocation_keys = (allocation_masses > 0) * weights
+
+        mass_fallback = (allocation_keys.sum(axis=1) <= 0) & (allocation_masses.sum(axis=1) > 0)
+        if allocation_basis != "Mass" and mass_fallback.any():
+            st.warning(f"No {allocation_basis.lower()} key for the recovered materials of "
+                       f"{', '.join(np.asarray(source_labels)[mass_fallback])}: allocated by mass instead.")
+        allocation, cost_per_kg = allocate_costs(allocation_costs, allocation_masses, allocation_keys)
+        st.caption(f"Annualised CapEx per batch = CapEx x {capex_per_batch_factor:.6f} "
+                   f"(capital recovery factor / batches per year).")
+        st.table(pd.DataFrame(cost_per_kg, index=source_labels,
+                              columns=[f"{material} (EUR/kg)" for material in allocation_materials]))
+
+        bar_labels = [f"{label}\n{material}" for label in source_labels for material in allocation_materials]
+
+        def draw_allocation():
+            fig_allocation, ax_allocation = plt.subplots(figsize=(10, 6))
+            bottom = np.zeros(len(bar_labels))
+            for category, color in zip(range(len(ALLOCATION_CATEGORIES)), ["green", "orange", "blue"]):
+                category_values = allocation[:, category, :].ravel()
+                ax_allocation.bar(bar_labels, category_values, bottom=bottom, color=color,
+                                  label=ALLOCATION_CATEGORIES[category])
+                bottom += category_values
+            ax_allocation.set_ylabel("Allocated Cost (EUR per batch)")
+            ax_allocation.set_title("Cost Allocation to Recovered Materials")
+            ax_allocation.set_xticks(range(len(bar_labels)))
+            ax_allocation.set_xticklabels(bar_labels, rotation=45, ha="right")
+            ax_allocation.legend()
+            return fig_allocation
+
+        # allocation: fonti x categorie x materiali -> una riga per barra e categoria
+        allocation_frame = pd.DataFrame({
+            "Source": np.repeat(source_labels, len(ALLOCATION_CATEGORIES) * len(allocation_materials)),
+            "Category": np.tile(np.repeat(ALLOCATION_CATEGORIES, len(allocation_materials)), len(source_labels)),
+            "Material": np.tile(allocation_materials, len(source_labels) * len(ALLOCATION_CATEGORIES)),
+            "Allocated Cost (EUR per batch)": allocation.ravel()
+        })
+        show_figure(draw_allocation, allocation_frame, {
+            "title": "Cost Allocation to Recovered Materials",
+            "mark": {"type": "bar", "tooltip": True},
+            "encoding": {
+                "x": {"field": "Source", "type": "nominal", "sort": None, "title": None, "axis": {"labelAngle": -45}},
+                "xOffset": {"field": "Material", "type": "nominal"},
+                "y": {"field": "Allocated Cost (EUR per batch)", "type": "quantitative", "stack": "zero"},
+                "color": {"field": "Category", "type": "nominal",
+                          "scale": {"domain": list(ALLOCATION_CATEGORIES), "range": ["green", "orange", "blue"]}}
+            }
+        }, name="cost_allocation")
 
     # Confronto massa/volume per fase
     st.markdown("### Solid/Liquid Ratios Comparison: Per Phase and Overall")
@@ -1777,18 +5565,15 @@ def benchmarking():
 
         # Recupera le fasi
         phases = source_data.get("technical_kpis", {}).get("phases", {})
+        total_mass = 0.0
+        total_volume = 0.0
         for phase_name, phase_info in phases.items():
-            phase_mass = phase_info.get("mass", 0)
-            liquids = phase_info.get("liquids", [])
-
-            if not isinstance(liquids, list):  # Assicurati che i liquidi siano una lista
-                st.warning(f"Invalid data format for liquids in phase '{phase_name}' from source '{source_name}'.")
-                liquids = []
+            phase_mass, phase_volume = phase_totals(phase_info)
+            total_mass += phase_mass
+            total_volume += phase_volume
 
             # Itera sui liquidi per calcolare e raccogliere i dati
-            for liquid in liquids:
-                liquid_type = liquid.get("type", "Unknown")
-                liquid_volume = liquid.get("volume", 0)
+            for liquid_type, liquid_volume in phase_info["liquids"].items():
                 sl_ratio = phase_mass / liquid_volume if liquid_volume > 0 else 0
 
                 phase_data.append({
@@ -1801,11 +5586,6 @@ def benchmarking():
                 })
 
         # Calcolo complessivo per la fonte
-        total_mass = sum(phase_info.get("mass", 0) for phase_info in phases.values())
-        total_volume = sum(
-            sum(liquid.get("volume", 0) for liquid in phase_info.get("liquids", []))
-            for phase_info in phases.values()
-        )
         overall_sl_ratio = total_mass / total_volume if total_volume > 0 else 0
 
         overall_data.append({
@@ -1837,35 +5617,13 @@ def benchmarking():
     st.markdown("#### Overall Solid/Liquid Ratios Table")
     st.table(overall_df)
 
-    # Grafico comparativo per le masse complessive
-    st.markdown("#### Total Mass Comparison")
-    fig_mass, ax_mass = plt.subplots(figsize=(10, 6))
-    ax_mass.bar(overall_df["Source"], overall_df["Total Mass (kg)"], color="blue")
-    ax_mass.set_xlabel("Sources")
-    ax_mass.set_ylabel("Total Mass (kg)")
-    ax_mass.set_title("Total Mass Comparison")
-    ax_mass.set_xticklabels(overall_df["Source"], rotation=45, ha="right")
-    st.pyplot(fig_mass)
-
-    # Grafico comparativo per i volumi complessivi
-    st.markdown("#### Total Volume Comparison")
-    fig_volume, ax_volume = plt.subplots(figsize=(10, 6))
-    ax_volume.bar(overall_df["Source"], overall_df["Total Volume (L)"], color="green")
-    ax_volume.set_xlabel("Sources")
-    ax_volume.set_ylabel("Total Volume (L)")
-    ax_volume.set_title("Total Volume Comparison")
-    ax_volume.set_xticklabels(overall_df["Source"], rotation=45, ha="right")
-    st.pyplot(fig_volume)
-
-    # Grafico comparativo per il rapporto S/L complessivo
-    st.markdown("#### Overall S/L Ratio Comparison")
-    fig_sl_ratio, ax_sl_ratio = plt.subplots(figsize=(10, 6))
-    ax_sl_ratio.bar(overall_df["Source"], overall_df["Overall S/L Ratio"], color="purple")
-    ax_sl_ratio.set_xlabel("Sources")
-    ax_sl_ratio.set_ylabel("Overall S/L Ratio")
-    ax_sl_ratio.set_title("Overall S/L Ratio Comparison")
-    ax_sl_ratio.set_xticklabels(overall_df["Source"], rotation=45, ha="right")
-    st.pyplot(fig_sl_ratio)
+    # Massa, volume e rapporto S/L complessivi in un'unica figura
+    st.markdown("#### Total Mass, Volume and S/L Ratio Comparison")
+    show_small_multiples(overall_df["Source"].tolist(), [
+        ("Total Mass (kg)", overall_df["Total Mass (kg)"], "blue"),
+        ("Total Volume (L)", overall_df["Total Volume (L)"], "green"),
+        ("Overall S/L Ratio", overall_df["Overall S/L Ratio"], "purple")
+    ], name="mass_volume_comparison")
 
     # Aggregazione dei dati
     all_data = []  # Per combinare KPI economici
@@ -1887,20 +5645,11 @@ def benchmarking():
 
         # Processa i dati relativi al rapporto massa/volume per ogni fase
         for phase_name, phase_data in phases.items():
-            # Recupera la massa totale per la fase
-            total_mass = phase_data.get("mass", 0)
-
-            # Recupera i dati sui liquidi
-            liquids = phase_data.get("liquids", [])
-            if not isinstance(liquids, list):  # Gestisce eventuali errori di formato
-                st.warning(f"Invalid data format for liquids in phase '{phase_name}' from source '{source_name}'.")
-                liquids = []
+            # Recupera massa e volume totali per la fase
+            total_mass, total_volume = phase_totals(phase_data)
 
             # Itera sui liquidi per calcolare il rapporto massa/volume
-            for liquid in liquids:
-                liquid_type = liquid.get("type", "Unknown")
-                liquid_volume = liquid.get("volume", 0)
-
+            for liquid_type, liquid_volume in phase_data["liquids"].items():
                 # Calcolo del rapporto massa/volume
                 sl_ratio = total_mass / liquid_volume if liquid_volume > 0 else 0
 
@@ -1915,7 +5664,6 @@ def benchmarking():
                 })
 
             # Calcolo complessivo per la fase
-            total_volume = sum(liquid.get("volume", 0) for liquid in liquids)
             overall_ratio = total_mass / total_volume if total_volume > 0 else 0
 
             # Aggiungi i dati complessivi della fase
@@ -1934,6 +5682,9 @@ def benchmarking():
     # Visualizzazione dei rapporti massa/volume
     st.markdown("### Comparison of Mass/Volume Ratios")
 
+    # Memorizza i dati per il confronto
+    scenario_data = {}
+
     if mass_volume_ratios:
         # Converte i dati in DataFrame per il confronto
         mass_volume_df = pd.DataFrame(mass_volume_ratios)
@@ -1944,9 +5695,6 @@ def benchmarking():
         # Crea colonne per disporre le tabelle affiancate
         cols = st.columns(len(unique_sources))
 
-        # Memorizza i dati per il confronto
-        scenario_data = {}
-
         # Per ogni colonna (scenario)
         for idx, source in enumerate(unique_sources):
             with cols[idx]:
@@ -1981,63 +5729,6 @@ def benchmarking():
                         'avg_ratio': source_data_sorted['S/L Ratio'].mean()
                     }
 
-        # Confronto tra scenari
-        if len(scenario_data) > 1:
-            st.markdown("### Scenario Comparison")
-            comparison_data = []
-            base_scenario = list(scenario_data.keys())[0]
-
-            for scenario in scenario_data.keys():
-                if scenario != base_scenario:
-                    diff_mass = ((scenario_data[scenario]['total_mass'] /
-                                  scenario_data[base_scenario]['total_mass'] - 1) * 100)
-                    diff_volume = ((scenario_data[scenario]['total_volume'] /
-                                    scenario_data[base_scenario]['total_volume'] - 1) * 100)
-                    diff_ratio = ((scenario_data[scenario]['avg_ratio'] /
-                                   scenario_data[base_scenario]['avg_ratio'] - 1) * 100)
-
-                    comparison_data.append({
-                        'Comparison': f'{scenario} vs {base_scenario}',
-                        'Mass Difference (%)': f"{diff_mass:.2f}%",
-                        'Volume Difference (%)': f"{diff_volume:.2f}%",
-                        'S/L Ratio Difference (%)': f"{diff_ratio:.2f}%"
-                    })
-
-            if comparison_data:
-                comparison_df = pd.DataFrame(comparison_data)
-                st.table(comparison_df)
-
-        # Confronto tra scenari
-        st.markdown("### Scenario Comparison")
-
-        if len(scenario_data) > 1:
-            comparison_cols = st.columns(1)
-            with comparison_cols[0]:
-                # Crea DataFrame per il confronto
-                comparison_data = []
-                base_scenario = list(scenario_data.keys())[0]
-
-                for scenario in scenario_data.keys():
-                    if scenario != base_scenario:
-                        diff_mass = ((scenario_data[scenario]['total_mass'] /
-                                      scenario_data[base_scenario]['total_mass'] - 1) * 100)
-                        diff_volume = ((scenario_data[scenario]['total_volume'] /
-                                        scenario_data[base_scenario]['total_volume'] - 1) * 100)
-                        diff_ratio = ((scenario_data[scenario]['avg_ratio'] /
-                                       scenario_data[base_scenario]['avg_ratio'] - 1) * 100)
-
-                        comparison_data.append({
-                            'Comparison': f'{scenario} vs {base_scenario}',
-                            'Mass Difference (%)': f"{diff_mass:.2f}%",
-                            'Volume Difference (%)': f"{diff_volume:.2f}%",
-                            'S/L Ratio Difference (%)': f"{diff_ratio:.2f}%"
-                        })
-
-                if comparison_data:
-                    comparison_df = pd.DataFrame(comparison_data)
-                    st.table(comparison_df)
-
-
         # Visualizzazione Grafica
         st.markdown("### Graphical Representation of Mass/Volume Ratios")
 
@@ -2068,7 +5759,66 @@ def benchmarking():
 
         ax.set_title("Mass/Volume Ratios by Phase and Liquid")
         ax.legend(loc="upper right", bbox_to_anchor=(1.3, 1))
-        st.pyplot(fig)
+        show_chart(fig)
+
+    # Confronto a coppie tra tutte le fonti: una matrice N x N per ogni metrica
+    st.markdown("### Scenario Comparison")
+    if len(sources) > 1:
+        comparison_values = np.column_stack([
+            capex_df[capex_label].to_numpy(dtype=np.float64),
+            opex_df[opex_label].to_numpy(dtype=np.float64),
+            efficiency_df["Overall Efficiency (%)"].to_numpy(dtype=np.float64),
+            overall_df["Total Mass (kg)"].to_numpy(dtype=np.float64),
+            overall_df["Total Volume (L)"].to_numpy(dtype=np.float64),
+            [scenario_data.get(label, {}).get("avg_ratio", 0.0) for label in source_labels]
+        ])
+        differences = pairwise_relative_differences(comparison_values)
+        metric_labels = dict(zip(PAIRWISE_METRICS, (capex_label, opex_label) + PAIRWISE_METRICS[2:]))
+        comparison_metric = st.selectbox("Comparison Metric:", PAIRWISE_METRICS, format_func=metric_labels.get,
+                                         key="pairwise_metric")
+        metric_label = metric_labels[comparison_metric]
+        metric_differences = differences[PAIRWISE_METRICS.index(comparison_metric)]
+        st.caption("Each cell is the row source relative to the column source, in %. "
+                   "Empty cells: the column source has a zero value.")
+
+        finite = metric_differences[np.isfinite(metric_differences)]
+        limit = float(np.percentile(np.abs(finite), 95)) if finite.size else 1.0
+
+        def draw_pairwise():
+            fig_pairwise, ax_pairwise = plt.subplots(figsize=(max(6, 0.4 * len(sources) + 3),) * 2)
+            image = ax_pairwise.imshow(np.ma.masked_invalid(metric_differences), cmap="RdBu_r",
+                                       vmin=-(limit or 1.0), vmax=limit or 1.0)
+            fig_pairwise.colorbar(image, ax=ax_pairwise, label=f"{metric_label} difference (%)")
+            if len(sources) <= 40:
+                ax_pairwise.set_xticks(range(len(sources)))
+                ax_pairwise.set_yticks(range(len(sources)))
+                ax_pairwise.set_xticklabels(source_labels, rotation=90)
+                ax_pairwise.set_yticklabels(source_labels)
+            if len(sources) <= 12:
+                for (row, column), value in np.ndenumerate(metric_differences):
+                    if np.isfinite(value):
+                        ax_pairwise.text(column, row, f"{value:.0f}", ha="center", va="center", fontsize=8)
+            ax_pairwise.set_title(f"Pairwise {metric_label} Differences")
+            return fig_pairwise
+
+        pairwise_frame = pd.DataFrame({
+            "Row": np.repeat(source_labels, len(source_labels)),
+            "Column": np.tile(source_labels, len(source_labels)),
+            "Difference (%)": np.where(np.isfinite(metric_differences), metric_differences, None).ravel()
+        })
+        show_figure(draw_pairwise, pairwise_frame, {
+            "title": f"Pairwise {metric_label} Differences",
+            "mark": {"type": "rect", "tooltip": True},
+            "encoding": {
+                "x": {"field": "Column", "type": "nominal", "sort": None, "title": None},
+                "y": {"field": "Row", "type": "nominal", "sort": None, "title": None},
+                "color": {"field": "Difference (%)", "type": "quantitative",
+                          "scale": {"scheme": "redblue", "reverse": True, "domain": [-(limit or 1.0), limit or 1.0],
+                                    "clamp": True}}
+            }
+        }, name=f"pairwise_{comparison_metric}")
+
+        st.dataframe(pd.DataFrame(metric_differences, index=source_labels, columns=source_labels))
 
 
 if page == "Economic KPIs":
@@ -2080,6 +5830,15 @@ elif page == "Literature":
 elif page == "Benchmarking":
     benchmarking()
 
+# Byte dei grafici inviati per pagina, per calibrare la politica dei grafici
+st.session_state.setdefault("chart_payload", {})[page] = dict(chart_payload)
+chart_payload_report.caption(
+    f"Charts on this page: {chart_payload['charts']} ({chart_payload['bytes'] / 1024:.0f} kB, " + (
+        "Vega-Lite specs)" if chart_policy["renderer"] == "vega-lite"
+        else f"{chart_policy['format'].upper()}, max {chart_policy['max_dpi']} dpi)"
+    )
+)
+
 
 
 
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    """
+    Importa l'app in modalità bare di Streamlit da una cartella temporanea:
+    l'import esegue lo script e crea data/ nella cartella corrente.
+    """
+    working_dir = tmp_path_factory.mktemp("app")
+    previous_dir = os.getcwd()
+    os.chdir(working_dir)
+    sys.path.insert(0, ROOT)
+    try:
+        import amelie_iterative_app
+        yield amelie_iterative_app
+    finally:
+        sys.path.remove(ROOT)
+        os.chdir(previous_dir)
+
+
+@pytest.fixture
+def corpus(app, tmp_path):
+    """Piccolo corpus della letteratura scritto in una cartella temporanea."""
+    case_studies = {
+        "Paper A": {"capex": {"Reactor": 300.0, "Filter": 100.0}, "opex": {"Labor": 60.0, "Acid": 40.0},
+                    "technical_kpis": {"composition": {"Co": 20.0, "Li": 5.0},
+                                       "phases": {"Leach": {"masses": {"BM": 5}, "liquids": {"Water": 10}}}}},
+        "Paper B": {"capex": {"Reactor": 50.0}, "opex": {"Labor": 10.0},
+                    "technical_kpis": {"composition": {"Ni": 30.0}}}
+    }
+    directory = str(tmp_path / "corpus")
+    app.write_literature_corpus(case_studies, directory)
+    return app.LiteratureCorpus(directory)
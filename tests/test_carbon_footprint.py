@@ -0,0 +1,31 @@
+import numpy as np
+
+
+FACTORS = {"electricity": 0.5, "liquids": {"Malic Acid": 2.0, "Water": 0.001},
+           "opex_spend": {"Malic Acid": 0.5, "Disposal": 0.4}}
+
+
+def test_footprints_of_several_records(app):
+    footprints = app.carbon_footprints(
+        energy_kwh=[10.0, 0.0],
+        liquids=np.array([[1.0, 1000.0], [0.0, 0.0]]), liquid_names=["Malic Acid", "Water"],
+        # "malic acid" è già contato dal volume: la spesa OpEx non si somma
+        opex=np.array([[100.0, 10.0], [0.0, 5.0]]), opex_names=["malic acid", "Disposal"],
+        black_mass=[5.0, 0.0], factors=FACTORS
+    )
+    np.testing.assert_allclose(footprints["scope2"], [5.0, 0.0])
+    np.testing.assert_allclose(footprints["reagents"], [2.0 + 1.0 + 4.0, 2.0])
+    np.testing.assert_allclose(footprints["total"], [12.0, 2.0])
+    assert footprints["per_kg"][0] == 12.0 / 5.0 and np.isnan(footprints["per_kg"][1])
+
+
+def test_electricity_intensity_per_record_replaces_the_flat_factor(app):
+    footprints = app.carbon_footprints([10.0, 10.0], np.zeros((2, 0)), [], np.zeros((2, 0)), [], [1.0, 1.0],
+                                       FACTORS, electricity_intensity=np.array([0.1, 0.3]))
+    np.testing.assert_allclose(footprints["scope2"], [1.0, 3.0])
+
+
+def test_black_mass_prefers_the_declared_total(app):
+    phases = {"Leach": {"masses": {"BM": 4.0}, "liquids": {}}, "Wash": {"masses": {"BM": 1.0}, "liquids": {}}}
+    assert app.record_black_mass({"phases": phases}) == 5.0
+    assert app.record_black_mass({"phases": phases, "total_black_mass": 8.0}) == 8.0
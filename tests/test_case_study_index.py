@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+
+
+def test_vectorize_matches_the_corpus_rows(app, corpus):
+    index = app.CaseStudyIndex(corpus)
+    record = {"capex": {"Reactor": 300.0, "Filter": 100.0}, "opex": {"Labor": 60.0, "Acid": 40.0},
+              "technical_kpis": {"composition": {"Co": 20.0, "Li": 5.0},
+                                 "phases": {"Leach": {"masses": {"BM": 5.0}, "liquids": {"Water": 10.0}}}}}
+    np.testing.assert_allclose(index.vectorize(record), index.features[corpus._index["Paper A"]], rtol=1e-6)
+
+
+def test_vectorize_shares_use_the_full_record_totals(app, corpus):
+    index = app.CaseStudyIndex(corpus)
+    # "Dryer" non è nel corpus ma conta nel totale CapEx del record
+    vector = index.vectorize({"capex": {"Reactor": 50.0, "Dryer": 50.0}, "opex": {}, "technical_kpis": {}})
+    reactor_column = len(index._columns["composition"]) + index._columns["capex"]["Reactor"]
+    assert vector[reactor_column] == pytest.approx(0.5)
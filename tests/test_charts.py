@@ -0,0 +1,72 @@
+import matplotlib.pyplot as plt
+
+
+def test_small_multiples_draws_one_panel_per_metric(app):
+    panels = [("CapEx", [1.0, 2.0], "blue"), ("OpEx", [3.0, 4.0], "green"), ("Li", [0.5, 0.0], "orange"),
+              ("Co", [0.2, 0.1], "purple")]
+    fig = app.small_multiples(["Scenario", "Paper A"], panels, columns=3)
+    try:
+        axes = fig.axes
+        assert len(axes) == 6
+        assert [ax.get_title() for ax in axes[:4]] == ["CapEx", "OpEx", "Li", "Co"]
+        assert not any(ax.get_visible() for ax in axes[4:])
+        # Etichette delle fonti solo sotto l'ultimo pannello di ogni colonna: il primo ha "Co" sotto di sé
+        labelled = [any(label.get_text() for label in ax.get_xticklabels()) for ax in axes[:4]]
+        assert labelled == [False, True, True, True]
+        assert [bar.get_height() for bar in axes[1].patches] == [3.0, 4.0]
+    finally:
+        plt.close(fig)
+
+
+def png_size(payload):
+    # Larghezza e altezza dall'header IHDR del PNG
+    return int.from_bytes(payload[16:20], "big"), int.from_bytes(payload[20:24], "big")
+
+
+def large_figure():
+    fig, ax = plt.subplots(figsize=(20, 10))
+    ax.plot([0, 1], [0, 1])
+    return fig
+
+
+def test_render_chart_caps_width_and_pixels(app):
+    policy = {**app.DEFAULT_CHART_POLICY, "max_dpi": 100, "max_width": 800, "max_pixels": 10_000_000}
+    width, height = png_size(app.render_chart(large_figure(), policy))
+    assert width <= 801 and height < width
+
+    policy = {**policy, "max_width": 10_000, "max_pixels": 200_000}
+    width, height = png_size(app.render_chart(large_figure(), policy))
+    assert width * height <= 200_000 * 1.01
+
+
+def test_render_chart_formats_and_payload_accounting(app):
+    before = dict(app.chart_payload)
+    svg = app.render_chart(large_figure(), {**app.DEFAULT_CHART_POLICY, "format": "svg"})
+    webp = app.render_chart(large_figure(), {**app.DEFAULT_CHART_POLICY, "format": "webp"})
+    assert svg.lstrip().startswith("<?xml") and "<svg" in svg
+    assert webp.startswith("data:image/webp;base64,")
+    assert app.chart_payload["charts"] == before["charts"] + 2
+    assert app.chart_payload["bytes"] == before["bytes"] + len(svg) + len(webp)
+    assert not plt.get_fignums()  # Le figure vengono chiuse
+
+
+def test_show_figure_draws_lazily_in_vega_lite_mode(app, monkeypatch):
+    drawn = []
+
+    def draw():
+        drawn.append(True)
+        return large_figure()
+
+    frame, spec = app.line_spec(app.pd.DataFrame({"x": [0, 1], "y": [1, 2]}), "x", ["y"], "Value")
+    monkeypatch.setattr(app, "chart_policy", {**app.DEFAULT_CHART_POLICY, "renderer": "vega-lite"})
+    monkeypatch.setattr(app, "chart_names", {})
+    before = dict(app.chart_payload)
+    app.show_figure(draw, frame, spec, name="margin")
+    app.show_figure(draw, frame, spec, name="margin")  # Stesso nome nella stessa esecuzione
+    assert drawn == []
+    assert app.chart_names == {"margin": 2}
+    assert app.chart_payload["charts"] == before["charts"] + 2
+
+    monkeypatch.setattr(app, "chart_policy", app.DEFAULT_CHART_POLICY)
+    app.show_figure(draw, frame, spec, name="margin")
+    assert drawn == [True]
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+
+def test_allocation_by_keys_with_mass_fallback(app):
+    costs = np.array([[10.0, 2.0, 8.0], [6.0, 0.0, 0.0]])
+    masses = np.array([[1.0, 3.0], [2.0, 2.0]])
+    # Il secondo record non ha chiavi (materiali senza prezzo): ripartito per massa
+    keys = np.array([[3.0, 1.0], [0.0, 0.0]])
+    allocation, cost_per_kg = app.allocate_costs(costs, masses, keys)
+
+    np.testing.assert_allclose(allocation.sum(axis=(1, 2)), costs.sum(axis=1))
+    np.testing.assert_allclose(cost_per_kg, [[15.0, 5.0 / 3.0], [1.5, 1.5]])
+
+
+def test_allocation_leaves_cost_per_kg_undefined_without_mass(app):
+    _, cost_per_kg = app.allocate_costs(np.array([[4.0, 0.0, 0.0]]), np.array([[2.0, 0.0]]),
+                                        np.array([[1.0, 0.0]]))
+    assert cost_per_kg[0, 0] == pytest.approx(2.0)
+    assert np.isnan(cost_per_kg[0, 1])
+
+
+def test_capital_recovery_factor(app):
+    assert app.capital_recovery_factor(0.0, 10) == pytest.approx(0.1)
+    assert app.capital_recovery_factor(0.08, 10) == pytest.approx(0.149029, rel=1e-5)
+    assert app.capital_recovery_factor(0.08, 0) == 1.0
@@ -0,0 +1,22 @@
+import numpy as np
+
+
+def test_cost_normalizer_interpolates_between_known_years(app):
+    normalizer = app.CostNormalizer({
+        "reference_currency": "EUR", "reference_year": 2020,
+        "plant_cost_index": {"2015": 500.0, "2020": 600.0},
+        "price_index": {"2015": 100.0, "2020": 110.0},
+        "exchange_rates": {"EUR": {}, "USD": {"2016": 1.0, "2020": 1.2}}
+    })
+    capex, opex = normalizer.factors(["EUR", "EUR", "USD", "XYZ"], [2020, 2017, 2018, 2020])
+    np.testing.assert_allclose(capex[:3], [1.0, 600.0 / 540.0, 600.0 / 560.0 / 1.1])
+    np.testing.assert_allclose(opex[:3], [1.0, 110.0 / 104.0, 110.0 / 106.0 / 1.1])
+    assert np.isnan(capex[3]) and np.isnan(opex[3])
+    np.testing.assert_array_equal(normalizer.out_of_range(["EUR", "USD", "USD"], [2014, 2015, 2018]),
+                                  [True, True, False])
+
+
+def test_default_table_is_neutral_at_the_reference_year(app):
+    normalizer = app.CostNormalizer(app.DEFAULT_COST_INDICES)
+    capex, opex = normalizer.factors(["EUR"], [app.DEFAULT_COST_YEAR])
+    np.testing.assert_allclose([capex[0], opex[0]], [1.0, 1.0])
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+
+def test_hourly_load_spreads_each_machine_over_its_running_hours(app):
+    schedule = {"batch_start_hours": [8], "operating_days": "Weekdays",
+                "machines": {"Reactor": {"offset": 0, "duration": 2}, "Dryer": {"offset": 3, "duration": 1}}}
+    load, batches = app.hourly_load({"Reactor": 10.0, "Dryer": 4.0}, schedule)
+
+    assert batches == 261  # Giorni feriali di un anno di 365 giorni che inizia di lunedì
+    assert load.sum() == pytest.approx(261 * 14.0)
+    np.testing.assert_allclose(load[8:12], [5.0, 5.0, 0.0, 4.0])
+    assert load[5 * 24 + 8] == 0.0  # Sabato
+
+
+def test_every_day_schedule_wraps_around_the_year(app):
+    schedule = {"batch_start_hours": [23], "operating_days": "Every Day",
+                "machines": {"Reactor": {"offset": 0, "duration": 2}}}
+    load, batches = app.hourly_load({"Reactor": 2.0}, schedule)
+    assert batches == 365
+    assert load[0] == 1.0 and load[-1] == 1.0
+
+
+def test_effective_price_uses_the_default_bands_of_the_scenario_price(app):
+    schedule = {"batch_start_hours": [8], "operating_days": "Weekdays",
+                "machines": {"Reactor": {"offset": 0, "duration": 1}, "Dryer": {"offset": 15, "duration": 1}}}
+    consumption = {"Reactor": 10.0, "Dryer": 10.0}
+    peak, off_peak = app.DEFAULT_TOU_MULTIPLIERS["peak"], app.DEFAULT_TOU_MULTIPLIERS["off_peak"]
+    assert app.effective_energy_price(consumption, 0.2, schedule) == pytest.approx(0.2 * (peak + off_peak) / 2)
+    assert app.effective_energy_price(consumption, 0.2) == 0.2
+
+
+def test_absolute_tariff_ignores_the_scenario_price(app):
+    tariff = app.HourlyTariff(np.full(app.HOURS_PER_YEAR, 0.1), np.full(app.HOURS_PER_YEAR, 0.3))
+    loads = np.zeros((2, app.HOURS_PER_YEAR))
+    loads[:, 0] = 10.0
+    costs, emissions = tariff.annual(loads, np.array([0.2, 0.5]))
+    np.testing.assert_allclose(costs, [1.0, 1.0])
+    np.testing.assert_allclose(emissions, [3.0, 3.0])
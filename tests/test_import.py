@@ -0,0 +1,70 @@
+import io
+import json
+
+import pytest
+
+
+def test_parse_row_normalises_the_record(app):
+    name, record = app.parse_case_study_row({
+        "name": " Paper A ", "capex": {"Reactor": "300"}, "currency": "usd", "cost_year": 2019,
+        "technical_kpis": {"composition": {"Co": 20}, "efficiency": "95", "total_black_mass": 10}
+    })
+    assert name == "Paper A"
+    assert record["capex"] == {"Reactor": 300.0}
+    assert record["currency"] == "USD" and record["cost_year"] == 2019
+    assert record["technical_kpis"]["efficiency"] == 95.0
+    assert record["technical_kpis"]["total_black_mass"] == 10.0
+    assert record["schema_version"] == app.SCHEMA_VERSION
+
+
+@pytest.mark.parametrize("row, message", [
+    ({"capex": {}}, "missing case study name"),
+    ({"name": "A", "colour": "red"}, "unknown fields: colour"),
+    ({"name": "A", "opex": {"Labor": "many"}}, "opex.Labor: 'many' is not a number"),
+    ({"name": "A", "capex": {"Reactor": -1}}, "capex.Reactor: must be a non-negative number"),
+    ({"name": "A", "currency": "euro"}, "not a three-letter currency code"),
+    ({"name": "A", "cost_year": 1800}, "is not a valid year"),
+    ({"name": "A", "technical_kpis": {"efficiency": 120}}, "efficiency: must be between 0 and 100"),
+    ({"name": "A", "technical_kpis": {"total_black_mass": "x"}}, "total_black_mass: 'x' is not a number"),
+])
+def test_parse_row_rejects_invalid_values(app, row, message):
+    with pytest.raises(ValueError, match=message):
+        app.parse_case_study_row(row)
+
+
+def test_import_reports_errors_per_line(app):
+    lines = [
+        {"name": "A", "capex": {"Reactor": 1}},
+        "not json",
+        {"name": "A"},
+        {"name": "Existing"},
+        [1, 2],
+        {"name": "B", "opex": {"Labor": "x"}},
+        {"name": "C"},
+    ]
+    data = "\n".join(line if isinstance(line, str) else json.dumps(line) for line in lines).encode("utf-8")
+    batches = []
+    count, errors = app.import_case_studies(io.BytesIO(data), "jsonl", {"Existing"}, batches.append)
+
+    assert count == 2
+    assert [list(batch) for batch in batches] == [["A", "C"]]
+    assert [line for line, _ in errors] == [2, 3, 4, 5, 6]
+    assert "invalid JSON" in errors[0][1]
+    assert errors[1][1] == "duplicate case study name 'A' in file"
+    assert errors[2][1] == "case study 'Existing' already exists"
+    assert errors[3][1] == "expected a JSON object"
+
+
+def test_csv_import_unflattens_dotted_columns(app):
+    data = ("name,capex.Reactor,composition.Co,phases.Leach.liquids.Water,assumptions\n"
+            "A,300,20,10,first|second\n"
+            "B,1,2,3,x,extra\n").encode("utf-8")
+    batches = []
+    count, errors = app.import_case_studies(io.BytesIO(data), "csv", set(), batches.append)
+
+    assert count == 1
+    record = batches[0]["A"]
+    assert record["assumptions"] == ["first", "second"]
+    assert record["technical_kpis"]["composition"] == {"Co": 20.0}
+    assert record["technical_kpis"]["phases"]["Leach"]["liquids"] == {"Water": 10.0}
+    assert errors == [(3, "row has more values than the header")]
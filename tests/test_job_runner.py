@@ -0,0 +1,60 @@
+import threading
+import time
+
+
+def wait_for(job, timeout=5.0):
+    deadline = time.time() + timeout
+    while job.status in ("queued", "running") and time.time() < deadline:
+        time.sleep(0.01)
+    return job
+
+
+def test_identical_requests_share_one_job(app):
+    runner = app.JobRunner(max_workers=1)
+    calls = []
+
+    def work(params, report_progress):
+        calls.append(params)
+        report_progress(0.5)
+        return params["x"] * 2
+
+    job = runner.submit("double", "Double", work, {"x": 21})
+    assert runner.submit("double", "Double", work, {"x": 21}) is job
+    assert wait_for(job).status == "done"
+    assert job.result == 42 and job.progress == 1.0 and job.finished_at > 0
+    assert runner.find("double", {"x": 21}) is job
+    assert len(calls) == 1
+
+
+def test_failures_and_cancellation_are_reported(app):
+    runner = app.JobRunner(max_workers=1)
+    started = threading.Event()
+
+    def fail(params, report_progress):
+        raise ValueError("bad input")
+
+    def slow(params, report_progress):
+        started.set()
+        while True:
+            report_progress(0.1)
+            time.sleep(0.01)
+
+    failed = wait_for(runner.submit("fail", "Fail", fail, {}))
+    assert failed.status == "failed" and failed.error == "bad input"
+
+    job = runner.submit("slow", "Slow", slow, {})
+    assert started.wait(5)
+    runner.cancel(job.job_id)
+    assert wait_for(job).status == "cancelled" and job.finished_at > 0
+
+
+def test_finished_jobs_are_evicted_oldest_first_over_the_memory_limit(app):
+    runner = app.JobRunner(max_workers=1, max_result_bytes=1000)
+
+    def work(params, report_progress):
+        return app.np.zeros(100)  # 800 byte
+
+    first = wait_for(runner.submit("array", "First", work, {"n": 1}))
+    second = wait_for(runner.submit("array", "Second", work, {"n": 2}))
+    assert runner.get(first.job_id) is None
+    assert runner.get(second.job_id) is second
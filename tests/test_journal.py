@@ -0,0 +1,40 @@
+import json
+
+
+def test_record_appends_only_changes_and_load_replays_them(app, tmp_path):
+    path = str(tmp_path / "data.json")
+    journal = app.EditJournal(path)
+    assert journal.record({"a": {"x": 1}, "b": {"y": 2}}) is None  # Nuovo snapshot
+
+    ops = journal.record({"a": {"x": 5}, "b": {"y": 2}})
+    assert ops == [{"op": "add", "path": "/a/x", "value": 5}]
+    assert journal.record({"a": {"x": 5}, "b": {"y": 2}}) == []
+
+    assert app.EditJournal(path).load() == {"a": {"x": 5}, "b": {"y": 2}}
+
+
+def test_replay_skips_a_torn_entry_and_keeps_later_ones(app, tmp_path):
+    path = str(tmp_path / "data.json")
+    journal = app.EditJournal(path)
+    journal.record({"a": 1, "b": 1})
+    journal.record({"a": 2, "b": 1})
+    # Scrittura interrotta da un crash: frammento senza ritorno a capo finale
+    with open(path + ".journal", "a") as file:
+        file.write('{"ts": 0, "ops": [{"op": "add", "path": "/a"')
+
+    reopened = app.EditJournal(path)
+    assert reopened.load() == {"a": 2, "b": 1}
+    reopened.record({"a": 2, "b": 3})
+    assert app.EditJournal(path).load() == {"a": 2, "b": 3}
+
+
+def test_compact_folds_the_journal_into_the_snapshot(app, tmp_path):
+    path = str(tmp_path / "data.json")
+    journal = app.EditJournal(path)
+    journal.record({"a": {"x": 1}})
+    journal.record({"a": {"x": 1, "y": "/~"}})
+    journal.compact()
+
+    with open(path) as file:
+        assert json.load(file) == {"a": {"x": 1, "y": "/~"}}
+    assert app.EditJournal(path).load() == {"a": {"x": 1, "y": "/~"}}
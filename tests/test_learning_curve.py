@@ -0,0 +1,24 @@
+import numpy as np
+
+
+def test_each_doubling_reduces_cost_by_the_learning_rate(app):
+    projection = app.project_learning_curve(np.array([[100.0, 50.0]]), np.array([[0.2, 0.1]]), [1, 2, 4])
+    np.testing.assert_allclose(projection[0, 0], [150.0, 80.0 + 45.0, 64.0 + 40.5])
+
+
+def test_chunked_percentiles_match_the_full_projection(app):
+    costs = np.array([[100.0, 50.0], [80.0, 0.0]])
+    learning_rates = app.sample_learning_rates([0.15, 0.1], [0.05, 0.05], samples=200, seed=3)
+    units = np.arange(1, 40)
+    expected = np.percentile(app.project_learning_curve(costs, learning_rates, units), (5, 50, 95),
+                             axis=1).transpose(1, 0, 2)
+    # max_elements piccolo: un passo per blocco
+    result = app.learning_curve_percentiles(costs, learning_rates, units, max_elements=1)
+    np.testing.assert_allclose(result, expected)
+    assert (result[:, 0] <= result[:, 1]).all() and (result[:, 1] <= result[:, 2]).all()
+
+
+def test_sampled_rates_stay_in_range(app):
+    rates = app.sample_learning_rates([0.02, 0.94], [0.1, 0.1], samples=500)
+    assert rates.shape == (500, 2)
+    assert rates.min() >= 0.0 and rates.max() <= 0.95
@@ -0,0 +1,51 @@
+import pytest
+
+
+def linked_scenario(app, water_volume):
+    scenario = app.get_default_scenario()
+    scenario["opex"] = {"Labor": 10.0}
+    scenario["technical_kpis"]["total_black_mass"] = 20.0
+    scenario["technical_kpis"]["phases"] = {"Leach": {"masses": {"BM": 20.0}, "liquids": {"Water": water_volume}}}
+    scenario["reagent_link"] = {"prices": {"Water": 0.5}, "reference_black_mass": 10.0}
+    return scenario
+
+
+def test_sync_scales_phase_volumes_by_batch_mass(app):
+    scenario = linked_scenario(app, 4.0)
+    assert app.sync_linked_reagents(scenario) == ["Water"]
+    assert scenario["opex"] == {"Labor": 10.0, "Water": 4.0}  # 4 L x 0.5 EUR/L x (20 / 10 kg)
+    assert app.sync_linked_reagents(scenario) == []
+
+
+def test_store_does_not_modify_the_callers_scenario(app):
+    scenario = linked_scenario(app, 4.0)
+    opex = scenario["opex"]
+    store = app.ScenarioStore()
+    store["base"] = scenario
+    assert opex == {"Labor": 10.0} and "Water" not in scenario["opex"]
+    assert store["base"]["opex"]["Water"] == pytest.approx(4.0)
+
+
+def test_inherited_phase_changes_reach_linked_items_of_children(app):
+    store = app.ScenarioStore({"base": linked_scenario(app, 4.0)})
+    store.create_child("child", "base")
+    child = store["child"]
+    child["opex"]["Labor"] = 12.0
+    store["child"] = child
+    assert store.overrides("child") == {"opex": {"Labor": 12.0}}
+
+    base = store["base"]
+    base["technical_kpis"]["phases"]["Leach"]["liquids"]["Water"] = 6.0
+    store["base"] = base
+    assert store.view("child")["opex"] == {"Labor": 12.0, "Water": 6.0}
+    assert store.model("child").opex.to_dict()["Water"] == pytest.approx(6.0)
+
+
+def test_child_with_its_own_phases_keeps_no_linked_values_in_the_delta(app):
+    store = app.ScenarioStore({"base": linked_scenario(app, 4.0)})
+    store.create_child("child", "base")
+    child = store["child"]
+    child["technical_kpis"]["total_black_mass"] = 40.0
+    store["child"] = child
+    assert "opex" not in store.overrides("child")
+    assert store.view("child")["opex"]["Water"] == pytest.approx(8.0)
@@ -0,0 +1,28 @@
+import numpy as np
+
+
+def test_corpus_round_trip(corpus):
+    assert corpus.names == ["Paper A", "Paper B"]
+    row = corpus.index("Paper A")
+    assert corpus.line_items("capex", row).to_dict() == {"Reactor": 300.0, "Filter": 100.0}
+    assert corpus.technical_kpis(row)["phases"] == {"Leach": {"masses": {"BM": 5.0}, "liquids": {"Water": 10.0}}}
+    np.testing.assert_allclose(corpus.column("capex_total"), [400.0, 50.0])
+    np.testing.assert_allclose(corpus.column("total_mass"), [5.0, 0.0])
+    assert corpus.model(corpus.index("Paper B")).opex.to_dict() == {"Labor": 10.0}
+
+
+def test_dense_matrix_per_item_group(corpus):
+    matrix, names = corpus.dense("opex")
+    assert names == ["Labor", "Acid"]
+    np.testing.assert_allclose(matrix, [[60.0, 40.0], [10.0, 0.0]])
+
+
+def test_content_key_follows_the_persisted_content(app, tmp_path):
+    path = str(tmp_path / "case_studies.json")
+    journal = app.EditJournal(path)
+    journal.record({"Paper A": {"energy_cost": 0.1}})
+    key = journal.content_key()
+    journal.record({"Paper A": {"energy_cost": 0.1}})  # Nessuna modifica: niente da scrivere
+    assert app.EditJournal(path).content_key() == key
+    journal.record({"Paper A": {"energy_cost": 0.2}})
+    assert journal.content_key() != key
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def network(app, tmp_path):
+    nodes = tmp_path / "nodes.csv"
+    nodes.write_text("id,type,supply_kg_per_year,capex_multiplier\n"
+                     "S1,source,1000,\nS2,source,3000,\nS3,source,0,\n"
+                     "A,site,,1.0\nB,site,,1.5\nHub,hub,,\n")
+    edges = tmp_path / "edges.csv"
+    # Verso B si passa dall'hub (anche S2, via A e S1); S3 è isolata ma non fornisce nulla
+    edges.write_text("from,to,distance_km\nS1,A,100\nS1,Hub,10\nHub,B,20\nS2,A,50\nA,B,200\n")
+    return app.LogisticsNetwork(str(nodes), str(edges))
+
+
+def test_shortest_distances_from_every_source(network):
+    assert network.sources == ["S1", "S2", "S3"] and network.sites == ["A", "B"]
+    np.testing.assert_allclose(network.distances[:2], [[100.0, 30.0], [50.0, 180.0]])
+    assert np.isinf(network.distances[2]).all()
+
+
+def test_site_costs_weight_transport_by_supply(network):
+    transport, capex, total = network.site_costs(transport_rate=0.001, annual_capex=4000.0, opex_per_kg=0.5)
+    np.testing.assert_allclose(transport, [(1000 * 100 + 3000 * 50) * 0.001 / 4000,
+                                           (1000 * 30 + 3000 * 180) * 0.001 / 4000])
+    np.testing.assert_allclose(capex, [1.0, 1.5])
+    np.testing.assert_allclose(total, transport + capex + 0.5)
+
+
+def test_unknown_edge_nodes_are_rejected(app, tmp_path):
+    nodes = tmp_path / "nodes.csv"
+    nodes.write_text("id,type\nA,site\n")
+    edges = tmp_path / "edges.csv"
+    edges.write_text("from,to,distance_km\nA,Z,1\n")
+    with pytest.raises(ValueError, match="unknown node"):
+        app.LogisticsNetwork(str(nodes), str(edges))
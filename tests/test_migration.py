@@ -0,0 +1,37 @@
+def test_migrate_record_fills_defaults_and_normalizes_phases(app):
+    record = app.migrate_record({
+        "capex": {"Reactor": "1000"},
+        "energy_cost": None,
+        "technical_kpis": {
+            "composition": {"Co": "12"},
+            "phases": {
+                "Leaching": {"mass": 5, "liquids": [{"type": "Water", "volume": 10}, {"type": "Water", "volume": 2}]},
+                "Old": {"masses": {"BM": 2}, "liquids": [3, "4"]}
+            }
+        }
+    }, app.get_default_case_study())
+
+    assert record["schema_version"] == app.SCHEMA_VERSION
+    assert record["capex"] == {"Reactor": 1000.0}
+    assert record["opex"] == {}
+    assert record["energy_cost"] == 0.0
+    assert record["currency"] == "EUR"
+    assert record["cost_year"] == app.DEFAULT_COST_YEAR
+    assert record["technical_kpis"]["composition"] == {"Co": 12.0}
+    assert record["technical_kpis"]["phases"] == {
+        "Leaching": {"masses": {"Black Mass": 5.0}, "liquids": {"Water": 12.0}},
+        "Old": {"masses": {"BM": 2.0}, "liquids": {"Liquid 1": 3.0, "Liquid 2": 4.0}}
+    }
+
+
+def test_migrate_record_is_idempotent(app):
+    record = app.migrate_record({"capex": {"Reactor": 1}, "currency": "usd", "cost_year": "2019"},
+                                app.get_default_case_study())
+    assert record["currency"] == "USD"
+    assert record["cost_year"] == 2019
+    assert app.migrate_record(dict(record), app.get_default_case_study()) == record
+
+
+def test_migrate_delta_keeps_removal_markers_and_adds_no_defaults(app):
+    delta = app.migrate_delta({"capex": {"Reactor": "5", "Filter": None}, "energy_cost": "0.2"})
+    assert delta == {"capex": {"Reactor": 5.0, "Filter": None}, "energy_cost": 0.2}
@@ -0,0 +1,21 @@
+def record(assumptions, reactor, composition):
+    return {"assumptions": [assumptions], "capex": {"Reactor": reactor}, "opex": {"Labor": 40.0},
+            "technical_kpis": {"composition": composition}}
+
+
+def test_re_entered_case_study_is_a_candidate_pair(app):
+    text = "Leaching of black mass with malic acid at 80 C followed by precipitation of cobalt"
+    index = app.NearDuplicateIndex({
+        "Paper A": record(text, 300.0, {"Co": 20.0}),
+        "Paper A (copy)": record(text, 301.0, {"Co": 20.2}),  # Stesso bucket di costo e composizione
+        "Paper B": record("Pyrometallurgical smelting of modules in an electric furnace", 900.0, {"Ni": 30.0})
+    })
+    duplicates = index.duplicates(threshold=0.7)
+    assert [(first, second) for first, second, _ in duplicates] == [("Paper A", "Paper A (copy)")]
+    assert duplicates[0][2] == 1.0
+    assert index.similarity(0, 2) < 0.3
+
+
+def test_empty_records_are_never_candidates(app):
+    index = app.NearDuplicateIndex({"Empty 1": {}, "Empty 2": {}})
+    assert index.duplicates(threshold=0.0) == []
@@ -0,0 +1,12 @@
+import numpy as np
+import pytest
+
+
+def test_pairwise_relative_differences(app):
+    values = np.array([[100.0, 0.0], [50.0, 2.0], [200.0, 4.0]])
+    differences = app.pairwise_relative_differences(values)
+
+    assert differences.shape == (2, 3, 3)
+    np.testing.assert_allclose(differences[0], [[0.0, 100.0, -50.0], [-50.0, 0.0, -75.0], [100.0, 300.0, 0.0]])
+    assert np.isnan(differences[1, :, 0]).all()
+    assert differences[1, 2, 1] == pytest.approx(100.0)
@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+import pytest
+
+
+def write_csv(tmp_path, text):
+    path = tmp_path / "prices.csv"
+    path.write_text(text)
+    return str(path)
+
+
+def test_history_is_sorted_and_forward_filled(app, tmp_path):
+    csv_path = write_csv(tmp_path, "Date,Co,Li\n2024-01-03,30,\n2024-01-01,28,12\n\n2024-01-02,,13\n")
+    directory = str(tmp_path / "history")
+    app.write_price_history(csv_path, directory)
+    history = app.PriceHistory(directory)
+
+    assert len(history) == 3 and history.materials == ["Co", "Li"]
+    np.testing.assert_allclose(history.prices, [[28.0, 12.0], [28.0, 13.0], [30.0, 13.0]])
+    assert history.date_range() == (np.datetime64("2024-01-01"), np.datetime64("2024-01-03"))
+    np.testing.assert_allclose(history.prices_at(["li", "Ni"], "2024-01-02"), [13.0, 0.0])
+    revenue, unpriced = history.revenue([{"Co": 2.0, "Cu": 1.0}], start="2024-01-02")
+    np.testing.assert_allclose(revenue[:, 0], [56.0, 60.0])
+    assert unpriced == ["Cu"]
+
+
+@pytest.mark.parametrize("text, message", [
+    ("Date,Co\n2024-01-01,30\n2024-01-02\n", "line 3: 1 values for 2 columns"),
+    ("Date,Co\n2024-01-01,30,1\n", "line 2: 3 values for 2 columns"),
+    ("Date,Co\n2024-01-01,n/a\n", "line 2: 'n/a' is not a price for Co"),
+    ("Date,Co\nyesterday,30\n", "line 2: 'yesterday' is not a date"),
+    ("Day,Co\n2024-01-01,30\n", "no 'date' column"),
+])
+def test_invalid_rows_are_rejected_with_the_line_number(app, tmp_path, text, message):
+    with pytest.raises(ValueError, match=message):
+        app.write_price_history(write_csv(tmp_path, text), str(tmp_path / "history"))
+
+
+def test_failed_build_leaves_no_temporary_directory(app):
+    with open(app.price_history_file, "w") as file:
+        file.write("Date,Co\n2024-01-01,30,1\n")
+    try:
+        with pytest.raises(ValueError):
+            app.open_price_history(app.price_history_version())
+        assert not [name for name in os.listdir(app.data_dir) if name.startswith(".prices_")]
+    finally:
+        os.remove(app.price_history_file)
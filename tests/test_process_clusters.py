@@ -0,0 +1,18 @@
+import numpy as np
+
+
+def test_kmeans_separates_well_separated_groups(app):
+    rng = np.random.default_rng(1)
+    features = np.vstack([rng.normal(0.0, 0.05, (20, 2)), rng.normal(5.0, 0.05, (20, 2))])
+    labels, centers = app.ProcessClusters._kmeans(features, 2, 100, seed=0)
+    assert len(set(labels[:20])) == 1 and len(set(labels[20:])) == 1 and labels[0] != labels[20]
+    np.testing.assert_allclose(np.sort(centers[:, 0]), [0.0, 5.0], atol=0.1)
+
+
+def test_clusters_of_the_corpus(app, corpus):
+    clusters = app.ProcessClusters(corpus, n_clusters=5)
+    assert len(clusters) == 2  # Non più cluster che case studies
+    assert sorted(clusters.sizes()) == [1, 1]
+    paper_a = clusters.labels[corpus.index("Paper A")]
+    assert clusters.label(paper_a) == "Cluster %d (1 case studies: Reactor / Labor)" % (paper_a + 1)
+    assert clusters.centroid_model(paper_a).capex.to_dict() == {"Reactor": 300.0, "Filter": 100.0}
@@ -0,0 +1,53 @@
+import pytest
+
+
+@pytest.fixture
+def store(app):
+    base = app.get_default_scenario()
+    base["capex"] = {"Reactor": 100.0, "Filter": 50.0}
+    base["opex"] = {"Labor": 10.0, "Water": 2.0}
+    return app.ScenarioStore({
+        "base": base,
+        "child": {"parent": "base", "energy_cost": 0.3, "capex": {"Filter": None, "Dryer": 20.0}}
+    })
+
+
+def test_delta_resolution(store):
+    child = store["child"]
+    assert child["energy_cost"] == 0.3
+    assert child["capex"] == {"Reactor": 100.0, "Dryer": 20.0}
+    assert child["opex"] == {"Labor": 10.0, "Water": 2.0}
+
+
+def test_parent_changes_propagate_to_children(store):
+    base = store["base"]
+    base["opex"]["Labor"] = 15.0
+    store["base"] = base
+    assert store.view("child")["opex"]["Labor"] == 15.0
+    assert store.overrides("child") == {"energy_cost": 0.3, "capex": {"Filter": None, "Dryer": 20.0}}
+
+
+def test_setting_a_child_stores_only_the_differences(store):
+    child = store["child"]
+    child["opex"]["Water"] = 4.0
+    store["child"] = child
+    assert store.overrides("child")["opex"] == {"Water": 4.0}
+
+
+def test_delete_reparents_children_with_resolved_values(store):
+    del store["base"]
+    assert "base" not in store
+    assert store.parent("child") is None
+    assert store["child"]["capex"] == {"Reactor": 100.0, "Dryer": 20.0}
+    assert store["child"]["energy_cost"] == 0.3
+
+
+def test_json_keeps_only_the_delta(store):
+    assert store.to_json_dict()["child"] == {"parent": "base", "energy_cost": 0.3,
+                                             "capex": {"Filter": None, "Dryer": 20.0}}
+
+
+def test_new_child_inherits_everything(app, store):
+    store.create_child("grandchild", "child")
+    assert store.overrides("grandchild") == {}
+    assert store["grandchild"] == store["child"]
@@ -0,0 +1,52 @@
+import types
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def store(app):
+    base = app.get_default_scenario()
+    base["capex"] = {"Reactor": 100.0, "Filter": 50.0}
+    base["opex"] = {"Labor": 10.0, "Water": 2.0}
+    other = app.get_default_scenario()
+    other["capex"] = {"Reactor": 70.0}
+    other["opex"] = {}
+    return app.ScenarioStore({"base": base, "other": other})
+
+
+def test_scenario_model_round_trips_through_line_items(app):
+    data = app.get_default_scenario()
+    data["custom_key"] = {"kept": True}
+    model = app.ScenarioModel.from_dict(data)
+    assert isinstance(model.capex.values, np.ndarray)
+    assert model.capex.total() == pytest.approx(sum(data["capex"].values()))
+    assert model.to_dict() == data
+
+
+def test_models_with_the_same_items_share_names(store):
+    assert store.model("base").capex.names == ("Reactor", "Filter")
+    assert store.model("base").energy_consumption.names is store.model("other").energy_consumption.names
+
+
+def test_view_is_read_only_and_getitem_returns_a_copy(store):
+    view = store.view("base")
+    assert isinstance(view, types.MappingProxyType)
+    with pytest.raises(TypeError):
+        view["energy_cost"] = 1.0
+    copy = store["base"]
+    copy["capex"]["Reactor"] = 0.0
+    assert store.view("base")["capex"]["Reactor"] == 100.0
+
+
+def test_unchanged_write_keeps_the_version(store):
+    version = store.version
+    store["base"] = store["base"]
+    assert store.version == version
+
+
+def test_totals(store):
+    energy_costs, capex, opex = store.totals(["base", "other"])
+    np.testing.assert_allclose(capex, [150.0, 70.0])
+    np.testing.assert_allclose(opex, [12.0, 0.0])
+    np.testing.assert_allclose(energy_costs, [store.view("base")["energy_cost"], store.view("other")["energy_cost"]])
@@ -0,0 +1,33 @@
+import pytest
+
+
+@pytest.fixture
+def index(app):
+    return app.SearchIndex({
+        "Hydromet Malic": {"assumptions": ["Leaching with organic acid"], "opex": {"Malic Acid": 5.0},
+                           "technical_kpis": {"composition": {"Co": 20.0, "Li": 5.0}}},
+        "Hydromet Sulfuric": {"assumptions": ["Inorganic leaching"], "opex": {"Sulfuric Acid": 3.0},
+                              "technical_kpis": {"composition": {"Co": 8.0}}},
+        "Pyromet": {"capex": {"Furnace": 100.0}, "technical_kpis": {"composition": {"Ni": 30.0}}}
+    })
+
+
+def test_words_match_as_prefixes_and_all_are_required(index):
+    assert index.search("hydro") == ["Hydromet Malic", "Hydromet Sulfuric"]
+    assert index.search("hydro organ") == ["Hydromet Malic"]
+    assert index.search("furn") == ["Pyromet"]
+    assert index.search("missing") == []
+
+
+def test_composition_facets(index):
+    assert index.search("Co>=10") == ["Hydromet Malic"]
+    assert index.search("co<10%") == ["Hydromet Sulfuric"]
+    assert index.search("Mn>0") == []
+    assert index.search(composition=[("Ni", "=", 30.0)]) == ["Pyromet"]
+
+
+def test_used_item_facets(index):
+    assert index.search('uses:"Malic Acid"') == ["Hydromet Malic"]
+    assert index.search("uses:sulf") == ["Hydromet Sulfuric"]
+    assert index.search("hydro", uses=["furnace"]) == []
+    assert index.materials() == ["co", "li", "ni"]
@@ -0,0 +1,38 @@
+def test_commit_skips_unchanged_records_regardless_of_key_order(app):
+    history = app.VersionHistory()
+    first = history.commit("scenario", "base", {"capex": {"Reactor": 1.0, "Filter": 2.0}, "energy_cost": 0.1})
+    second = history.commit("scenario", "base", {"energy_cost": 0.1, "capex": {"Filter": 2.0, "Reactor": 1.0}})
+    assert first == second
+    assert history.versions("scenario", "base") == [first]
+
+
+def test_undo_redo_and_new_commit_after_undo(app):
+    history = app.VersionHistory()
+    history.commit("scenario", "base", {"energy_cost": 0.1})
+    history.commit("scenario", "base", {"energy_cost": 0.2})
+    assert history.undo("scenario", "base") == {"energy_cost": 0.1}
+    assert not history.can_undo("scenario", "base")
+    assert history.redo("scenario", "base") == {"energy_cost": 0.2}
+    history.undo("scenario", "base")
+    history.commit("scenario", "base", {"energy_cost": 0.3})
+    assert not history.can_redo("scenario", "base")
+    assert len(history.versions("scenario", "base")) == 2
+
+
+def test_unchanged_sub_structures_are_shared(app):
+    history = app.VersionHistory()
+    history.commit("scenario", "base", {"capex": {"Reactor": 1.0}, "energy_cost": 0.1})
+    history.commit("scenario", "base", {"capex": {"Reactor": 1.0}, "energy_cost": 0.2})
+    assert len(history._blobs) == 3
+
+
+def test_compact_drops_unreachable_versions(app):
+    history = app.VersionHistory(max_versions=3)
+    for value in range(10):
+        history.commit("scenario", "base", {"energy_cost": value})
+    versions = history.versions("scenario", "base")
+    assert len(versions) == 3
+    assert history.checkout(versions[0]) == {"energy_cost": 7}
+    history.compact()
+    assert set(history._trees) == set(versions)
+    assert len(history._blobs) == 3